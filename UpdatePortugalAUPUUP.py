@@ -1,295 +1,3632 @@
+import argparse
+import asyncio
+import bisect
+import concurrent.futures
+import contextlib
+import copy
+import functools
+import hashlib
+import http.client
+import importlib
+import importlib.util
+import io
+import math
 import os
+import pickle
+import posixpath
 import re
+import sqlite3
 import sys
+import tempfile
+import threading
+import time
 import traceback
+import urllib.parse
+import zipfile
 from datetime import datetime, timedelta, timezone
+from datetime import time as dt_time
+from xml.parsers import expat
 
 import json
+import multiprocessing
 
-from bs4 import BeautifulSoup
-from lxml import etree
-from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
-from playwright.sync_api import sync_playwright
+
+class LazyModule:
+    # Тяжёлые зависимости импортируются при первом обращении к атрибуту:
+    # импорт скрипта как библиотеки и офлайн-запуск не загружают браузерный стек
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        return f"<lazy module '{self._name}'>"
+
+
+def module_available(name):
+    return importlib.util.find_spec(name) is not None
+
+
+etree = LazyModule("lxml.etree")
+bs4 = LazyModule("bs4")
+playwright_sync = LazyModule("playwright.sync_api")
+# numpy нужен только для упрощения геометрии (SIMPLIFY_TOLERANCE_M и др.)
+np = LazyModule("numpy")
 
 
 # --- ЗАГРУЗКА ПАРАМЕТРОВ ---
 CONFIG_FILE = "config.json"
 
+DEFAULT_CONFIG = {
+    "IS_ONLINE": True,
+    "HTML_FILE": "AUP_UUP Details.htm",
+    "INPUT_KML": "Data Base.kml",
+    "OUTPUT_KML": "Active Regions.kml",
+    "KML_NS": "http://www.opengis.net/kml/2.2",
+    "FULL_COPY": ["ALWAYS ON - NOT CHANGE AREAS LP-R (ALWAYS THE SAME)", "ALWAYS ON - DAILY NOTAM UPDATES AREAS (AS IN DAILY EMAIL AT 05H00)", "ALWAYS ON - NOT CHANGE AIRSPACE 2026 (ALWAYS THE SAME)"],
+    "TRACEBACK_FILE": "Traceback.txt",
+    "BAN_WORDS": ["lp-", "lp", "area", "fall", "land", "tancos", "-"],
+    "NAME_INDEX": True,
+    "STREAMING_KML": False,
+    "HTML_ENGINE": "lxml",
+    "LINK_DISCOVERY": True,
+    "EAUP_RELEASE": None,
+    "FETCH_BACKEND": "playwright",
+    "HTTP_RELEASES_URL": None,
+    "HTTP_TABLE_URL": None,
+    "WATCH_INTERVAL": 300,
+    "CACHE_DIR": "cache",
+    "CACHE_MAX_MB": 200,
+    "CACHE_MAX_AGE_DAYS": 30,
+    "DELTA_KML": False,
+    "DELTA_REFRESH_INTERVAL": 300,
+    "FULL_REFRESH_INTERVAL": 3600,
+    "ICAO_PREFIXES": ["LP"],
+    "SKIP_NAMES": ["LPA"],
+    "JOBS": [],
+    "BATCH_WORKERS": None,
+    "TIME_SPANS": False,
+    "TIME_SPAN_DAY": "today",
+    "METRICS_FILE": None,
+    "PROMETHEUS_FILE": None,
+    "LOG_FORMAT": "text",
+    "COMPACT_KML": False,
+    "OPTIMIZE_STYLES": True,
+    "SIMPLIFY_TOLERANCE_M": None,
+    "COORDINATE_PRECISION": None,
+    "REGION_LOD_PIXELS": None,
+    "ASYNC_PIPELINE": True,
+    "TEMPLATE_ERROR_POLICY": "skip",
+    "SPATIAL_CELL_DEG": 0.25,
+    "HISTORY_DB": "history.sqlite",
+    "HISTORY_RECORD": False,
+    "ROW_DELTA": True,
+    "OUTPUTS": []
+}
+
 
-def load_config():
-    if not os.path.exists(CONFIG_FILE):
+def load_config(path=None):
+    path = path or CONFIG_FILE
+    if not os.path.exists(path):
         # Если файла нет, создаем его с дефолтными значениями
-        default_config = {
-            "IS_ONLINE": True,
-            "HTML_FILE": "AUP_UUP Details.htm",
-            "INPUT_KML": "Data Base.kml",
-            "OUTPUT_KML": "Active Regions.kml",
-            "KML_NS": "http://www.opengis.net/kml/2.2",
-            "FULL_COPY": ["ALWAYS ON - NOT CHANGE AREAS LP-R (ALWAYS THE SAME)", "ALWAYS ON - DAILY NOTAM UPDATES AREAS (AS IN DAILY EMAIL AT 05H00)", "ALWAYS ON - NOT CHANGE AIRSPACE 2026 (ALWAYS THE SAME)"],
-            "TRACEBACK_FILE": "Traceback.txt",
-            "BAN_WORDS": ["lp-", "lp", "area", "fall", "land", "tancos", "-"]
-        }
-        with open(CONFIG_FILE, "w", encoding="utf-8") as f:
+        default_config = copy.deepcopy(DEFAULT_CONFIG)
+        with open(path, "w", encoding="utf-8") as f:
             json.dump(default_config, f, indent=4, ensure_ascii=False)
         return default_config
 
-    with open(CONFIG_FILE, "r", encoding="utf-8") as f:
+    with open(path, "r", encoding="utf-8") as f:
         return json.load(f)
 
 
-config = load_config()
+def apply_config(new_config):
+    # Конфиг применяется явно (CLI или вызывающий код); при импорте модуля действуют значения по умолчанию
+    global config, IS_ONLINE, HTML_FILE, INPUT_KML, OUTPUT_KML, KML_NS, FULL_COPY, TRACEBACK_FILE, BAN_WORDS, NAME_INDEX
+    global STREAMING_KML, HTML_ENGINE, LINK_DISCOVERY, EAUP_RELEASE, FETCH_BACKEND, HTTP_RELEASES_URL, HTTP_TABLE_URL
+    global WATCH_INTERVAL, CACHE_DIR, CACHE_MAX_MB, CACHE_MAX_AGE_DAYS, DELTA_KML, DELTA_REFRESH_INTERVAL
+    global FULL_REFRESH_INTERVAL, ICAO_PREFIXES, SKIP_NAMES, JOBS, BATCH_WORKERS, TIME_SPANS, TIME_SPAN_DAY
+    global METRICS_FILE, PROMETHEUS_FILE, LOG_FORMAT, COMPACT_KML, OPTIMIZE_STYLES, SIMPLIFY_TOLERANCE_M
+    global COORDINATE_PRECISION, REGION_LOD_PIXELS, ASYNC_PIPELINE, TEMPLATE_ERROR_POLICY
+    global SPATIAL_CELL_DEG, HISTORY_DB, HISTORY_RECORD, ROW_DELTA, OUTPUTS
+    config = new_config
+    IS_ONLINE = config["IS_ONLINE"]
+    HTML_FILE = config["HTML_FILE"]
+    INPUT_KML = config["INPUT_KML"]
+    OUTPUT_KML = config["OUTPUT_KML"]
+    KML_NS = config["KML_NS"]
+    FULL_COPY = config["FULL_COPY"]
+    TRACEBACK_FILE = config["TRACEBACK_FILE"]
+    BAN_WORDS = config["BAN_WORDS"]
+    NAME_INDEX = config.get("NAME_INDEX", True)
+    STREAMING_KML = config.get("STREAMING_KML", False)
+    HTML_ENGINE = config.get("HTML_ENGINE", "lxml")
+    LINK_DISCOVERY = config.get("LINK_DISCOVERY", True)
+    EAUP_RELEASE = config.get("EAUP_RELEASE")
+    FETCH_BACKEND = config.get("FETCH_BACKEND", "playwright")
+    HTTP_RELEASES_URL = config.get("HTTP_RELEASES_URL")
+    HTTP_TABLE_URL = config.get("HTTP_TABLE_URL")
+    WATCH_INTERVAL = config.get("WATCH_INTERVAL", 300)
+    CACHE_DIR = config.get("CACHE_DIR", "cache")
+    CACHE_MAX_MB = config.get("CACHE_MAX_MB", 200)
+    CACHE_MAX_AGE_DAYS = config.get("CACHE_MAX_AGE_DAYS", 30)
+    DELTA_KML = config.get("DELTA_KML", False)
+    DELTA_REFRESH_INTERVAL = config.get("DELTA_REFRESH_INTERVAL", 300)
+    FULL_REFRESH_INTERVAL = config.get("FULL_REFRESH_INTERVAL", 3600)
+    ICAO_PREFIXES = [prefix.upper() for prefix in config.get("ICAO_PREFIXES", ["LP"])]
+    SKIP_NAMES = config.get("SKIP_NAMES", ["LPA"])
+    JOBS = config.get("JOBS", [])
+    BATCH_WORKERS = config.get("BATCH_WORKERS")
+    TIME_SPANS = config.get("TIME_SPANS", False)
+    TIME_SPAN_DAY = config.get("TIME_SPAN_DAY", "today")
+    METRICS_FILE = config.get("METRICS_FILE")
+    PROMETHEUS_FILE = config.get("PROMETHEUS_FILE")
+    LOG_FORMAT = config.get("LOG_FORMAT", "text")
+    COMPACT_KML = config.get("COMPACT_KML", False)
+    OPTIMIZE_STYLES = config.get("OPTIMIZE_STYLES", True)
+    SIMPLIFY_TOLERANCE_M = config.get("SIMPLIFY_TOLERANCE_M")
+    COORDINATE_PRECISION = config.get("COORDINATE_PRECISION")
+    REGION_LOD_PIXELS = config.get("REGION_LOD_PIXELS")
+    ASYNC_PIPELINE = config.get("ASYNC_PIPELINE", True)
+    TEMPLATE_ERROR_POLICY = config.get("TEMPLATE_ERROR_POLICY", "skip")
+    SPATIAL_CELL_DEG = config.get("SPATIAL_CELL_DEG", 0.25)
+    HISTORY_DB = config.get("HISTORY_DB", "history.sqlite")
+    HISTORY_RECORD = config.get("HISTORY_RECORD", False)
+    ROW_DELTA = config.get("ROW_DELTA", True)
+    OUTPUTS = config.get("OUTPUTS", [])
+
+
+apply_config(DEFAULT_CONFIG)
+HTTP_USER_AGENT = "Mozilla/5.0 (compatible; UpdatePortugalAUPUUP)"
+
+
+# --- МЕТРИКИ ---
+ANSI_RE = re.compile(r'\033\[[0-9;]*m')
+
+
+def log_event(event, **fields):
+    # В режиме LOG_FORMAT="json" события этапов пишутся отдельными строками JSON
+    if LOG_FORMAT != "json":
+        return
+    record = {"time": datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ'), "event": event}
+    record.update(fields)
+    stream = sys.stdout.stream if isinstance(sys.stdout, JsonLogStream) else sys.stdout
+    stream.write(json.dumps(record, ensure_ascii=False) + "\n")
+    stream.flush()
+
+
+class JsonLogStream:
+    # Подменяет sys.stdout: каждая напечатанная строка уходит как {"time", "event": "message", "message"}
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = ""
+
+    def write(self, text):
+        self.buffer += text
+        while "\n" in self.buffer:
+            line, self.buffer = self.buffer.split("\n", 1)
+            line = ANSI_RE.sub('', line).strip()
+            if line:
+                log_event("message", message=line)
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def setup_logging():
+    if LOG_FORMAT == "json" and not isinstance(sys.stdout, JsonLogStream):
+        sys.stdout = JsonLogStream(sys.stdout)
+
+
+class Metrics:
+    # Длительности этапов, счётчики строк/меток и размеры файлов одного запуска.
+    # Экспорт: JSON (METRICS_FILE) и textfile для node_exporter (PROMETHEUS_FILE)
+    def __init__(self):
+        # Этапы в run_pipeline_async идут в нескольких потоках сразу
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+        self.sizes = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            yield
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            with self.lock:
+                stage = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0, "errors": 0})
+                stage["seconds"] += seconds
+                stage["calls"] += 1
+                if status == "error":
+                    stage["errors"] += 1
+            log_event("stage", stage=name, seconds=round(seconds, 4), status=status)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_bytes(self, name, value):
+        with self.lock:
+            self.sizes[name] = self.sizes.get(name, 0) + value
+
+    def as_dict(self):
+        return {"started": self.started, "stages": self.stages, "counters": self.counters, "bytes": self.sizes}
+
+    def merge(self, other):
+        # Метрики из процессов пула (JOBS) складываются с метриками основного процесса
+        with self.lock:
+            for name, stage in other["stages"].items():
+                mine = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0, "errors": 0})
+                for field in mine:
+                    mine[field] += stage[field]
+            for name, value in other["counters"].items():
+                self.count(name, value)
+            for name, value in other["bytes"].items():
+                self.add_bytes(name, value)
+
+    def prometheus_text(self, success=True):
+        lines = [
+            "# HELP aup_stage_duration_seconds Time spent in a pipeline stage during the last run.",
+            "# TYPE aup_stage_duration_seconds gauge",
+        ]
+        lines += [f'aup_stage_duration_seconds{{stage="{name}"}} {stage["seconds"]:.6f}'
+                  for name, stage in sorted(self.stages.items())]
+        lines += ["# HELP aup_stage_calls Number of times a stage ran during the last run.",
+                  "# TYPE aup_stage_calls gauge"]
+        lines += [f'aup_stage_calls{{stage="{name}"}} {stage["calls"]}' for name, stage in sorted(self.stages.items())]
+        lines += ["# HELP aup_stage_errors Number of failed stage runs during the last run.",
+                  "# TYPE aup_stage_errors gauge"]
+        lines += [f'aup_stage_errors{{stage="{name}"}} {stage["errors"]}' for name, stage in sorted(self.stages.items())]
+        lines += ["# HELP aup_items Rows and placemarks counted during the last run.", "# TYPE aup_items gauge"]
+        lines += [f'aup_items{{counter="{name}"}} {value}' for name, value in sorted(self.counters.items())]
+        lines += ["# HELP aup_bytes Size of downloaded and written files during the last run.", "# TYPE aup_bytes gauge"]
+        lines += [f'aup_bytes{{file="{name}"}} {value}' for name, value in sorted(self.sizes.items())]
+        lines += ["# HELP aup_last_run_timestamp_seconds Start time of the last run.",
+                  "# TYPE aup_last_run_timestamp_seconds gauge",
+                  f"aup_last_run_timestamp_seconds {self.started:.3f}",
+                  "# HELP aup_last_run_success 1 if the last run finished without errors.",
+                  "# TYPE aup_last_run_success gauge",
+                  f"aup_last_run_success {int(success)}"]
+        return "\n".join(lines) + "\n"
+
+    def export(self, success=True, json_path=None, prometheus_path=None):
+        json_path = METRICS_FILE if json_path is None else json_path
+        prometheus_path = PROMETHEUS_FILE if prometheus_path is None else prometheus_path
+        if LOG_FORMAT == "json":
+            log_event("metrics", success=success, **self.as_dict())
+        elif self.stages:
+            print("⏱️" + ", ".join(f"{name} {stage['seconds']:.2f} s" for name, stage in self.stages.items()))
+        # Оба файла подменяются атомарно: node_exporter не должен прочитать половину файла
+        if json_path:
+            with open_output(json_path, atomic=True) as f:
+                f.write(json.dumps(dict(self.as_dict(), success=success), indent=4).encode('utf-8'))
+        if prometheus_path:
+            with open_output(prometheus_path, atomic=True) as f:
+                f.write(self.prometheus_text(success).encode('utf-8'))
 
-# Теперь используем переменные из словаря config
-IS_ONLINE = config["IS_ONLINE"]
-HTML_FILE = config["HTML_FILE"]
-INPUT_KML = config["INPUT_KML"]
-OUTPUT_KML = config["OUTPUT_KML"]
-KML_NS = config["KML_NS"]
-FULL_COPY = config["FULL_COPY"]
-TRACEBACK_FILE = config["TRACEBACK_FILE"]
-BAN_WORDS = config["BAN_WORDS"]
 
+METRICS = Metrics()
 
-def download_page():
-    with sync_playwright() as p:
+
+EAUP_PORTAL_URL = 'https://www.public.nm.eurocontrol.int/PUBPORTAL/gateway/spec/'
+RELEASE_TIME_RE = re.compile(r'(\d{2}/\d{2}/\d{4} \d{2}:\d{2})')
+RELEASE_KIND_RE = re.compile(r'(?<![A-Za-z])(E?[AU]UP)(?![A-Za-z])', flags=re.IGNORECASE)
+
+_RELEASES_READY_JS = r"() => /\d{2}\/\d{2}\/\d{4} \d{2}:\d{2}/.test(document.body.innerText)"
+
+# Один запрос к DOM: все тексты вида "dd/mm/YYYY HH:MM" вместе со строкой таблицы и ссылкой
+_RELEASE_LINKS_JS = r"""
+() => {
+    const pattern = /\d{2}\/\d{2}\/\d{4} \d{2}:\d{2}/;
+    const found = [];
+    const walker = document.createTreeWalker(document.body, NodeFilter.SHOW_TEXT);
+    while (walker.nextNode()) {
+        const node = walker.currentNode;
+        if (!pattern.test(node.textContent)) continue;
+        const element = node.parentElement;
+        const row = element.closest('tr, li') || element.parentElement;
+        const link = element.closest('a');
+        found.push({text: node.textContent, context: row ? row.textContent : '', href: link ? link.href : null});
+    }
+    return found;
+}
+"""
+
+
+def parse_eaup_releases(entries):
+    # entries: [{"text": ..., "context": ..., "href": ...}] -> выпуски AUP/UUP, самые новые первыми
+    releases = {}
+    for entry in entries:
+        time_match = RELEASE_TIME_RE.search(entry.get("text") or "")
+        if not time_match:
+            continue
+        label = time_match.group(1)
+        kind_match = RELEASE_KIND_RE.search(entry.get("context") or "")
+        kind = kind_match.group(1).upper().lstrip('E') if kind_match else ""
+        if (label, kind) in releases:
+            continue
+        releases[(label, kind)] = {
+            "label": label,
+            "time": datetime.strptime(label, '%d/%m/%Y %H:%M').replace(tzinfo=timezone.utc),
+            "kind": kind,
+            "href": entry.get("href"),
+        }
+    # С одной меткой первыми идут выпуски со ссылкой (не заголовок страницы) и UUP, который заменяет AUP
+    return sorted(releases.values(), reverse=True,
+                  key=lambda release: (release["time"], release["href"] is not None, release["kind"] == "UUP"))
+
+
+def select_eaup_release(releases, wanted=None, now=None):
+    # Выбираем запрошенный выпуск или самый свежий за последние 24 часа
+    if wanted:
+        for release in releases:
+            if release["label"] == wanted:
+                return release
+        raise RuntimeError(f"EU table '{wanted}' is not available on the portal.")
+    if now is None:
+        now = datetime.now(timezone.utc)
+    for release in releases:
+        if now - timedelta(hours=24) <= release["time"] <= now:
+            return release
+    raise RuntimeError(
+        "Failed to find a downloadable EU table for the last 24 hours. "
+        "The page format or availability may have changed."
+    )
+
+
+def print_eaup_releases(releases):
+    print('📋Available EU tables:')
+    for release in releases:
+        print('', release["label"], release["kind"] or "-", sep='\t')
+
+
+def _probing_labels():
+    # Возможные метки выпусков за последние 24 часа с шагом 30 минут, самые новые первыми
+    # (так же подбирается адрес таблицы по HTTP_TABLE_URL в HttpEaupFetcher)
+    now_utc = datetime.now(timezone.utc)
+    floored_minute = (now_utc.minute // 30) * 30
+    start_time = now_utc.replace(minute=floored_minute, second=0, microsecond=0)
+    for trying_time in range(49):
+        candidate_time = start_time - timedelta(minutes=30 * trying_time)
+        yield candidate_time.strftime('%d/%m/%Y %H:%M')
+
+
+def _open_table_by_probing(page, context):
+    # Перебираем возможные варианты времени, что бы перейти по ссылке, (каждая попытка +- 2 сек)
+    for need_page in _probing_labels():
+        METRICS.count("table_selection_attempts")
+        try:
+            # Ожидаем появление новой вкладки (page) после клика
+            with context.expect_page() as new_page_info:
+                # Кликаем по ссылке
+                page.get_by_text(need_page).click(timeout=2000)
+                print(f"⬇️Downloading EU table: {need_page}")
+            return need_page, new_page_info.value
+        except playwright_sync.TimeoutError:
+            print(f"❌Dont have EU table: '{need_page}'")
+
+    raise RuntimeError(
+        "Failed to find a downloadable EU table for the last 24 hours. "
+        "The page format or availability may have changed."
+    )
+
+
+def discover_eaup_releases(page):
+    # Ждём, пока портал отрисует список таблиц, и забираем все ссылки за один запрос
+    page.wait_for_function(_RELEASES_READY_JS, timeout=30000)
+    return parse_eaup_releases(page.evaluate(_RELEASE_LINKS_JS))
+
+
+def _open_release(page, context, release):
+    # Переходим по найденной ссылке: та же метка может быть у AUP и UUP или в заголовке страницы,
+    # клик по тексту открыл бы первую из них. Клик — только если ссылки нет
+    print(f"⬇️Downloading EU table: {release['label']} {release['kind']}".rstrip())
+    if release["href"] and release["href"].startswith(("http://", "https://")):
+        target_page = context.new_page()
+        target_page.goto(release["href"])
+        return target_page
+    with context.expect_page() as new_page_info:
+        page.get_by_text(release["label"]).first.click()
+    return new_page_info.value
+
+
+def _open_table_by_discovery(page, context, wanted=None):
+    METRICS.count("table_selection_attempts")
+    releases = discover_eaup_releases(page)
+    print_eaup_releases(releases)
+    release = select_eaup_release(releases, wanted)
+    return release["label"], _open_release(page, context, release)
+
+
+def download_page(url=EAUP_PORTAL_URL, release=None):
+    release_label, html_code = fetch_page(url, release)
+    save_html_table(html_code)
+    return release_label
+
+
+def fetch_page(url=EAUP_PORTAL_URL, release=None):
+    # Возвращает (метка выпуска, HTML) без записи на диск
+    with playwright_sync.sync_playwright() as p:
         browser = p.chromium.launch(headless=True)
         context = browser.new_context()
         page = context.new_page()
 
-        page.goto('https://www.public.nm.eurocontrol.int/PUBPORTAL/gateway/spec/')
+        with METRICS.stage("portal_load"):
+            page.goto(url)
 
-        # Перебираем возможные варианты времени, что бы перейти по ссылке, (каждая попытка +- 2 сек)
-        flag = False
-        now_utc = datetime.now(timezone.utc)
-        floored_minute = (now_utc.minute // 30) * 30
-        start_time = now_utc.replace(minute=floored_minute, second=0, microsecond=0)
-        for trying_time in range(49):
-            candidate_time = start_time - timedelta(minutes=30 * trying_time)
-            need_page = candidate_time.strftime('%d/%m/%Y %H:%M')
-            try:
-                # Ожидаем появление новой вкладки (page) после клика
-                with context.expect_page() as new_page_info:
-                    # Кликаем по ссылке
-                    page.get_by_text(need_page).click(timeout=2000)
-                    print(f"⬇️Downloading EU table: {need_page}")
-                    flag = True
-                    break
-            except PlaywrightTimeoutError:
-                print(f"❌Dont have EU table: '{need_page}'")
-
-        if not flag:
-            raise RuntimeError(
-                "Failed to find a downloadable EU table for the last 24 hours. "
-                "The page format or availability may have changed."
-            )
-        # Это и есть та самая страница, которая открылась
-        target_page = new_page_info.value
+        with METRICS.stage("table_selection"):
+            if LINK_DISCOVERY:
+                # Это и есть та самая страница, которая открылась
+                release_label, target_page = _open_table_by_discovery(page, context, release or EAUP_RELEASE)
+            else:
+                release_label, target_page = _open_table_by_probing(page, context)
 
         # Ждем, пока JS отрисует таблицу (networkidle — нет запросов в течение 0.5 сек)
-        target_page.wait_for_load_state("networkidle")
+        with METRICS.stage("networkidle_wait"):
+            target_page.wait_for_load_state("networkidle")
 
-        # Получаем чистый HTML и сохраняем в файл
+        # Получаем чистый HTML
         html_code = target_page.content()
-        with open(HTML_FILE, "w", encoding="utf-8") as f:
-            f.write(html_code)
-
-        print(f"✅Table successfully saved in '{HTML_FILE}'")
+        METRICS.add_bytes("html_table", len(html_code.encode('utf-8')))
         browser.close()
+    return release_label, html_code
 
-def process_ge_pro_kml(input_path, output_path, folders_to_copy, regions_dict):
-    parser = etree.XMLParser(remove_blank_text=True, recover=True)
-    tree = etree.parse(input_path, parser)
-    root = tree.getroot()
 
-    #Изменение имени файла
-    doc_name = root.find(f".//{{{KML_NS}}}Document/{{{KML_NS}}}name")
-    doc_name.text = output_path.replace(".kml", '').strip()
+def save_html_table(html_code):
+    with open(HTML_FILE, "w", encoding="utf-8") as f:
+        f.write(html_code)
+    print(f"✅Table successfully saved in '{HTML_FILE}'")
+
+
+class BrowserEaupFetcher:
+    # Тёплый браузер для режима наблюдения: Chromium запускается один раз,
+    # при каждом опросе портал только перезагружается
+    def __init__(self, url=EAUP_PORTAL_URL):
+        self.url = url
+        self.playwright = playwright_sync.sync_playwright().start()
+        self.browser = self.playwright.chromium.launch(headless=True)
+        self.context = self.browser.new_context()
+        self.page = self.context.new_page()
+
+    def releases(self):
+        self.page.goto(self.url)
+        return discover_eaup_releases(self.page)
+
+    def fetch(self, release):
+        target_page = _open_release(self.page, self.context, release)
+        try:
+            target_page.wait_for_load_state("networkidle")
+            return target_page.content()
+        finally:
+            target_page.close()
+
+    def close(self):
+        self.browser.close()
+        self.playwright.stop()
+
+
+class HttpEaupFetcher:
+    # Загрузка списка выпусков и таблицы AUP/UUP обычными HTTP запросами, без браузера.
+    # Соединения держатся открытыми и переиспользуются для всех запросов к одному хосту
+    def __init__(self, releases_url=None, table_url=None, timeout=30):
+        self.releases_url = releases_url if releases_url is not None else HTTP_RELEASES_URL
+        self.table_url = table_url if table_url is not None else HTTP_TABLE_URL
+        self.timeout = timeout
+        self.connections = {}
+        self.probed = None  # (выпуск, HTML), найденный перебором в releases
+
+    def _connection(self, scheme, netloc):
+        key = (scheme, netloc)
+        if key not in self.connections:
+            connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+            self.connections[key] = connection_class(netloc, timeout=self.timeout)
+        return self.connections[key]
+
+    def get(self, url, redirects=5):
+        parts = urllib.parse.urlsplit(url)
+        path = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        headers = {"User-Agent": HTTP_USER_AGENT, "Accept": "text/html,application/xhtml+xml,*/*"}
+        for attempt in range(2):
+            connection = self._connection(parts.scheme, parts.netloc)
+            try:
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # Сервер закрыл keep-alive соединение, открываем заново
+                connection.close()
+                del self.connections[(parts.scheme, parts.netloc)]
+                if attempt:
+                    raise
+        METRICS.count("http_requests")
+        METRICS.add_bytes("http_download", len(body))
+        if response.status in (301, 302, 303, 307, 308) and redirects:
+            return self.get(urllib.parse.urljoin(url, response.getheader("Location")), redirects - 1)
+        if response.status != 200:
+            raise RuntimeError(f"HTTP {response.status} for '{url}'")
+        charset = response.headers.get_content_charset() or 'utf-8'
+        return body.decode(charset, errors='ignore')
+
+    def releases(self, wanted=None):
+        if self.releases_url:
+            METRICS.count("table_selection_attempts")
+            return parse_eaup_releases(_release_entries_from_html(self.get(self.releases_url), self.releases_url))
+        if not self.table_url:
+            raise RuntimeError("HTTP backend needs HTTP_RELEASES_URL or HTTP_TABLE_URL.")
+        return [self._probe(wanted)]
+
+    def _probe(self, wanted=None):
+        # Списка выпусков в статичном HTML портала нет (его рисует JavaScript), поэтому адрес таблицы
+        # подбирается по шаблону HTTP_TABLE_URL, как клики в _open_table_by_probing: метки с шагом 30 минут,
+        # для каждой UUP и AUP. Выпуск есть, если сервер отдал страницу с таблицей
+        kinds = ("UUP", "AUP") if "{kind" in self.table_url else ("",)
+        for label in [wanted] if wanted else _probing_labels():
+            for kind in kinds:
+                METRICS.count("table_selection_attempts")
+                release = {
+                    "label": label,
+                    "time": datetime.strptime(label, '%d/%m/%Y %H:%M').replace(tzinfo=timezone.utc),
+                    "kind": kind,
+                    "href": None,
+                }
+                try:
+                    html = self.get(self.table_url.format(time=release["time"], kind=kind))
+                except RuntimeError:
+                    continue
+                if "<table" in html.lower():
+                    self.probed = (release, html)
+                    return release
+            print(f"❌Dont have EU table: '{label}'")
+        if wanted:
+            raise RuntimeError(f"EU table '{wanted}' is not available on the portal.")
+        raise RuntimeError(
+            "Failed to find a downloadable EU table for the last 24 hours. "
+            "The page format or availability may have changed."
+        )
+
+    def fetch(self, release):
+        if self.probed and self.probed[0] is release:
+            html, self.probed = self.probed[1], None
+            return html
+        if self.table_url:
+            url = self.table_url.format(time=release["time"], kind=release["kind"])
+        elif release["href"]:
+            url = release["href"]
+        else:
+            raise RuntimeError(f"EU table '{release['label']}' has no link to download.")
+        return self.get(url)
+
+    def close(self):
+        for connection in self.connections.values():
+            connection.close()
+        self.connections.clear()
+
+
+def _release_entries_from_html(html, base_url):
+    # То же, что _RELEASE_LINKS_JS, но по статичному HTML через lxml
+    root = etree.fromstring(html.encode('utf-8'), etree.HTMLParser(encoding='utf-8'))
+    entries = []
+    if root is None:
+        return entries
+    for element in root.iter():
+        if not isinstance(element.tag, str):
+            continue
+        for text, owner in ((element.text, element), (element.tail, element.getparent())):
+            if not text or owner is None or not RELEASE_TIME_RE.search(text):
+                continue
+            row = owner if owner.tag in ('tr', 'li') else next(owner.iterancestors('tr', 'li'), None)
+            if row is None:
+                row = owner.getparent() if owner.getparent() is not None else owner
+            link = owner if owner.tag == 'a' else next(owner.iterancestors('a'), None)
+            href = link.get('href') if link is not None else None
+            entries.append({
+                "text": text,
+                "context": "".join(row.itertext()),
+                "href": urllib.parse.urljoin(base_url, href) if href else None,
+            })
+    return entries
+
+
+def download_table_http(release=None, fetcher=None):
+    release_label, html_code = fetch_table_http(release, fetcher)
+    save_html_table(html_code)
+    return release_label
+
+
+def fetch_table_http(release=None, fetcher=None):
+    # Возвращает (метка выпуска, HTML) без записи на диск
+    own_fetcher = fetcher is None
+    if own_fetcher:
+        fetcher = HttpEaupFetcher()
+    try:
+        with METRICS.stage("table_selection"):
+            releases = fetcher.releases(release or EAUP_RELEASE)
+            print_eaup_releases(releases)
+            chosen = select_eaup_release(releases, release or EAUP_RELEASE)
+        print(f"⬇️Downloading EU table over HTTP: {chosen['label']} {chosen['kind']}".rstrip())
+        with METRICS.stage("table_download"):
+            html_code = fetcher.fetch(chosen)
+    finally:
+        if own_fetcher:
+            fetcher.close()
+    METRICS.add_bytes("html_table", len(html_code.encode('utf-8')))
+    return chosen["label"], html_code
+
+
+def use_http_backend():
+    # Список выпусков портал рисует JavaScript, в статичном HTML его нет, поэтому без браузера нужна
+    # страница со списком выпусков (HTTP_RELEASES_URL) или шаблон адреса таблицы с {time:...} для перебора
+    if FETCH_BACKEND != "http":
+        return False
+    if HTTP_RELEASES_URL or (HTTP_TABLE_URL and "{time" in HTTP_TABLE_URL):
+        return True
+    print("⚠️FETCH_BACKEND 'http' needs HTTP_RELEASES_URL or HTTP_TABLE_URL with a {time:...} placeholder, "
+          "using browser")
+    return False
+
+
+def fetch_eaup_table(release=None):
+    # HTTP без браузера, если не получилось — прежний путь через playwright
+    # Возвращает метку скачанного выпуска "dd/mm/YYYY HH:MM"
+    with METRICS.stage("download"):
+        if use_http_backend():
+            try:
+                return download_table_http(release)
+            except (OSError, RuntimeError, ValueError, http.client.HTTPException) as e:
+                METRICS.count("http_fallbacks")
+                print(f"❌HTTP download failed ({e}), trying browser")
+        return download_page(release=release)
+
+
+async def fetch_eaup_table_async(release=None):
+    # Как fetch_eaup_table, но возвращает (метка выпуска, HTML) и не блокирует цикл событий
+    with METRICS.stage("download"):
+        if use_http_backend():
+            try:
+                return await asyncio.to_thread(fetch_table_http, release)
+            except (OSError, RuntimeError, ValueError, http.client.HTTPException) as e:
+                METRICS.count("http_fallbacks")
+                print(f"❌HTTP download failed ({e}), trying browser")
+        # Sync API playwright работает в потоке: в потоке нет своего цикла событий
+        return await asyncio.to_thread(fetch_page, release=release)
+
+
+def normalize_placemark_name(kml_name, ban_words=None):
+    # Нормализация имени KML для сравнения со словарем: LP-D10 -> d10
+    # Возвращает None, если после удаления BAN_WORDS ничего не осталось
+    if ban_words is None:
+        ban_words = BAN_WORDS
+    pm_name_normalized = kml_name.strip().lower()
+    for ban in ban_words:
+        pm_name_normalized = pm_name_normalized.replace(ban, '')
+    normalized_parts = pm_name_normalized.strip().split()
+    if not normalized_parts:
+        return None
+    return normalized_parts[0]
+
 
+def _find_top_folders(root):
     # Поиск Document — главного контейнера Google Earth
     document = root.find("{{{}}}Document".format(KML_NS))
     if document is None:
         document = root
-
     # Находим все папки верхнего уровня
-    folders = document.findall("{{{}}}Folder".format(KML_NS))
+    return document, document.findall("{{{}}}Folder".format(KML_NS))
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@contextlib.contextmanager
+def open_output(output_path, atomic=False):
+    # atomic=True: пишем во временный файл рядом и подменяем результат одним os.replace,
+    # чтобы Google Earth никогда не увидел недописанный файл
+    if not atomic:
+        with open(output_path, 'wb') as f:
+            yield f
+        return
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def is_kmz(path):
+    return path.lower().endswith(".kmz")
+
+
+def _kmz_main_entry(archive):
+    # По спецификации KMZ главный документ — первый .kml в корне архива (обычно doc.kml)
+    names = [name for name in archive.namelist() if name.lower().endswith(".kml")]
+    root_names = [name for name in names if "/" not in name]
+    if not names:
+        raise ValueError(f"KMZ '{archive.filename}' has no .kml document inside")
+    return (root_names or names)[0]
+
+
+@contextlib.contextmanager
+def open_kml_input(input_path):
+    # Источник для etree.parse/iterparse: путь к .kml или doc.kml, читаемый прямо из .kmz без распаковки
+    if not is_kmz(input_path):
+        yield input_path
+        return
+    with zipfile.ZipFile(input_path) as archive:
+        with archive.open(_kmz_main_entry(archive)) as f:
+            yield f
+
+
+@contextlib.contextmanager
+def open_kml_output(output_path, atomic=False, resources=None):
+    # .kmz: doc.kml сжимается на лету прямо в архив, без промежуточного буфера.
+    # resources {имя в архиве: источник} заполняется во время записи и дописывается после doc.kml
+    with open_output(output_path, atomic) as f:
+        if not is_kmz(output_path):
+            yield f
+            return
+        with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as archive:
+            with archive.open("doc.kml", 'w') as doc:
+                yield doc
+            for arcname, source in (resources or {}).items():
+                if isinstance(source, tuple):
+                    kmz_path, member = source
+                    with zipfile.ZipFile(kmz_path) as source_archive:
+                        archive.writestr(arcname, source_archive.read(member))
+                else:
+                    archive.write(source, arcname)
+
+
+def kml_resources(input_path, hrefs):
+    # Локальные файлы, на которые ссылается KML (иконки стилей, оверлеи): имя в архиве -> источник.
+    # Ссылки http(s) и абсолютные пути остаются как есть
+    members = set()
+    if is_kmz(input_path):
+        with zipfile.ZipFile(input_path) as archive:
+            members = set(archive.namelist())
+    base_dir = os.path.dirname(os.path.abspath(input_path))
+    resources = {}
+    for href in sorted(set(hrefs)):
+        parts = urllib.parse.urlsplit(href.strip())
+        if parts.scheme or parts.netloc or not parts.path or parts.path.startswith("/"):
+            continue
+        arcname = posixpath.normpath(urllib.parse.unquote(parts.path).replace("\\", "/"))
+        if arcname.startswith("../") or arcname in resources:
+            continue
+        if arcname in members:
+            resources[arcname] = (input_path, arcname)
+        elif os.path.isfile(os.path.join(base_dir, arcname)):
+            resources[arcname] = os.path.join(base_dir, arcname)
+        else:
+            print(f"\033[31mResource '{href}' didn't found\033[0m, it won't be packed into KMZ")
+    return resources
+
+
+def _document_name(output_path):
+    return output_path.replace(".kmz", '').replace(".kml", '').strip()
+
+
+def _file_size(path):
+    # Для метрик: отсутствие файла не ошибка, просто размер неизвестен
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+# Версия формата индекса: индекс старого формата пересобирается
+NAME_INDEX_VERSION = 3
+
+
+def name_index_path(input_path):
+    return f"{input_path}.index.json"
+
 
+def build_name_index(input_path, ban_words=None, root=None):
+    # Индекс имён: для каждой папки верхнего уровня
+    # нормализованное имя -> позиции Placemark внутри папки, и скомпилированные шаблоны описаний
+    if ban_words is None:
+        ban_words = BAN_WORDS
+    if root is None:
+        parser = etree.XMLParser(remove_blank_text=True, recover=True)
+        with open_kml_input(input_path) as source:
+            root = etree.parse(source, parser).getroot()
+    _, folders = _find_top_folders(root)
+
+    index_folders = []
     for folder in folders:
         name_node = folder.find("{{{}}}name".format(KML_NS))
-        folder_name = name_node.text if name_node is not None else "Unnamed Folder"
+        keys = {}
+        templates = {}
+        # Placemark без имени исходный алгоритм не трогает, запоминаем их отдельно
+        unnamed = []
+        placemarks = folder.findall("{{{}}}Placemark".format(KML_NS))
+        for position, pm in enumerate(placemarks):
+            pm_name_node = pm.find('{{{}}}name'.format(KML_NS))
+            if pm_name_node is None or not pm_name_node.text:
+                unnamed.append(position)
+                continue
+            desc_node = pm.find('{{{}}}description'.format(KML_NS))
+            if desc_node is not None:
+                templates[str(position)] = compile_description_template(desc_node.text)
+            key = normalize_placemark_name(pm_name_node.text, ban_words)
+            if key is not None:
+                keys.setdefault(key, []).append(position)
+        index_folders.append({
+            "name": name_node.text if name_node is not None else "Unnamed Folder",
+            "placemarks": len(placemarks),
+            "unnamed": unnamed,
+            "keys": keys,
+            # позиция -> шаблон для str.format, null — описание без шаблона
+            "templates": templates,
+        })
 
-        if folder_name in folders_to_copy:
-            print(f"📦 Full coping folder: {folder_name}")
-            # Ничего не делаем, она остается в дереве со всем содержимым
-        else:
-            print(f"🔧 Processing folder contents: {folder_name}")
-            # ПРИМЕР ОБРАБОТКИ: Удаляем всё, кроме Placemark с конкретным стилем
-            # или просто удаляем папку, если она не нужна
-
-            # Если нужно удалить папку целиком:
-            # document.remove(folder)
-
-            # Если нужно отфильтровать метки внутри этой папки:
-            placemarks = folder.findall("{{{}}}Placemark".format(KML_NS))
-            sorted_pm_count = 0
-
-            found_in_kml = set()
-
-            for pm in placemarks:
-                # **Исправленный синтаксис lxml для поиска имени в рамках KML_NS**
-                name_node = pm.find('{{{}}}name'.format(KML_NS))
-
-                if name_node is not None and name_node.text:
-                    kml_name = name_node.text.strip()
-                    # Нормализация имени KML для сравнения со словарем: LP-D10 -> d10
-                    pm_name_normalized = kml_name.lower()
-                    for ban in BAN_WORDS:
-                        pm_name_normalized = pm_name_normalized.replace(ban, '')
-                    normalized_parts = pm_name_normalized.strip().split()
-                    if not normalized_parts:
-                        folder.remove(pm)
-                        continue
-                    pm_name_normalized = normalized_parts[0]
-
-                    if pm_name_normalized in regions_dict:
-                        # подсчитывает кол-во оставшихся регионов
-                        sorted_pm_count += 1
-
-                        if pm_name_normalized not in found_in_kml:
-                            found_in_kml.add(pm_name_normalized)
-
-                        # 1. Обновляем описание (используя исправленный синтаксис)
-                        data_list = regions_dict[pm_name_normalized]
-                        description_html = "\n".join(data_list)
-                        altitudes = ', '.join([i.split('|')[1] for i in data_list])
-                        active_time = ', '.join([i.split('|')[0] for i in data_list])
-
-                        desc_node = pm.find('{{{}}}description'.format(KML_NS))
-                        if desc_node is None:
-                            # Если description нет, создаем новый элемент с правильным NS
-                            desc_node = etree.SubElement(pm, '{{{}}}description'.format(KML_NS))
-                        else:
-                            if str(desc_node.text).find('XXXXft AGL/FLXXX') == -1 or str(desc_node.text).find('XX:XX-XX:XX') == -1:
-                                print(f'''\033[31mERROR. please check the format of the description {pm_name_normalized}\033[0m
-altitude must have XXXXft AGL/FLXXX
-time must have XX:XX-XX:XX''')
-                                sys.exit(1)
-                            description_html = str(desc_node.text).replace('XXXXft AGL/FLXXX', altitudes)
-                            description_html = description_html.replace('XX:XX-XX:XX', active_time)
-                        desc_node.text = etree.CDATA(description_html)
-
-                        # 2. Принудительный инлайновый красный стиль
-                        # old_style_url = pm.find('{{{}}}styleUrl'.format(KML_NS))
-                        # if old_style_url is not None:
-                        #     pm.remove(old_style_url)
-
-                        # Создание новых элементов также требует правильного синтаксиса NS
-                        # colors = {'red': "ff2a00", 'blue': '0015ff', 'orange': 'FF8C00', 'black': '000000'}
-                        # style = etree.SubElement(pm, '{{{}}}Style'.format(KML_NS))
-                        # poly_style = etree.SubElement(style, '{{{}}}PolyStyle'.format(KML_NS))
-                        # color = etree.SubElement(poly_style, '{{{}}}color'.format(KML_NS))
-                        # color.text = "7f0000ff"
-                        # outline = etree.SubElement(poly_style, '{{{}}}outline'.format(KML_NS))
-                        # outline.text = "1"
-                        # line_style = etree.SubElement(style, '{{{}}}LineStyle'.format(KML_NS))
-                        # l_color = etree.SubElement(line_style, '{{{}}}color'.format(KML_NS))
-                        # l_color.text = "ff0000ff"
-                        # l_width = etree.SubElement(line_style, '{{{}}}width'.format(KML_NS))
-                        # l_width.text = "2"
-                    else:
-                        folder.remove(pm)
-            print(f'\tNumber of processed placemarks: {sorted_pm_count}')
-
-    # Сохранение с корректным объявлением XML для Google Earth
-    with open(output_path, 'wb') as f:
-        f.write(etree.tostring(tree,
-                               pretty_print=True,
-                               xml_declaration=True,
-                               encoding='utf-8'))
-
-def parse_eaup_htm(file_path):
-    # (Ваша функция parse_eaup_html остается без изменений)
-    if not os.path.exists(file_path):
-        raise FileNotFoundError(file_path)
-    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-        soup = BeautifulSoup(f, 'html.parser')
-    rows = soup.find_all('tr')
-    seen_records = set()
-    parsed_lp_regions = dict()
+    placemark_ranges = _placemark_ranges(_read_kml_bytes(input_path))
+    if placemark_ranges is not None and [len(ranges) for ranges in placemark_ranges] != \
+            [folder["placemarks"] for folder in index_folders]:
+        placemark_ranges = None
+    if placemark_ranges is None:
+        print("\033[31mCan't find placemark offsets in the database\033[0m, it will be parsed in full")
 
-    def format_altitude(level, type):
-        if level == 0:
-            return 'GND'
-        if level < 50:
-            return f"{level * 100}ft {["AGL", "AMSL"][type]}"
-        return f"FL{level}"
+    return {
+        "version": NAME_INDEX_VERSION,
+        "kml_sha256": _file_sha256(input_path),
+        "kml_stamp": _file_stamp(input_path),
+        "ban_words": list(ban_words),
+        "folders": index_folders,
+        # [[начало, конец) в байтах для каждой Placemark папки] по папкам, null — без смещений
+        "placemark_ranges": placemark_ranges,
+    }
 
-    print('🔍Founded regions:')
-    for row in rows:
-        cells = row.find_all(['td', 'th'])
-        row_text = "|".join([c.get_text(strip=True) for c in cells if c.get_text(strip=True)])
-        name_match = re.search(r'\b(LP(?:-?[A-Z0-9]+)+)\b', row_text, flags=re.IGNORECASE)
-        if name_match:
-            region_name = name_match.group(1).upper()
-            if region_name == "LPA": continue
-            times = re.findall(r'\d{2}:\d{2}', row_text)
-            if len(times) > 4 or len(times) < 2: continue
-            time_str = "-".join(times[:2])
-            raw_levels = re.findall(r'\b(?:\d{3}|SFC)\b', row_text, flags=re.IGNORECASE)
-            altitudes = []
-            for val in raw_levels:
-                val = val.upper()
-                if val == 'SFC' or val == 'GND':
-                    val = 0
-                else:
-                    val = int(val)
-                altitudes.append(val)
-            clean_alts = altitudes[:2]
-            if not clean_alts:
-                alt_display = "\033[31mNot specified\033[0m"
-            elif len(clean_alts) == 1:
-                alt_display = format_altitude(clean_alts[0], 1)
-            else:
-                alt_display = f"{format_altitude(clean_alts[0], 0)}/{format_altitude(clean_alts[1], 1)}"
-            record_key = f"{region_name}|{time_str}|{alt_display}"
-            if record_key not in seen_records:
-                seen_records.add(record_key)
-                clean_region_name = region_name[2:].lower().replace('-', '').strip()
-                time_alt_string = f"{time_str}|{alt_display}"
-                print('', clean_region_name+' ', time_alt_string, sep='\t')
-                if clean_region_name in parsed_lp_regions:
-                    parsed_lp_regions[clean_region_name].append(time_alt_string)
-                else:
-                    parsed_lp_regions[clean_region_name] = [time_alt_string]
-    return parsed_lp_regions
 
+def _file_stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
 
-if __name__ == "__main__":
+
+def _read_kml_bytes(input_path):
+    with open_kml_input(input_path) as source:
+        if isinstance(source, str):
+            with open(source, 'rb') as f:
+                return f.read()
+        return source.read()
+
+
+def _placemark_ranges(data):
+    # Байтовые границы Placemark — прямых потомков папок верхнего уровня, как в _find_top_folders.
+    # lxml смещений не даёт, expat даёт. None, если expat не разобрал файл (lxml читает с recover=True)
+    document_tag, folder_tag, placemark_tag = (f"{KML_NS}}}{name}" for name in ("Document", "Folder", "Placemark"))
+    parser = expat.ParserCreate(namespace_separator="}")
+    stack = []  # (тег, роль): "document", "root_folder", "document_folder", "placemark" или None
+    ranges = {"root_folder": [], "document_folder": []}
+    seen_document = False
+
+    def start(name, attributes):
+        nonlocal seen_document
+        parent_role = stack[-1][1] if stack else None
+        role = None
+        if len(stack) == 1 and name == document_tag and not seen_document:
+            seen_document = True
+            role = "document"
+        elif name == folder_tag and (len(stack) == 1 or parent_role == "document"):
+            role = "root_folder" if len(stack) == 1 else "document_folder"
+            ranges[role].append([])
+        elif name == placemark_tag and parent_role in ranges:
+            role = "placemark"
+            ranges[parent_role][-1].append([parser.CurrentByteIndex, None])
+        stack.append((name, role))
+
+    def end(name):
+        _, role = stack.pop()
+        if role == "placemark":
+            position = parser.CurrentByteIndex
+            # Для <Placemark/> конец — "/>" открывающего тега, иначе ">" закрывающего
+            if data.startswith(b"</", position):
+                finish = data.index(b">", position) + 1
+            else:
+                finish = data.index(b"/>", position) + 2
+            ranges[stack[-1][1]][-1][-1][1] = finish
+
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
     try:
-        if IS_ONLINE:
-            download_page()
-        print(f"🔧Start parsing '{HTML_FILE}'...")
+        parser.Parse(data, True)
+    except (expat.ExpatError, ValueError):
+        return None
+    return ranges["document_folder"] if seen_document else ranges["root_folder"]
+
+
+def parse_indexed_database(input_path, name_index, regions_dict, folders_to_copy):
+    # Разбор без неактивных меток: их байты вырезаются по смещениям индекса до разбора, lxml их не видит.
+    # Остаются безымянные, активные и метки с неверным шаблоном (для отчёта). Возвращает дерево и индекс
+    # с позициями меток уже в этом дереве
+    data = _read_kml_bytes(input_path)
+    pieces = []
+    cursor = 0
+    reduced_folders = []
+    skipped = 0
+    for folder_index, ranges in zip(name_index["folders"], name_index["placemark_ranges"]):
+        if folder_index["name"] in folders_to_copy:
+            reduced_folders.append(folder_index)
+            continue
+        kept = set(folder_index["unnamed"])
+        kept.update(int(position) for position, template in folder_index["templates"].items() if template is None)
+        for key in regions_dict:
+            kept.update(folder_index["keys"].get(key, ()))
+        new_positions = {position: number for number, position in enumerate(sorted(kept))}
+        for position, (start, end) in enumerate(ranges):
+            if position not in new_positions:
+                # Отступ перед меткой тоже вырезается: длинные пробельные куски remove_blank_text не убирает
+                pieces.append(data[cursor:start].rstrip())
+                cursor = end
+                skipped += 1
+        keys = {}
+        for key, positions in folder_index["keys"].items():
+            positions = [new_positions[position] for position in positions if position in new_positions]
+            if positions:
+                keys[key] = positions
+        reduced_folders.append(dict(
+            folder_index,
+            placemarks=len(kept),
+            unnamed=[new_positions[position] for position in folder_index["unnamed"]],
+            keys=keys,
+            templates={str(new_positions[int(position)]): template
+                       for position, template in folder_index["templates"].items()
+                       if int(position) in new_positions},
+        ))
+    pieces.append(data[cursor:])
+    METRICS.count("placemarks_not_parsed", skipped)
+    METRICS.count("placemarks_removed", skipped)
+    parser = etree.XMLParser(remove_blank_text=True, recover=True)
+    root = etree.fromstring(b"".join(pieces), parser)
+    return root.getroottree(), dict(name_index, folders=reduced_folders, placemark_ranges=None)
+
+
+def load_name_index(input_path, ban_words=None, root=None):
+    # Индекс хранится рядом с базой и пересобирается, если изменился KML или BAN_WORDS.
+    # Размер и время изменения совпали — база та же, без чтения; иначе сверяется sha256.
+    # root — уже разобранная база, чтобы не читать её второй раз
+    if ban_words is None:
+        ban_words = BAN_WORDS
+    index_path = name_index_path(input_path)
+    kml_stamp = _file_stamp(input_path)
+    if os.path.exists(index_path):
         try:
-            lp_regions = parse_eaup_htm(HTML_FILE)
-        except FileNotFoundError:
-            print(f"File '{HTML_FILE}' didn't found, check the file name with database, it must be called '{HTML_FILE}'")
-            exit(1)
-
-        if lp_regions:
-            print(f"🔍Founded {len(lp_regions)} active regions in European AUP/UUP.")
-            process_ge_pro_kml(INPUT_KML, OUTPUT_KML, FULL_COPY, lp_regions)
-            print(f"✅Saved in '{OUTPUT_KML}'.")
-        else:
-            print("\033[31mRegions for update didn't found, KML didn't created, try later")
-        print("\n\033[32mProcess finished\033[0m, without errors.")
-    except Exception:
-        tb = traceback.format_exc()
-        print(f"\n\033[31mAn unexpected error occurred\033[0m. Traceback written to '{TRACEBACK_FILE}'.")
-        with open(TRACEBACK_FILE, 'w', encoding='utf-8') as f:
-            f.write(tb)
-        print(tb, file=sys.stderr)
+            with open(index_path, "r", encoding="utf-8") as f:
+                name_index = json.load(f)
+            if name_index.get("version") == NAME_INDEX_VERSION and name_index.get("ban_words") == list(ban_words):
+                if name_index.get("kml_stamp") == kml_stamp:
+                    return name_index
+                if name_index.get("kml_sha256") == _file_sha256(input_path):
+                    name_index["kml_stamp"] = kml_stamp
+                    with open(index_path, "w", encoding="utf-8") as f:
+                        json.dump(name_index, f, ensure_ascii=False)
+                    return name_index
+        except (OSError, ValueError):
+            pass
+
+    print(f"📇Building placemark name index for '{input_path}'...")
+    name_index = build_name_index(input_path, ban_words, root)
+    try:
+        with open(index_path, "w", encoding="utf-8") as f:
+            json.dump(name_index, f, ensure_ascii=False)
+    except OSError:
+        print(f"\033[31mCan't save name index '{index_path}'\033[0m, continue without cache")
+    return name_index
+
+
+TEMPLATE_ALTITUDES = 'XXXXft AGL/FLXXX'
+TEMPLATE_TIME = 'XX:XX-XX:XX'
+TEMPLATE_ERROR_POLICIES = ("abort", "skip")
+
+
+@functools.lru_cache(maxsize=16384)
+def compile_description_template(text):
+    # Описание -> строка для str.format с полями {altitudes} и {active_time};
+    # None, если в описании нет одного из шаблонов
+    text = str(text)
+    if TEMPLATE_ALTITUDES not in text or TEMPLATE_TIME not in text:
+        return None
+    text = text.replace('{', '{{').replace('}', '}}')
+    return text.replace(TEMPLATE_ALTITUDES, '{altitudes}').replace(TEMPLATE_TIME, '{active_time}')
+
+
+def folder_templates(folder, folder_index=None):
+    # Позиция именованной метки -> шаблон её описания (None — шаблон неверный), из индекса, если он есть
+    if folder_index is not None:
+        return {int(position): template for position, template in folder_index["templates"].items()}
+    templates = {}
+    for position, pm in enumerate(folder.findall("{{{}}}Placemark".format(KML_NS))):
+        pm_name_node = pm.find('{{{}}}name'.format(KML_NS))
+        desc_node = pm.find('{{{}}}description'.format(KML_NS))
+        if pm_name_node is not None and pm_name_node.text and desc_node is not None:
+            templates[position] = compile_description_template(desc_node.text)
+    return templates
+
+
+def template_error(folder_name, pm_name, regions_dict, ban_words=None):
+    return {"folder": folder_name, "name": pm_name.strip(),
+            "active": normalize_placemark_name(pm_name, ban_words) in regions_dict}
+
+
+def report_template_errors(errors, output_path):
+    # Все метки с неверным описанием одним списком. Активные либо пропускаются (skip),
+    # либо сборка останавливается до записи файла (abort)
+    if not errors:
+        return
+    if TEMPLATE_ERROR_POLICY not in TEMPLATE_ERROR_POLICIES:
+        raise ValueError(f"Unknown TEMPLATE_ERROR_POLICY '{TEMPLATE_ERROR_POLICY}', "
+                         f"use one of: {', '.join(TEMPLATE_ERROR_POLICIES)}")
+    METRICS.count("template_errors", len(errors))
+    print(f"\033[31mERROR. please check the format of the description\033[0m of {len(errors)} placemarks:")
+    for error in errors:
+        print(f"\t{error['folder']}: {error['name']}" + (" (active)" if error["active"] else ""))
+    print(f"altitude must have {TEMPLATE_ALTITUDES}\ntime must have {TEMPLATE_TIME}")
+    active = sum(1 for error in errors if error["active"])
+    if not active:
+        return
+    if TEMPLATE_ERROR_POLICY == "abort":
+        print(f"\033[31m'{output_path}' didn't created\033[0m, {active} active placemarks can't be filled")
         sys.exit(1)
-    finally:
-        # Записываю в переменную enter, чтобы избавиться от бага с необходимостью дважды нажимать enter
-        if sys.stdin.isatty():
-            input("\nPress enter to exit...")
+    METRICS.count("placemarks_skipped", active)
+    print(f"⚠️{active} active placemarks skipped, they are not in '{output_path}'")
+
+
+def _fill_placemark(pm, pm_name_normalized, data_list, template=None):
+    # 1. Обновляем описание (используя исправленный синтаксис)
+    parts = [_activation_parts(item) for item in data_list]
+    description_html = "\n".join([f"{time_part}|{alt_part}" for time_part, alt_part in parts])
+    altitudes = ', '.join([alt_part for _, alt_part in parts])
+    active_time = ', '.join([time_part for time_part, _ in parts])
+
+    desc_node = pm.find('{{{}}}description'.format(KML_NS))
+    if desc_node is None:
+        # Если description нет, создаем новый элемент с правильным NS
+        desc_node = etree.SubElement(pm, '{{{}}}description'.format(KML_NS))
+    else:
+        # Шаблоны проверяются заранее (report_template_errors), сюда неверный попасть не должен
+        template = template or compile_description_template(desc_node.text)
+        if template is None:
+            raise ValueError(f"Description of '{pm_name_normalized}' has no {TEMPLATE_ALTITUDES} or {TEMPLATE_TIME}")
+        description_html = template.format(altitudes=altitudes, active_time=active_time)
+    desc_node.text = etree.CDATA(description_html)
+
+    # 2. Принудительный инлайновый красный стиль
+    # old_style_url = pm.find('{{{}}}styleUrl'.format(KML_NS))
+    # if old_style_url is not None:
+    #     pm.remove(old_style_url)
+
+    # Создание новых элементов также требует правильного синтаксиса NS
+    # colors = {'red': "ff2a00", 'blue': '0015ff', 'orange': 'FF8C00', 'black': '000000'}
+    # style = etree.SubElement(pm, '{{{}}}Style'.format(KML_NS))
+    # poly_style = etree.SubElement(style, '{{{}}}PolyStyle'.format(KML_NS))
+    # color = etree.SubElement(poly_style, '{{{}}}color'.format(KML_NS))
+    # color.text = "7f0000ff"
+    # outline = etree.SubElement(poly_style, '{{{}}}outline'.format(KML_NS))
+    # outline.text = "1"
+    # line_style = etree.SubElement(style, '{{{}}}LineStyle'.format(KML_NS))
+    # l_color = etree.SubElement(line_style, '{{{}}}color'.format(KML_NS))
+    # l_color.text = "ff0000ff"
+    # l_width = etree.SubElement(line_style, '{{{}}}width'.format(KML_NS))
+    # l_width.text = "2"
+
+
+def _assign_folder_id(folder, folder_number):
+    # id нужны для NetworkLinkControl/Update: Create/Change/Delete ссылаются на targetId
+    if folder.get("id") is None:
+        folder.set("id", f"fua-folder-{folder_number}")
+
+
+def _assign_placemark_id(pm, folder_number, pm_name_normalized, used_ids):
+    if pm.get("id") is None:
+        base_id = f"fua-{folder_number}-" + re.sub(r'[^A-Za-z0-9_.-]', '_', pm_name_normalized)
+        pm_id = base_id
+        duplicate = 1
+        while pm_id in used_ids:
+            duplicate += 1
+            pm_id = f"{base_id}-{duplicate}"
+        pm.set("id", pm_id)
+    used_ids.add(pm.get("id"))
+
+
+def _activation_minutes(item):
+    if isinstance(item, Activation):
+        start, end = item.start, item.end
+    else:
+        start, end = (_parse_minutes(value) for value in _activation_parts(item)[0].split('-'))
+    # Интервал через полночь (22:00-02:00) заканчивается на следующие сутки
+    if end <= start:
+        end += 24 * 60
+    return start, end
+
+
+def _time_span_bounds(item, day):
+    start, end = _activation_minutes(item)
+    midnight = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+    return tuple((midnight + timedelta(minutes=minutes)).strftime('%Y-%m-%dT%H:%M:%SZ') for minutes in (start, end))
+
+
+def _add_time_span(pm, item, day):
+    begin, end = _time_span_bounds(item, day)
+    time_span = etree.Element('{{{}}}TimeSpan'.format(KML_NS))
+    etree.SubElement(time_span, '{{{}}}begin'.format(KML_NS)).text = begin
+    etree.SubElement(time_span, '{{{}}}end'.format(KML_NS)).text = end
+    # По схеме KML TimePrimitive идёт сразу после description
+    desc_node = pm.find('{{{}}}description'.format(KML_NS))
+    pm.insert(pm.index(desc_node) + 1 if desc_node is not None else len(pm), time_span)
+
+
+def _render_placemark(pm, pm_name_normalized, data_list, folder_number, used_ids, day=None, template=None):
+    # day не задан: одна метка со всеми интервалами в описании (как раньше).
+    # day задан: отдельная метка на каждый интервал со своим <TimeSpan> для ползунка времени Google Earth
+    if day is None:
+        _fill_placemark(pm, pm_name_normalized, data_list, template)
+        _assign_placemark_id(pm, folder_number, pm_name_normalized, used_ids)
+        return [pm]
+
+    rendered = []
+    for slot_number, item in enumerate(data_list, 1):
+        slot_pm = copy.deepcopy(pm)
+        _fill_placemark(slot_pm, pm_name_normalized, [item], template)
+        _add_time_span(slot_pm, item, day)
+        if pm.get("id") is not None:
+            slot_pm.set("id", f"{pm.get('id')}-{slot_number}")
+        _assign_placemark_id(slot_pm, folder_number, pm_name_normalized, used_ids)
+        rendered.append(slot_pm)
+    parent = pm.getparent()
+    if parent is not None:
+        position = parent.index(pm)
+        parent[position:position + 1] = rendered
+    return rendered
+
+
+def _filter_folder_scan(folder, regions_dict, folder_number=0, ban_words=None, day=None, templates=None,
+                        render=None):
+    # Полный проход: нормализуем имя каждой метки.
+    # templates: позиция -> шаблон описания (folder_templates), метки с неверным шаблоном пропускаются.
+    # render — что сделать с активной меткой, по умолчанию _render_placemark
+    placemarks = folder.findall("{{{}}}Placemark".format(KML_NS))
+    sorted_pm_count = 0
+    used_ids = set()
+    if templates is None:
+        templates = {}
+    if render is None:
+        render = _render_placemark
+
+    for position, pm in enumerate(placemarks):
+        # **Исправленный синтаксис lxml для поиска имени в рамках KML_NS**
+        name_node = pm.find('{{{}}}name'.format(KML_NS))
+
+        if name_node is not None and name_node.text:
+            pm_name_normalized = normalize_placemark_name(name_node.text, ban_words)
+            if pm_name_normalized is None:
+                folder.remove(pm)
+                METRICS.count("placemarks_removed")
+                continue
+
+            if pm_name_normalized in regions_dict and templates.get(position, "") is not None:
+                # подсчитывает кол-во оставшихся регионов
+                sorted_pm_count += 1
+                render(pm, pm_name_normalized, regions_dict[pm_name_normalized],
+                       folder_number, used_ids, day, templates.get(position))
+            else:
+                folder.remove(pm)
+                METRICS.count("placemarks_removed")
+    METRICS.count("placemarks_scanned", len(placemarks))
+    METRICS.count("placemarks_matched", sorted_pm_count)
+    return sorted_pm_count
+
+
+def _filter_folder_indexed(folder, folder_index, regions_dict, folder_number=0, day=None, templates=None,
+                           render=None):
+    # Проход по индексу: смотрим только активные регионы, без нормализации имён
+    placemarks = folder.findall("{{{}}}Placemark".format(KML_NS))
+    if templates is None:
+        templates = folder_templates(folder, folder_index)
+    if render is None:
+        render = _render_placemark
+    keep = dict.fromkeys(folder_index["unnamed"])
+    for pm_name_normalized in regions_dict:
+        for position in folder_index["keys"].get(pm_name_normalized, ()):
+            if templates.get(position, "") is not None:
+                keep[position] = pm_name_normalized
+
+    for position, pm in enumerate(placemarks):
+        if position not in keep:
+            folder.remove(pm)
+    METRICS.count("placemarks_scanned", len(placemarks))
+    METRICS.count("placemarks_removed", len(placemarks) - len(keep))
+    sorted_pm_count = 0
+    used_ids = set()
+    for position in sorted(keep):
+        pm_name_normalized = keep[position]
+        if pm_name_normalized is not None:
+            sorted_pm_count += 1
+            render(placemarks[position], pm_name_normalized, regions_dict[pm_name_normalized],
+                   folder_number, used_ids, day, templates.get(position))
+    METRICS.count("placemarks_matched", sorted_pm_count)
+    return sorted_pm_count
+
+
+def _style_key(style):
+    # Одинаковые определения стиля дают одинаковый c14n без учёта id
+    clone = copy.deepcopy(style)
+    clone.attrib.pop("id", None)
+    return etree.tostring(clone, method="c14n")
+
+
+def _local_style_id(url):
+    url = (url or "").strip()
+    return url[1:] if url.startswith("#") else None
+
+
+def optimize_kml_styles(root, prune=True):
+    # Одинаковые Style/StyleMap сводятся к первому, все styleUrl переписываются на него.
+    # prune=True: удаляются общие стили, на которые не ссылается ни одна оставшаяся метка/папка
+    style_tag, map_tag = "{{{}}}Style".format(KML_NS), "{{{}}}StyleMap".format(KML_NS)
+    url_tag = "{{{}}}styleUrl".format(KML_NS)
+    containers = ("{{{}}}Document".format(KML_NS), "{{{}}}Folder".format(KML_NS))
+    shared = [elem for elem in root.iter(style_tag, map_tag)
+              if elem.get("id") and elem.getparent() is not None and elem.getparent().tag in containers]
+
+    replaced = {}
+    survivors = {}
+    # Сначала Style, потом StyleMap: ссылки внутри StyleMap уже переписаны, и одинаковые пары совпадут
+    for tag in (style_tag, map_tag):
+        for elem in shared:
+            if elem.tag != tag:
+                continue
+            for url_node in elem.iter(url_tag):
+                style_id = _local_style_id(url_node.text)
+                if style_id in replaced:
+                    url_node.text = "#" + replaced[style_id]
+            key = _style_key(elem)
+            if key in survivors:
+                replaced[elem.get("id")] = survivors[key]
+                elem.getparent().remove(elem)
+            else:
+                survivors[key] = elem.get("id")
+    for url_node in root.iter(url_tag):
+        style_id = _local_style_id(url_node.text)
+        if style_id in replaced:
+            url_node.text = "#" + replaced[style_id]
+
+    pruned = 0
+    if prune:
+        remaining = {elem.get("id"): elem for elem in shared if elem.getparent() is not None}
+        used = set()
+        pending = [_local_style_id(url_node.text) for url_node in root.iter(url_tag)
+                   if next(url_node.iterancestors(map_tag), None) is None]
+        while pending:
+            style_id = pending.pop()
+            if style_id is None or style_id in used:
+                continue
+            used.add(style_id)
+            if style_id in remaining and remaining[style_id].tag == map_tag:
+                pending.extend(_local_style_id(url_node.text) for url_node in remaining[style_id].iter(url_tag))
+        for style_id, elem in remaining.items():
+            if style_id not in used:
+                elem.getparent().remove(elem)
+                pruned += 1
+
+    METRICS.count("styles_merged", len(replaced))
+    METRICS.count("styles_pruned", pruned)
+    print(f"🎨Styles: {len(replaced)} duplicates merged, {pruned} unused removed")
+    return len(replaced), pruned
+
+
+class _StreamStyleDeduplicator:
+    # Потоковая версия: удалять неиспользуемые стили нельзя (ссылки ещё впереди),
+    # а дубликат выкидывается, только если на его id до сих пор никто не сослался
+    def __init__(self):
+        self.style_tags = ("{{{}}}Style".format(KML_NS), "{{{}}}StyleMap".format(KML_NS))
+        self.url_tag = "{{{}}}styleUrl".format(KML_NS)
+        self.survivors = {}
+        self.replaced = {}
+        self.referenced = set()
+
+    def keep(self, elem):
+        # elem — готовый к записи элемент верхнего уровня Document/папки
+        for url_node in elem.iter(self.url_tag):
+            style_id = _local_style_id(url_node.text)
+            if style_id in self.replaced:
+                style_id = self.replaced[style_id]
+                url_node.text = "#" + style_id
+            self.referenced.add(style_id)
+        if elem.tag not in self.style_tags or not elem.get("id"):
+            return True
+        key = _style_key(elem)
+        if key in self.survivors and elem.get("id") not in self.referenced:
+            self.replaced[elem.get("id")] = self.survivors[key]
+            METRICS.count("styles_merged")
+            return False
+        self.survivors.setdefault(key, elem.get("id"))
+        return True
+
+
+# --- ГЕОМЕТРИЯ ---
+METERS_PER_DEGREE = 111320.0
+GEOMETRY_TAGS = ("Point", "LineString", "LinearRing", "Polygon", "MultiGeometry", "Model", "Track", "MultiTrack")
+
+
+def _parse_coordinates(text):
+    # "lon,lat[,alt] lon,lat[,alt] ..." -> массив N x 3 и число значений в кортеже (2 или 3)
+    tokens = text.split()
+    widths = set(token.count(',') + 1 for token in tokens)
+    if len(widths) == 1:
+        width = widths.pop()
+        values = np.array(text.replace(',', ' ').split(), dtype=float).reshape(-1, width)
+        points = np.zeros((len(values), 3))
+        points[:, :width] = values
+        return points, width
+    points = np.zeros((len(tokens), 3))
+    for row, token in enumerate(tokens):
+        values = [float(value) for value in token.split(',')]
+        points[row, :len(values)] = values[:3]
+    return points, max(widths)
+
+
+def _format_number(value, precision=None):
+    text = repr(float(value)) if precision is None else f"{value:.{precision}f}"
+    if '.' in text and 'e' not in text:
+        text = text.rstrip('0').rstrip('.')
+    return "0" if text == "-0" else text
+
+
+def _format_coordinates(points, width, precision=None):
+    return " ".join(",".join([_format_number(lon, precision), _format_number(lat, precision)] +
+                             ([_format_number(alt)] if width > 2 else []))
+                    for lon, lat, alt in points)
+
+
+def _project(points, lat0):
+    # Локальная равнопромежуточная проекция в метрах: для областей размером с FIR ошибка мала
+    return np.column_stack((points[:, 0] * METERS_PER_DEGREE * np.cos(np.radians(lat0)),
+                            points[:, 1] * METERS_PER_DEGREE))
+
+
+def _segment_distances(xy, start, end):
+    # Расстояния от всех точек xy до отрезка start-end одним векторным выражением
+    segment = end - start
+    length2 = segment @ segment
+    if length2 == 0:
+        return np.hypot(*(xy - start).T)
+    t = np.clip(((xy - start) @ segment) / length2, 0.0, 1.0)
+    return np.hypot(*(xy - (start + t[:, None] * segment)).T)
+
+
+def _douglas_peucker(xy, tolerance):
+    # Рамер-Дуглас-Пекер без рекурсии: точка остаётся, если отходит от хорды больше допуска
+    keep = np.zeros(len(xy), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(xy) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        distances = _segment_distances(xy[first + 1:last], xy[first], xy[last])
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            index = first + 1 + farthest
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return keep
+
+
+def _simplify_coordinates(text, closed=False, tolerance_m=None, precision=None):
+    # Возвращает новый текст, число точек до/после и максимальное отклонение результата от исходника, м
+    points, width = _parse_coordinates(text)
+    keep = np.ones(len(points), dtype=bool)
+    lat0 = points[:, 1].mean()
+    xy = _project(points, lat0)
+    if tolerance_m and len(points) > 2:
+        keep = _douglas_peucker(xy, tolerance_m)
+        # Кольцо из меньше чем 4 точек вырождается, такую область оставляем как была
+        if closed and keep.sum() < 4:
+            keep[:] = True
+    result = points.copy()
+    if precision is not None:
+        result[:, :2] = np.round(result[:, :2], precision)
+    # Отклонение меряем уже после округления: каждую исходную точку до своего отрезка результата
+    result_xy = _project(result, lat0)
+    kept = np.flatnonzero(keep)
+    deviation = 0.0
+    for first, last in zip(kept[:-1], kept[1:]):
+        deviation = max(deviation, float(_segment_distances(xy[first:last + 1], result_xy[first], result_xy[last]).max()))
+    if len(kept) == 1:
+        deviation = float(np.hypot(*(xy[0] - result_xy[0])))
+    return _format_coordinates(result[keep], width, precision), len(points), int(keep.sum()), deviation, points
+
+
+def _add_region(pm, points, lod_pixels):
+    west, south = points[:, 0].min(), points[:, 1].min()
+    east, north = points[:, 0].max(), points[:, 1].max()
+    if east <= west or north <= south:
+        # У точки нет площади, Region с Lod её бы никогда не показал
+        return
+    kml_tag = "{{{}}}".format(KML_NS)
+    region = etree.Element(kml_tag + "Region")
+    box = etree.SubElement(region, kml_tag + "LatLonAltBox")
+    for name, value in (("north", north), ("south", south), ("east", east), ("west", west)):
+        etree.SubElement(box, kml_tag + name).text = _format_number(value)
+    lod = etree.SubElement(region, kml_tag + "Lod")
+    etree.SubElement(lod, kml_tag + "minLodPixels").text = str(lod_pixels)
+    etree.SubElement(lod, kml_tag + "maxLodPixels").text = "-1"
+    # По схеме KML Region идёт перед ExtendedData и геометрией
+    position = next((index for index, child in enumerate(pm) if isinstance(child.tag, str) and
+                     etree.QName(child).localname in GEOMETRY_TAGS + ("ExtendedData",)), len(pm))
+    pm.insert(position, region)
+
+
+def simplify_kml_geometry(root, tolerance_m=None, precision=None, lod_pixels=None):
+    # Упрощение контуров с допуском tolerance_m метров, округление до precision знаков
+    # и Region/Lod для меток. Возвращает отчёт по каждой области
+    placemark_tag = "{{{}}}Placemark".format(KML_NS)
+    coordinates_tag = "{{{}}}coordinates".format(KML_NS)
+    ring_tag = "{{{}}}LinearRing".format(KML_NS)
+    region_tag = "{{{}}}Region".format(KML_NS)
+    report = []
+    for pm in ([root] if root.tag == placemark_tag else root.iter(placemark_tag)):
+        area = {"name": pm.findtext("{{{}}}name".format(KML_NS)), "points_before": 0, "points_after": 0,
+                "max_deviation_m": 0.0}
+        all_points = []
+        for node in pm.iter(coordinates_tag):
+            if not node.text or not node.text.strip():
+                continue
+            text, before, after, deviation, points = _simplify_coordinates(
+                node.text, node.getparent().tag == ring_tag, tolerance_m, precision)
+            node.text = text
+            area["points_before"] += before
+            area["points_after"] += after
+            area["max_deviation_m"] = max(area["max_deviation_m"], deviation)
+            all_points.append(points)
+        if not all_points:
+            continue
+        if lod_pixels and pm.find(region_tag) is None:
+            _add_region(pm, np.concatenate(all_points), lod_pixels)
+        METRICS.count("coordinates_in", area["points_before"])
+        METRICS.count("coordinates_out", area["points_after"])
+        report.append(area)
+    return report
+
+
+def print_geometry_report(report, tolerance_m=None):
+    for area in report:
+        if area["points_after"] != area["points_before"]:
+            print(f'\t{area["name"]}: {area["points_before"]} -> {area["points_after"]} points, '
+                  f'max deviation {area["max_deviation_m"]:.1f} m')
+    before = sum(area["points_before"] for area in report)
+    after = sum(area["points_after"] for area in report)
+    deviation = max((area["max_deviation_m"] for area in report), default=0.0)
+    tolerance = f" (tolerance {tolerance_m} m)" if tolerance_m else ""
+    print(f"📐Geometry: {before} -> {after} points, max deviation {deviation:.1f} m{tolerance}")
+
+
+def _geometry_options(simplify_geometry=None):
+    # None — по конфигу; стадия включена, если задан хотя бы один из параметров
+    if simplify_geometry is False:
+        return None
+    if SIMPLIFY_TOLERANCE_M is None and COORDINATE_PRECISION is None and REGION_LOD_PIXELS is None:
+        return None
+    if not module_available("numpy"):
+        print("\033[31mnumpy is not installed\033[0m, geometry is written without simplification")
+        return None
+    return {"tolerance_m": SIMPLIFY_TOLERANCE_M, "precision": COORDINATE_PRECISION, "lod_pixels": REGION_LOD_PIXELS}
+
+
+# --- ПРОСТРАНСТВЕННЫЙ ИНДЕКС ---
+METERS_PER_NM = 1852.0
+SPATIAL_INDEX_VERSION = 1
+
+
+def spatial_index_path(input_path):
+    return f"{input_path}.spatial.json"
+
+
+def _ring_points(text):
+    # Без numpy: "lon,lat[,alt] ..." -> [[lon, lat], ...]
+    points = []
+    for token in text.split():
+        values = token.split(',')
+        points.append([float(values[0]), float(values[1])])
+    return points
+
+
+def build_spatial_areas(input_path, ban_words=None):
+    # Контуры меток базы: имя, ключ как в process_ge_pro_kml, папка, внешние кольца полигонов и рамка
+    if ban_words is None:
+        ban_words = BAN_WORDS
+    parser = etree.XMLParser(remove_blank_text=True, recover=True)
+    with open_kml_input(input_path) as source:
+        root = etree.parse(source, parser).getroot()
+    _, folders = _find_top_folders(root)
+    inner_tag = "{{{}}}innerBoundaryIs".format(KML_NS)
+    areas = []
+    for folder in folders:
+        name_node = folder.find("{{{}}}name".format(KML_NS))
+        folder_name = name_node.text if name_node is not None else "Unnamed Folder"
+        for pm in folder.findall("{{{}}}Placemark".format(KML_NS)):
+            pm_name_node = pm.find('{{{}}}name'.format(KML_NS))
+            if pm_name_node is None or not pm_name_node.text:
+                continue
+            key = normalize_placemark_name(pm_name_node.text, ban_words)
+            rings = []
+            for ring in pm.iter("{{{}}}LinearRing".format(KML_NS)):
+                coordinates = ring.find("{{{}}}coordinates".format(KML_NS))
+                if ring.getparent().tag != inner_tag and coordinates is not None and coordinates.text:
+                    rings.append(_ring_points(coordinates.text))
+            if key is None or not rings:
+                continue
+            lons = [lon for ring in rings for lon, _ in ring]
+            lats = [lat for ring in rings for _, lat in ring]
+            areas.append({"name": pm_name_node.text.strip(), "key": key, "folder": folder_name,
+                          "bbox": [min(lons), min(lats), max(lons), max(lats)], "rings": rings})
+    return areas
+
+
+def load_spatial_index(input_path, ban_words=None):
+    # Контуры хранятся рядом с базой, как индекс имён, и пересобираются при изменении KML или BAN_WORDS
+    if ban_words is None:
+        ban_words = BAN_WORDS
+    index_path = spatial_index_path(input_path)
+    kml_hash = _file_sha256(input_path)
+    try:
+        with open(index_path, "r", encoding="utf-8") as f:
+            stored = json.load(f)
+        if (stored.get("version") == SPATIAL_INDEX_VERSION and stored.get("kml_sha256") == kml_hash
+                and stored.get("ban_words") == list(ban_words)):
+            return SpatialIndex(stored["areas"])
+    except (OSError, ValueError):
+        pass
+
+    print(f"📇Building spatial index for '{input_path}'...")
+    areas = build_spatial_areas(input_path, ban_words)
+    try:
+        with open(index_path, "w", encoding="utf-8") as f:
+            json.dump({"version": SPATIAL_INDEX_VERSION, "kml_sha256": kml_hash, "ban_words": list(ban_words),
+                       "areas": areas}, f, ensure_ascii=False)
+    except OSError:
+        print(f"\033[31mCan't save spatial index '{index_path}'\033[0m, continue without cache")
+    return SpatialIndex(areas)
+
 
+def _cross(o, a, b):
+    return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+
+def _point_segment_distance(p, a, b):
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    length = dx * dx + dy * dy
+    t = 0.0 if length == 0 else max(0.0, min(1.0, ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / length))
+    return math.hypot(p[0] - a[0] - t * dx, p[1] - a[1] - t * dy)
+
+
+def _segments_cross(a, b, c, d):
+    return (_cross(c, d, a) > 0) != (_cross(c, d, b) > 0) and (_cross(a, b, c) > 0) != (_cross(a, b, d) > 0)
+
+
+def _point_in_ring(point, ring):
+    x, y = point
+    inside = False
+    for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+        if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+            inside = not inside
+    return inside
+
+
+def _ring_path_distance(ring, path, closed=False):
+    # Расстояние от заполненного кольца до ломаной (closed — до заполненного многоугольника), в метрах
+    if _point_in_ring(path[0], ring) or (closed and _point_in_ring(ring[0], path)):
+        return 0.0
+    ring_segments = list(zip(ring, ring[1:] + ring[:1]))
+    path_segments = list(zip(path, path[1:] + (path[:1] if closed else []))) or [(path[0], path[0])]
+    if any(_segments_cross(a, b, c, d) for a, b in ring_segments for c, d in path_segments):
+        return 0.0
+    # Без пересечений ближайшие точки двух ломаных — среди их вершин
+    return min(min(_point_segment_distance(point, c, d) for point in ring for c, d in path_segments),
+               min(_point_segment_distance(point, a, b) for point in path for a, b in ring_segments))
+
+
+class SpatialIndex:
+    # Сетка по рамкам контуров: ячейка -> номера областей. Запрос смотрит только ячейки своей рамки,
+    # точная проверка расстояния (в локальной проекции, метры) — для немногих кандидатов
+    def __init__(self, areas, cell_deg=None):
+        self.areas = areas
+        self.cell_deg = cell_deg or SPATIAL_CELL_DEG
+        self.cells = {}
+        for number, area in enumerate(areas):
+            for cell in self._cells(area["bbox"]):
+                self.cells.setdefault(cell, []).append(number)
+
+    def _cells(self, bbox):
+        min_lon, min_lat, max_lon, max_lat = bbox
+        for x in range(math.floor(min_lon / self.cell_deg), math.floor(max_lon / self.cell_deg) + 1):
+            for y in range(math.floor(min_lat / self.cell_deg), math.floor(max_lat / self.cell_deg) + 1):
+                yield x, y
+
+    def candidates(self, bbox):
+        found = set()
+        for cell in self._cells(bbox):
+            found.update(self.cells.get(cell, ()))
+        return [self.areas[number] for number in sorted(found)]
+
+    def near_path(self, path, distance_m=0.0, closed=False):
+        # Области не дальше distance_m от ломаной path [(lon, lat), ...] -> [(область, расстояние в метрах)]
+        lat0 = sum(lat for _, lat in path) / len(path)
+        scale = METERS_PER_DEGREE * max(math.cos(math.radians(lat0)), 0.01)
+        margin_lon, margin_lat = distance_m / scale, distance_m / METERS_PER_DEGREE
+        bbox = [min(lon for lon, _ in path) - margin_lon, min(lat for _, lat in path) - margin_lat,
+                max(lon for lon, _ in path) + margin_lon, max(lat for _, lat in path) + margin_lat]
+        path_xy = [(lon * scale, lat * METERS_PER_DEGREE) for lon, lat in path]
+        found = []
+        for area in self.candidates(bbox):
+            min_lon, min_lat, max_lon, max_lat = area["bbox"]
+            if min_lon > bbox[2] or max_lon < bbox[0] or min_lat > bbox[3] or max_lat < bbox[1]:
+                continue
+            # Расстояние до рамки области — нижняя граница, дальние кандидаты отсеиваются без контура
+            x1, y1, x2, y2 = min_lon * scale, min_lat * METERS_PER_DEGREE, max_lon * scale, max_lat * METERS_PER_DEGREE
+            corners = [(x1, y1), (x2, y1), (x2, y2), (x1, y2)]
+            if _ring_path_distance(corners, path_xy, closed) > distance_m:
+                continue
+            distance = min(_ring_path_distance([(lon * scale, lat * METERS_PER_DEGREE) for lon, lat in ring],
+                                               path_xy, closed)
+                           for ring in area["rings"])
+            if distance <= distance_m:
+                found.append((area, distance))
+        return found
+
+    def route(self, waypoints, width_nm=0.0):
+        # Коридор шириной width_nm вдоль маршрута [(lat, lon), ...]
+        return self.near_path([(lon, lat) for lat, lon in waypoints], width_nm * METERS_PER_NM / 2)
+
+    def bbox(self, min_lat, min_lon, max_lat, max_lon):
+        return self.near_path([(min_lon, min_lat), (max_lon, min_lat), (max_lon, max_lat), (min_lon, max_lat)],
+                              closed=True)
+
+
+def in_altitude_band(activation, lower_ft=None, upper_ft=None):
+    # Эшелон сравнивается как футы (FL50 = 5000ft), AGL/AMSL — без учёта рельефа
+    low = activation.lower_ft or 0
+    high = activation.upper_ft if activation.upper_ft is not None else math.inf
+    return (upper_ft is None or low <= upper_ft) and (lower_ft is None or high >= lower_ft)
+
+
+def query_active_areas(spatial_index, regions_dict, route=None, width_nm=0.0, bbox=None, lower_ft=None,
+                       upper_ft=None, window=None, folders_to_copy=()):
+    # Активные области на маршруте (коридор width_nm) или в рамке (min_lat, min_lon, max_lat, max_lon),
+    # с активациями в диапазоне высот и, если задано окно времени (start, end), активными в это окно
+    with METRICS.stage("spatial_query"):
+        if route:
+            hits = spatial_index.route(route, width_nm)
+        elif bbox:
+            hits = spatial_index.bbox(*bbox)
+        else:
+            hits = [(area, 0.0) for area in spatial_index.areas]
+        in_window = set(ActivationIndex(regions_dict).active_during(*window)) if window else None
+        results = []
+        for area, distance in hits:
+            if area["folder"] in folders_to_copy:
+                continue
+            activations = [activation for activation in regions_dict.get(area["key"], ())
+                           if in_altitude_band(activation, lower_ft, upper_ft)
+                           and (in_window is None or activation in in_window)]
+            if activations:
+                results.append({"area": area, "distance_m": distance, "activations": activations})
+        METRICS.count("spatial_hits", len(results))
+        return sorted(results, key=lambda result: result["area"]["name"])
+
+
+def query_results_json(results):
+    return [{
+        "name": result["area"]["name"],
+        "key": result["area"]["key"],
+        "folder": result["area"]["folder"],
+        "bbox": result["area"]["bbox"],
+        "distance_nm": round(result["distance_m"] / METERS_PER_NM, 2),
+        "activations": [{"time": activation.time_display(),
+                         "altitudes": ANSI_RE.sub('', activation.altitude_display()),
+                         "lower_ft": activation.lower_ft, "upper_ft": activation.upper_ft}
+                        for activation in result["activations"]],
+    } for result in results]
+
+
+# --- СБОРКА KML ---
+def _load_database(input_path, folders_to_copy, regions_dict, name_index=None, tree=None):
+    # Разбор базы для process_ge_pro_kml и render_outputs: по смещениям индекса без неактивных меток,
+    # иначе целиком. Возвращает (дерево, Document, папки верхнего уровня, индекс или None)
+    if tree is None and name_index is not None and name_index.get("placemark_ranges"):
+        with METRICS.stage("kml_read"):
+            tree, name_index = parse_indexed_database(input_path, name_index, regions_dict, folders_to_copy)
+    if tree is None:
+        with METRICS.stage("kml_read"):
+            parser = etree.XMLParser(remove_blank_text=True, recover=True)
+            with open_kml_input(input_path) as source:
+                tree = etree.parse(source, parser)
+    root = tree.getroot()
+    METRICS.add_bytes("input_kml", _file_size(input_path))
+
+    document, folders = _find_top_folders(root)
+    if name_index is not None and len(name_index["folders"]) != len(folders):
+        print("\033[31mName index doesn't match the database\033[0m, scanning all placemarks")
+        name_index = None
+    return tree, document, folders, name_index
+
+
+def process_ge_pro_kml(input_path, output_path, folders_to_copy, regions_dict, name_index=None, atomic=False,
+                       ban_words=None, time_span_day=None, compact=None, optimize_styles=None,
+                       simplify_geometry=None, tree=None):
+    # tree — база, разобранная заранее (preload_database); она изменяется на месте
+    if compact is None:
+        compact = COMPACT_KML
+    tree, document, folders, name_index = _load_database(input_path, folders_to_copy, regions_dict, name_index,
+                                                         tree)
+    root = tree.getroot()
+
+    templates_by_folder = check_folder_templates(folders, folders_to_copy, regions_dict, name_index, ban_words,
+                                                 output_path)
+
+    #Изменение имени файла
+    doc_name = root.find(f".//{{{KML_NS}}}Document/{{{KML_NS}}}name")
+    doc_name.text = _document_name(output_path)
+
+    with METRICS.stage("kml_filter"):
+        for folder_number, folder in enumerate(folders):
+            name_node = folder.find("{{{}}}name".format(KML_NS))
+            folder_name = name_node.text if name_node is not None else "Unnamed Folder"
+
+            if folder_name in folders_to_copy:
+                print(f"📦 Full coping folder: {folder_name}")
+                # Ничего не делаем, она остается в дереве со всем содержимым
+                METRICS.count("placemarks_copied", sum(1 for _ in folder.iter("{{{}}}Placemark".format(KML_NS))))
+            else:
+                print(f"🔧 Processing folder contents: {folder_name}")
+                # Если нужно удалить папку целиком:
+                # document.remove(folder)
+
+                # Если нужно отфильтровать метки внутри этой папки:
+                _assign_folder_id(folder, folder_number)
+                templates = templates_by_folder[folder_number]
+                if name_index is not None:
+                    sorted_pm_count = _filter_folder_indexed(folder, name_index["folders"][folder_number],
+                                                             regions_dict, folder_number, time_span_day, templates)
+                else:
+                    sorted_pm_count = _filter_folder_scan(folder, regions_dict, folder_number, ban_words,
+                                                          time_span_day, templates)
+                print(f'\tNumber of processed placemarks: {sorted_pm_count}')
+
+    geometry = _geometry_options(simplify_geometry)
+    if geometry is not None:
+        with METRICS.stage("kml_geometry"):
+            print_geometry_report(simplify_kml_geometry(root, **geometry), geometry["tolerance_m"])
+
+    if OPTIMIZE_STYLES if optimize_styles is None else optimize_styles:
+        # С DELTA_KML метки из Update ссылаются на стили уже загруженного файла, поэтому их не удаляем
+        with METRICS.stage("kml_styles"):
+            optimize_kml_styles(root, prune=not DELTA_KML)
+
+    with METRICS.stage("kml_write"):
+        output_size = write_kml_tree(tree, input_path, output_path, atomic, compact)
+    METRICS.add_bytes("output_kml", output_size)
+
+
+def check_folder_templates(folders, folders_to_copy, regions_dict, name_index=None, ban_words=None,
+                           output_path=None):
+    # Все шаблоны описаний проверяются до изменения дерева, ошибки выводятся одним списком.
+    # Возвращает {номер папки: {позиция метки: шаблон}} для обрабатываемых папок
+    with METRICS.stage("kml_templates"):
+        templates_by_folder = {}
+        errors = []
+        for folder_number, folder in enumerate(folders):
+            name_node = folder.find("{{{}}}name".format(KML_NS))
+            folder_name = name_node.text if name_node is not None else "Unnamed Folder"
+            if folder_name in folders_to_copy:
+                continue
+            templates = folder_templates(folder, name_index["folders"][folder_number] if name_index else None)
+            templates_by_folder[folder_number] = templates
+            bad_positions = [position for position, template in templates.items() if template is None]
+            if bad_positions:
+                placemarks = folder.findall("{{{}}}Placemark".format(KML_NS))
+                for position in bad_positions:
+                    pm_name = placemarks[position].find('{{{}}}name'.format(KML_NS)).text
+                    errors.append(template_error(folder_name, pm_name, regions_dict, ban_words))
+        report_template_errors(errors, output_path)
+    return templates_by_folder
+
+
+def write_kml_tree(tree, input_path, output_path, atomic=False, compact=None):
+    # Сохранение с корректным объявлением XML для Google Earth, возвращает размер файла
+    if compact is None:
+        compact = COMPACT_KML
+    if is_kmz(output_path):
+        # Дерево пишется сразу в сжатый поток doc.kml, целиком в памяти не собирается
+        hrefs = [node.text for node in tree.getroot().iter("{{{}}}href".format(KML_NS)) if node.text]
+        with open_kml_output(output_path, atomic, kml_resources(input_path, hrefs)) as f:
+            tree.write(f, pretty_print=not compact, xml_declaration=True, encoding='utf-8')
+        return _file_size(output_path)
+    data = etree.tostring(tree,
+                          pretty_print=not compact,
+                          xml_declaration=True,
+                          encoding='utf-8')
+    with open_output(output_path, atomic) as f:
+        f.write(data)
+    return len(data)
+
+
+# --- НЕСКОЛЬКО ВЫХОДОВ ИЗ ОДНОЙ БАЗЫ ---
+OUTPUT_FORMATS = {".kml": "kml", ".kmz": "kmz", ".geojson": "geojson", ".json": "geojson"}
+
+
+def output_sink(spec):
+    # Выход из OUTPUTS: путь или {"PATH": ..., фильтры}. Формат — по расширению.
+    # FOLDERS — только эти папки верхнего уровня, AREAS — начала имён областей ("d", "r", "tra"),
+    # LOWER_FT/UPPER_FT — только активации, задевающие этот диапазон высот
+    if isinstance(spec, str):
+        spec = {"PATH": spec}
+    path = spec["PATH"]
+    output_format = OUTPUT_FORMATS.get(os.path.splitext(path)[1].lower())
+    if output_format is None:
+        raise ValueError(f"Unknown format of output '{path}', use one of: {', '.join(OUTPUT_FORMATS)}")
+    return {
+        "PATH": path,
+        "FORMAT": output_format,
+        "FOLDERS": spec.get("FOLDERS"),
+        "AREAS": tuple(area.lower() for area in spec["AREAS"]) if spec.get("AREAS") else None,
+        "LOWER_FT": spec.get("LOWER_FT"),
+        "UPPER_FT": spec.get("UPPER_FT"),
+    }
+
+
+def _sink_activations(sink, pm_name_normalized, data_list):
+    # Активации метки, которые попадают в выход; пустой список — метки в выходе нет
+    if sink["AREAS"] is not None and not pm_name_normalized.startswith(sink["AREAS"]):
+        return []
+    if sink["LOWER_FT"] is None and sink["UPPER_FT"] is None:
+        return list(data_list)
+    # У строк "time|alt" высоты не разобраны, фильтр высот их не отбрасывает
+    return [item for item in data_list if not isinstance(item, Activation)
+            or in_altitude_band(item, sink["LOWER_FT"], sink["UPPER_FT"])]
+
+
+def _reduce_database(folders, folders_to_copy, regions_dict, templates_by_folder, name_index=None,
+                     ban_words=None):
+    # Единственный проход по базе: неактивные метки удаляются, активные запоминаются без заполнения.
+    # Возвращает [(номер, имя, копировать целиком, [(метка, имя в словаре, активации, шаблон), ...])]
+    reduced = []
+    for folder_number, folder in enumerate(folders):
+        name_node = folder.find("{{{}}}name".format(KML_NS))
+        folder_name = name_node.text if name_node is not None else "Unnamed Folder"
+        if folder_name in folders_to_copy:
+            print(f"📦 Full coping folder: {folder_name}")
+            METRICS.count("placemarks_copied", sum(1 for _ in folder.iter("{{{}}}Placemark".format(KML_NS))))
+            reduced.append((folder_number, folder_name, True, []))
+            continue
+        print(f"🔧 Processing folder contents: {folder_name}")
+        active = []
+
+        def remember(pm, pm_name_normalized, data_list, number, used_ids, day, template):
+            active.append((pm, pm_name_normalized, data_list, template))
+
+        templates = templates_by_folder[folder_number]
+        if name_index is not None:
+            _filter_folder_indexed(folder, name_index["folders"][folder_number], regions_dict, folder_number,
+                                   templates=templates, render=remember)
+        else:
+            _filter_folder_scan(folder, regions_dict, folder_number, ban_words, templates=templates,
+                                render=remember)
+        print(f'\tNumber of processed placemarks: {len(active)}')
+        reduced.append((folder_number, folder_name, False, active))
+    return reduced
+
+
+def _render_kml_sink(sink, tree, reduced, element_numbers, day=None, prune_styles=True):
+    # Свой экземпляр уменьшенной базы для выхода: метки находятся по номеру в порядке обхода дерева
+    root = copy.deepcopy(tree.getroot())
+    elements = list(root.iter())
+    document, folders = _find_top_folders(root)
+    root.find(f".//{{{KML_NS}}}Document/{{{KML_NS}}}name").text = _document_name(sink["PATH"])
+    rendered = 0
+    for folder_number, folder_name, full_copy, active in reduced:
+        folder = folders[folder_number]
+        if sink["FOLDERS"] is not None and folder_name not in sink["FOLDERS"]:
+            folder.getparent().remove(folder)
+            continue
+        if full_copy:
+            continue
+        _assign_folder_id(folder, folder_number)
+        used_ids = set()
+        for pm, pm_name_normalized, data_list, template in active:
+            sink_pm = elements[element_numbers[pm]]
+            data_list = _sink_activations(sink, pm_name_normalized, data_list)
+            if data_list:
+                rendered += 1
+                _render_placemark(sink_pm, pm_name_normalized, data_list, folder_number, used_ids, day, template)
+            else:
+                sink_pm.getparent().remove(sink_pm)
+    if OPTIMIZE_STYLES:
+        optimize_kml_styles(root, prune=prune_styles)
+    return etree.ElementTree(root), rendered
+
+
+def _geojson_geometry(node):
+    # Геометрия KML -> GeoJSON, высоты отбрасываются
+    kml_tag = "{{{}}}".format(KML_NS)
+    tag = etree.QName(node).localname
+
+    def ring(parent):
+        coordinates = parent.find(f".//{kml_tag}coordinates")
+        return _ring_points(coordinates.text) if coordinates is not None and coordinates.text else []
+
+    if tag == "Point":
+        points = ring(node)
+        return {"type": "Point", "coordinates": points[0]} if points else None
+    if tag == "LineString":
+        return {"type": "LineString", "coordinates": ring(node)}
+    if tag == "LinearRing":
+        return {"type": "Polygon", "coordinates": [ring(node)]}
+    if tag == "Polygon":
+        rings = [ring(boundary) for boundary in node.findall(f"{kml_tag}outerBoundaryIs")]
+        rings += [ring(boundary) for boundary in node.findall(f"{kml_tag}innerBoundaryIs")]
+        return {"type": "Polygon", "coordinates": [points for points in rings if points]}
+    if tag == "MultiGeometry":
+        geometries = [_geojson_geometry(child) for child in node
+                      if isinstance(child.tag, str) and etree.QName(child).localname in GEOMETRY_TAGS]
+        return {"type": "GeometryCollection", "geometries": [geometry for geometry in geometries if geometry]}
+    return None
+
+
+def _geojson_feature(pm, folder_name, pm_name_normalized=None, data_list=(), day=None):
+    geometry = next((_geojson_geometry(child) for child in pm
+                     if isinstance(child.tag, str) and etree.QName(child).localname in GEOMETRY_TAGS), None)
+    activations = []
+    for item in data_list:
+        time_part, alt_part = _activation_parts(item)
+        activation = {"time": time_part, "altitudes": ANSI_RE.sub('', alt_part)}
+        if isinstance(item, Activation):
+            activation.update(lower_ft=item.lower_ft, upper_ft=item.upper_ft)
+        if day is not None:
+            activation["begin"], activation["end"] = _time_span_bounds(item, day)
+        activations.append(activation)
+    return {"type": "Feature", "geometry": geometry,
+            "properties": {"name": (pm.findtext("{{{}}}name".format(KML_NS)) or "").strip(), "folder": folder_name,
+                           "key": pm_name_normalized, "activations": activations}}
+
+
+def _render_geojson_sink(sink, folders, reduced, day=None):
+    # Области из FULL_COPY попадают в выход без активаций
+    features = []
+    rendered = 0
+    for folder_number, folder_name, full_copy, active in reduced:
+        if sink["FOLDERS"] is not None and folder_name not in sink["FOLDERS"]:
+            continue
+        if full_copy:
+            features += [_geojson_feature(pm, folder_name)
+                         for pm in folders[folder_number].iter("{{{}}}Placemark".format(KML_NS))]
+            continue
+        for pm, pm_name_normalized, data_list, _ in active:
+            data_list = _sink_activations(sink, pm_name_normalized, data_list)
+            if data_list:
+                rendered += 1
+                features.append(_geojson_feature(pm, folder_name, pm_name_normalized, data_list, day))
+    return {"type": "FeatureCollection", "features": features}, rendered
+
+
+def _write_sink(sink, tree, folders, reduced, element_numbers, input_path, atomic=False, day=None,
+                prune_styles=True):
+    # Выполняется в потоке: у каждого выхода своё дерево, общая база только читается
+    if sink["FORMAT"] == "geojson":
+        collection, rendered = _render_geojson_sink(sink, folders, reduced, day)
+        data = json.dumps(collection, ensure_ascii=False).encode('utf-8')
+        with open_output(sink["PATH"], atomic) as f:
+            f.write(data)
+        return len(data), rendered
+    sink_tree, rendered = _render_kml_sink(sink, tree, reduced, element_numbers, day, prune_styles)
+    return write_kml_tree(sink_tree, input_path, sink["PATH"], atomic), rendered
+
+
+def render_outputs(input_path, sinks, folders_to_copy, regions_dict, name_index=None, atomic=False,
+                   ban_words=None, time_span_day=None, simplify_geometry=None, tree=None):
+    # Несколько выходов (output_sink) из одного разбора базы: один проход отбирает активные метки,
+    # затем каждый выход заполняет свою копию уменьшенной базы и пишется в своём потоке.
+    # Первый выход — OUTPUT_KML задачи, только для него с DELTA_KML сохраняются неиспользуемые стили
+    tree, _, folders, name_index = _load_database(input_path, folders_to_copy, regions_dict, name_index, tree)
+    root = tree.getroot()
+    templates_by_folder = check_folder_templates(folders, folders_to_copy, regions_dict, name_index, ban_words,
+                                                 sinks[0]["PATH"])
+    with METRICS.stage("kml_filter"):
+        reduced = _reduce_database(folders, folders_to_copy, regions_dict, templates_by_folder, name_index,
+                                   ban_words)
+
+    # Геометрия от выхода не зависит, упрощается один раз
+    geometry = _geometry_options(simplify_geometry)
+    if geometry is not None:
+        with METRICS.stage("kml_geometry"):
+            print_geometry_report(simplify_kml_geometry(root, **geometry), geometry["tolerance_m"])
+
+    element_numbers = {element: number for number, element in enumerate(root.iter())}
+    workers = min(len(sinks), BATCH_WORKERS or os.cpu_count() or 1)
+    with METRICS.stage("kml_outputs"), concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_write_sink, sink, tree, folders, reduced, element_numbers, input_path, atomic,
+                               time_span_day, not DELTA_KML or number > 0)
+                   for number, sink in enumerate(sinks)]
+        for sink, future in zip(sinks, futures):
+            output_size, rendered = future.result()
+            METRICS.add_bytes("output_geojson" if sink["FORMAT"] == "geojson" else "output_kml", output_size)
+            METRICS.count("outputs_written")
+            print(f"\t{sink['PATH']}: {rendered} active placemarks")
+
+
+def _free_streamed(elem):
+    # Освобождаем память: очищаем элемент и уже записанных соседей
+    elem.clear(keep_tail=True)
+    parent = elem.getparent()
+    if parent is not None:
+        while elem.getprevious() is not None:
+            del parent[0]
+
+
+class _KmlChunkWriter:
+    # Пишет документ кусками: открывающие/закрывающие теги контейнеров и готовые поддеревья.
+    # Объявления пространств имён корня не повторяются в каждом поддереве
+    def __init__(self, f, root, compact=False, styles=None, geometry=None):
+        self.f = f
+        self.compact = compact
+        self.styles = styles
+        self.geometry = geometry
+        self.geometry_report = []
+        self.newline = b'' if compact else b'\n'
+        self.hrefs = []
+        self.href_tag = "{{{}}}href".format(KML_NS)
+        root_tag = etree.tostring(etree.Element(root.tag, nsmap=root.nsmap), encoding='utf-8')
+        self.root_decls = re.findall(rb' xmlns(?::[\w.-]+)?="[^"]*"', root_tag)
+
+    def _strip_decls(self, data):
+        head_end = data.index(b'>')
+        head = data[:head_end]
+        for decl in self.root_decls:
+            head = head.replace(decl, b'', 1)
+        return head + data[head_end:]
+
+    def start(self, elem, is_root=False):
+        shallow = etree.Element(elem.tag, dict(elem.attrib), nsmap=elem.nsmap)
+        data = etree.tostring(shallow, encoding='utf-8')
+        if not is_root:
+            data = self._strip_decls(data)
+        self.f.write(data[:-2] + b'>' + self.newline)
+
+    def end(self, elem):
+        local_name = etree.QName(elem).localname
+        closing = f"</{elem.prefix}:{local_name}>" if elem.prefix else f"</{local_name}>"
+        self.f.write(closing.encode() + self.newline)
+
+    def write(self, elem):
+        if self.styles is not None and not self.styles.keep(elem):
+            return
+        if self.geometry is not None:
+            self.geometry_report.extend(simplify_kml_geometry(elem, **self.geometry))
+        # Ссылки на иконки запоминаем по пути, чтобы потом положить файлы в KMZ
+        self.hrefs.extend(node.text for node in elem.iter(self.href_tag) if node.text)
+        self.f.write(self._strip_decls(etree.tostring(elem, encoding='utf-8', pretty_print=not self.compact,
+                                                      with_tail=False)))
+
+
+def process_ge_pro_kml_stream(input_path, output_path, folders_to_copy, regions_dict, atomic=False,
+                              ban_words=None, time_span_day=None, compact=None, optimize_styles=None,
+                              simplify_geometry=None):
+    # Потоковый вариант process_ge_pro_kml: база читается через iterparse,
+    # результат пишется по мере чтения, в памяти только текущая метка/стиль
+    document_tag = "{{{}}}Document".format(KML_NS)
+    folder_tag = "{{{}}}Folder".format(KML_NS)
+    name_tag = "{{{}}}name".format(KML_NS)
+    placemark_tag = "{{{}}}Placemark".format(KML_NS)
+    description_tag = "{{{}}}description".format(KML_NS)
+
+    if compact is None:
+        compact = COMPACT_KML
+    if optimize_styles is None:
+        optimize_styles = OPTIMIZE_STYLES
+    styles = _StreamStyleDeduplicator() if optimize_styles else None
+    geometry = _geometry_options(simplify_geometry)
+    resources = {}
+    # Ошибки шаблонов известны только после полного прохода: с "abort" пишем во временный файл,
+    # иначе прежний выходной файл был бы уже перезаписан к моменту остановки
+    if TEMPLATE_ERROR_POLICY == "abort":
+        atomic = True
+    METRICS.add_bytes("input_kml", _file_size(input_path))
+    # Чтение, фильтрация и запись идут вперемешку, поэтому это один этап
+    with METRICS.stage("kml_stream"), open_kml_input(input_path) as source, \
+            open_kml_output(output_path, atomic, resources) as f:
+        events = etree.iterparse(source, events=("start", "end"), remove_blank_text=True, recover=True)
+        f.write(b"<?xml version='1.0' encoding='utf-8'?>\n")
+        writer = None
+        containers = []  # открытые kml/Document
+        depth = 0
+        folder_depth = None  # глубина папок верхнего уровня
+        folder = None  # состояние текущей папки верхнего уровня
+        folder_number = -1
+
+        # Метки с неверным шаблоном в потоке не пишутся; с "abort" временный файл
+        # удаляется после полного прохода, чтобы в отчёт попали все ошибки
+        template_errors = []
+
+        def open_folder(folder_name):
+            folder["name"] = folder_name
+            folder["copy"] = folder_name in folders_to_copy
+            if folder["copy"]:
+                print(f"📦 Full coping folder: {folder_name}")
+            else:
+                print(f"🔧 Processing folder contents: {folder_name}")
+                _assign_folder_id(folder["elem"], folder_number)
+            writer.start(folder["elem"])
+            for pending in folder["pending"]:
+                writer.write(pending)
+                _free_streamed(pending)
+            folder["pending"] = []
+            folder["opened"] = True
+
+        def write_folder_child(child):
+            if folder["copy"] or child.tag != placemark_tag:
+                if child.tag == placemark_tag:
+                    METRICS.count("placemarks_copied")
+                writer.write(child)
+                return
+            METRICS.count("placemarks_scanned")
+            name_node = child.find(name_tag)
+            if name_node is None or not name_node.text:
+                writer.write(child)
+                return
+            pm_name_normalized = normalize_placemark_name(name_node.text, ban_words)
+            desc_node = child.find(description_tag)
+            template = None
+            if desc_node is not None:
+                template = compile_description_template(desc_node.text)
+                if template is None:
+                    template_errors.append(template_error(folder["name"], name_node.text, regions_dict, ban_words))
+                    METRICS.count("placemarks_removed")
+                    return
+            if pm_name_normalized is not None and pm_name_normalized in regions_dict:
+                folder["count"] += 1
+                METRICS.count("placemarks_matched")
+                for rendered in _render_placemark(child, pm_name_normalized, regions_dict[pm_name_normalized],
+                                                  folder_number, folder["used_ids"], time_span_day, template):
+                    writer.write(rendered)
+            else:
+                METRICS.count("placemarks_removed")
+
+        for event, elem in events:
+            if event == "start":
+                depth += 1
+                if depth == 1:
+                    writer = _KmlChunkWriter(f, elem, compact, styles, geometry)
+                if depth == 1 or (depth == 2 and elem.tag == document_tag):
+                    writer.start(elem, is_root=depth == 1)
+                    containers.append(elem)
+                    folder_depth = depth + 1
+                elif depth == folder_depth and elem.tag == folder_tag:
+                    folder_number += 1
+                    folder = {"elem": elem, "opened": False, "copy": False, "pending": [], "count": 0,
+                              "used_ids": set()}
+                continue
+
+            depth -= 1
+            if depth < folder_depth - 1:
+                continue
+            if depth == folder_depth - 1:
+                if elem.tag == folder_tag and folder is not None:
+                    # Папка верхнего уровня закончилась
+                    if not folder["opened"]:
+                        open_folder("Unnamed Folder")
+                    if not folder["copy"]:
+                        print(f'\tNumber of processed placemarks: {folder["count"]}')
+                    writer.end(elem)
+                    folder = None
+                elif elem.tag == name_tag and elem.getparent().tag == document_tag:
+                    #Изменение имени файла
+                    elem.text = _document_name(output_path)
+                    writer.write(elem)
+                else:
+                    # Стили, StyleMap и прочие элементы Document идут без изменений
+                    writer.write(elem)
+                _free_streamed(elem)
+            elif depth == folder_depth and folder is not None:
+                if not folder["opened"]:
+                    # Пока имя папки неизвестно, держим элементы в памяти
+                    folder["pending"].append(elem)
+                    if elem.tag == name_tag:
+                        open_folder(elem.text)
+                    continue
+                write_folder_child(elem)
+                _free_streamed(elem)
+
+        for container in reversed(containers):
+            writer.end(container)
+        if is_kmz(output_path) and writer is not None:
+            resources.update(kml_resources(input_path, writer.hrefs))
+        if styles is not None:
+            print(f"🎨Styles: {len(styles.replaced)} duplicates merged")
+        if geometry is not None and writer is not None:
+            print_geometry_report(writer.geometry_report, geometry["tolerance_m"])
+        report_template_errors(template_errors, output_path)
+    METRICS.add_bytes("output_kml", _file_size(output_path))
+
+
+def kml_delta_paths(output_path):
+    base = output_path[:-4] if output_path.lower().endswith((".kml", ".kmz")) else output_path
+    return {
+        "delta": f"{base} Update.kml",
+        "master": f"{base} Link.kml",
+        "state": f"{base}.state.json",
+    }
+
+
+def collect_active_placemarks(output_path):
+    # Все метки с id из готового OUTPUT_KML: папка, описание и хэши содержимого
+    parser = etree.XMLParser(remove_blank_text=True, recover=True)
+    with open_kml_input(output_path) as source:
+        root = etree.parse(source, parser).getroot()
+    elements = {}
+    placemarks = {}
+    for pm in root.iter("{{{}}}Placemark".format(KML_NS)):
+        pm_id = pm.get("id")
+        if not pm_id:
+            continue
+        desc_node = pm.find('{{{}}}description'.format(KML_NS))
+        body = etree.Element(pm.tag)
+        body.extend(copy.deepcopy(child) for child in pm if child is not desc_node)
+        parent = pm.getparent()
+        elements[pm_id] = pm
+        placemarks[pm_id] = {
+            "folder": parent.get("id") if parent is not None else None,
+            "description": desc_node.text if desc_node is not None else None,
+            "body_sha256": hashlib.sha256(etree.tostring(body, method="c14n")).hexdigest(),
+        }
+    return elements, placemarks
+
+
+def diff_active_placemarks(previous, current):
+    # Включённые, выключенные и изменённые (время/высоты в описании или сама метка) области
+    created = [pm_id for pm_id in current if pm_id not in previous]
+    deleted = [pm_id for pm_id in previous if pm_id not in current]
+    changed = []
+    for pm_id in current:
+        if pm_id not in previous or previous[pm_id] == current[pm_id]:
+            continue
+        if previous[pm_id]["body_sha256"] == current[pm_id]["body_sha256"] \
+                and previous[pm_id]["folder"] == current[pm_id]["folder"]:
+            changed.append(pm_id)
+        else:
+            # Поменялась геометрия/стиль в базе: пересоздаём метку целиком
+            deleted.append(pm_id)
+            created.append(pm_id)
+    return created, changed, deleted
+
+
+def write_kml_delta(output_path, atomic=False):
+    # Маленький KML с <NetworkLinkControl><Update> относительно прошлой публикации
+    # и мастер-файл с NetworkLink на полный файл и на обновления.
+    # Google Earth применяет Update при каждой загрузке, в том числе поверх только что
+    # перечитанного полного файла, поэтому операции идемпотентны: перед Create та же метка удаляется
+    paths = kml_delta_paths(output_path)
+    elements, current = collect_active_placemarks(output_path)
+    previous = None
+    if os.path.exists(paths["state"]):
+        with open(paths["state"], "r", encoding="utf-8") as f:
+            previous = json.load(f)
+
+    if previous is None:
+        # Первая публикация: всё уже есть в полном файле
+        created, changed, deleted = [], [], []
+    else:
+        created, changed, deleted = diff_active_placemarks(previous, current)
+    kml_tag = "{{{}}}".format(KML_NS)
+    root = etree.Element(kml_tag + "kml", nsmap={None: KML_NS})
+    update = etree.SubElement(etree.SubElement(root, kml_tag + "NetworkLinkControl"), kml_tag + "Update")
+    etree.SubElement(update, kml_tag + "targetHref").text = os.path.basename(output_path)
+    if deleted or created:
+        delete = etree.SubElement(update, kml_tag + "Delete")
+        for pm_id in dict.fromkeys(deleted + created):
+            etree.SubElement(delete, kml_tag + "Placemark", targetId=pm_id)
+    if created:
+        create = etree.SubElement(update, kml_tag + "Create")
+        containers = {}
+        for pm_id in created:
+            folder_id = current[pm_id]["folder"]
+            if folder_id is None:
+                print(f"\033[31mPlacemark '{pm_id}' has no parent folder id\033[0m, it will appear after full refresh")
+                continue
+            if folder_id not in containers:
+                containers[folder_id] = etree.SubElement(create, kml_tag + "Folder", targetId=folder_id)
+            containers[folder_id].append(copy.deepcopy(elements[pm_id]))
+    if changed:
+        change = etree.SubElement(update, kml_tag + "Change")
+        for pm_id in changed:
+            pm = etree.SubElement(change, kml_tag + "Placemark", targetId=pm_id)
+            etree.SubElement(pm, kml_tag + "description").text = etree.CDATA(current[pm_id]["description"] or "")
+
+    with open_output(paths["delta"], atomic) as f:
+        f.write(etree.tostring(root, pretty_print=True, xml_declaration=True, encoding='utf-8'))
+    _write_master_kml(output_path, paths, atomic)
+    with open_output(paths["state"], atomic) as f:
+        f.write(json.dumps(current, ensure_ascii=False).encode('utf-8'))
+
+    print(f"🔁Update: {len(created)} activated, {len(changed)} changed, {len(deleted)} deactivated "
+          f"-> '{paths['delta']}'")
+    return {"created": created, "changed": changed, "deleted": deleted}
+
+
+def _write_master_kml(output_path, paths, atomic=False):
+    kml_tag = "{{{}}}".format(KML_NS)
+    root = etree.Element(kml_tag + "kml", nsmap={None: KML_NS})
+    document = etree.SubElement(root, kml_tag + "Document")
+    title = os.path.splitext(os.path.basename(output_path))[0]
+    etree.SubElement(document, kml_tag + "name").text = title
+    links = (
+        (title, os.path.basename(output_path), FULL_REFRESH_INTERVAL),
+        (f"{title} updates", os.path.basename(paths["delta"]), DELTA_REFRESH_INTERVAL),
+    )
+    for name, href, interval in links:
+        network_link = etree.SubElement(document, kml_tag + "NetworkLink")
+        etree.SubElement(network_link, kml_tag + "name").text = name
+        link = etree.SubElement(network_link, kml_tag + "Link")
+        etree.SubElement(link, kml_tag + "href").text = href
+        etree.SubElement(link, kml_tag + "refreshMode").text = "onInterval"
+        etree.SubElement(link, kml_tag + "refreshInterval").text = str(interval)
+    with open_output(paths["master"], atomic) as f:
+        f.write(etree.tostring(root, pretty_print=True, xml_declaration=True, encoding='utf-8'))
+
+
+# Регулярки для строк таблицы EAUP компилируются один раз
+TIME_RE = re.compile(r'\d{2}:\d{2}')
+LEVEL_RE = re.compile(r'\b(?:\d{3}|SFC)\b', flags=re.IGNORECASE)
+
+
+def _iter_eaup_rows_bs4(html):
+    soup = bs4.BeautifulSoup(html, 'html.parser')
+    for row in soup.find_all('tr'):
+        cell_texts = [c.get_text(strip=True) for c in row.find_all(['td', 'th'])]
+        yield "|".join([text for text in cell_texts if text])
+
+
+def _iter_eaup_rows_lxml(html):
+    # C-парсер lxml: текст каждой ячейки собирается один раз, как get_text(strip=True) в bs4
+    root = etree.fromstring(html.encode('utf-8'), etree.HTMLParser(encoding='utf-8'))
+    if root is None:
+        return
+    etree.strip_elements(root, 'script', 'style', with_tail=False)
+    for row in root.iter('tr'):
+        cell_texts = ["".join([text.strip() for text in c.itertext()]) for c in row.iter('td', 'th')]
+        yield "|".join([text for text in cell_texts if text])
+
+
+HTML_ENGINES = {
+    "bs4": _iter_eaup_rows_bs4,
+    "lxml": _iter_eaup_rows_lxml,
+}
+
+
+def _resolve_html_engine(engine):
+    if engine is None:
+        engine = HTML_ENGINE
+    if engine not in HTML_ENGINES:
+        raise ValueError(f"Unknown HTML_ENGINE '{engine}', use one of: {', '.join(HTML_ENGINES)}")
+    return engine
+
+
+def parse_eaup_htm(file_path, engine=None):
+    engine = _resolve_html_engine(engine)
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(file_path)
+    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+        html = f.read()
+    return parse_eaup_html(html, engine)
+
+
+@functools.lru_cache(maxsize=None)
+def region_name_re(prefixes):
+    # ("LP",) -> \b(LP(?:-?[A-Z0-9]+)+)\b; несколько FIR -> одна регулярка на все префиксы
+    alternatives = '|'.join(re.escape(prefix) for prefix in sorted(prefixes, key=len, reverse=True))
+    return re.compile(r'\b((?:' + alternatives + r')(?:-?[A-Z0-9]+)+)\b', flags=re.IGNORECASE)
+
+
+class Activation:
+    # Одна активация области из AUP/UUP. Время — минуты от начала суток UTC,
+    # высоты — как в таблице (сотни футов или эшелон) со своей системой отсчёта:
+    # GND, AGL/AMSL (ниже 5000ft) или FL. Строки для описания собираются только при выводе
+    __slots__ = ('region', 'start', 'end', 'lower', 'lower_ref', 'upper', 'upper_ref')
+
+    def __init__(self, region, start, end, lower=None, lower_ref=None, upper=None, upper_ref=None):
+        self.region = region
+        self.start = start
+        self.end = end
+        self.lower = lower
+        self.lower_ref = lower_ref
+        self.upper = upper
+        self.upper_ref = upper_ref
+
+    @staticmethod
+    def level_ref(level, is_upper):
+        if level == 0:
+            return 'GND'
+        if level < 50:
+            return 'AMSL' if is_upper else 'AGL'
+        return 'FL'
+
+    @staticmethod
+    def format_level(level, ref):
+        if ref == 'GND':
+            return 'GND'
+        if ref == 'FL':
+            return f"FL{level}"
+        return f"{level * 100}ft {ref}"
+
+    @staticmethod
+    def format_minutes(minutes):
+        return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+    @property
+    def lower_ft(self):
+        return None if self.lower is None else self.lower * 100
+
+    @property
+    def upper_ft(self):
+        return None if self.upper is None else self.upper * 100
+
+    def key(self):
+        return (self.region, self.start, self.end, self.lower, self.lower_ref, self.upper, self.upper_ref)
+
+    def __eq__(self, other):
+        return isinstance(other, Activation) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __repr__(self):
+        return f"Activation({self.region!r}, {self})"
+
+    def time_display(self):
+        return f"{self.format_minutes(self.start)}-{self.format_minutes(self.end)}"
+
+    def altitude_display(self):
+        if self.upper is None:
+            return "\033[31mNot specified\033[0m"
+        if self.lower is None:
+            return self.format_level(self.upper, self.upper_ref)
+        return f"{self.format_level(self.lower, self.lower_ref)}/{self.format_level(self.upper, self.upper_ref)}"
+
+    def __str__(self):
+        # Прежний формат "10:00-12:00|GND/5000ft AMSL"
+        return f"{self.time_display()}|{self.altitude_display()}"
+
+    def levels(self):
+        return self.lower, self.lower_ref, self.upper, self.upper_ref
+
+    def same_levels(self, other):
+        return self.levels() == other.levels()
+
+    def levels_sort_key(self):
+        # None (высота не указана) нельзя сравнивать с числом, такие высоты идут первыми
+        return (self.lower is not None, self.lower or 0, self.lower_ref or '',
+                self.upper is not None, self.upper or 0, self.upper_ref or '')
+
+
+def merge_activations(activations):
+    # Склеивает пересекающиеся и соседние интервалы одной области с одинаковыми высотами.
+    # Сортировка по всем высотам с системой отсчёта: интервалы одной группы высот идут подряд
+    merged = []
+    ordered = sorted(activations, key=lambda a: (a.region, a.levels_sort_key(), a.start, a.end))
+    for activation in ordered:
+        last = merged[-1] if merged else None
+        if last is not None and last.region == activation.region and last.same_levels(activation) \
+                and activation.start <= last.end:
+            if activation.end > last.end:
+                merged[-1] = Activation(last.region, last.start, activation.end,
+                                        last.lower, last.lower_ref, last.upper, last.upper_ref)
+            continue
+        merged.append(activation)
+    return sorted(merged, key=lambda a: (a.region, a.start, a.end))
+
+
+class ActivationIndex:
+    # Интервальный индекс активаций: отсортированы по началу, плюс максимальная длительность,
+    # поэтому запрос "что активно в момент T / в окне" — bisect и просмотр только кандидатов
+    def __init__(self, regions):
+        self.activations = sorted(
+            (activation for activations in regions.values() for activation in activations),
+            key=lambda a: _activation_minutes(a))
+        self.bounds = [_activation_minutes(activation) for activation in self.activations]
+        self.starts = [start for start, _ in self.bounds]
+        self.max_duration = max((end - start for start, end in self.bounds), default=0)
+
+    @staticmethod
+    def _to_minutes(moment):
+        if isinstance(moment, (datetime, dt_time)):
+            return moment.hour * 60 + moment.minute
+        if isinstance(moment, str):
+            return _parse_minutes(moment)
+        return moment
+
+    def active_during(self, start, end):
+        # Активации, пересекающие окно [start, end); окно через полночь переносится на следующие сутки
+        start, end = self._to_minutes(start), self._to_minutes(end)
+        if end <= start:
+            end += 24 * 60
+        # dict вместо списка: проверка повтора за O(1), порядок находок сохраняется
+        found = {}
+        for window_start, window_end in ((start, end), (start + 24 * 60, end + 24 * 60)):
+            low = bisect.bisect_left(self.starts, window_start - self.max_duration)
+            high = bisect.bisect_left(self.starts, window_end)
+            for position in range(low, high):
+                activation_start, activation_end = self.bounds[position]
+                if activation_end > window_start:
+                    found.setdefault(self.activations[position])
+        return list(found)
+
+    def active_at(self, moment):
+        minute = self._to_minutes(moment)
+        return self.active_during(minute, minute + 1)
+
+    def regions_at(self, moment):
+        return sorted(set(activation.region for activation in self.active_at(moment)))
+
+    def regions_during(self, start, end):
+        return sorted(set(activation.region for activation in self.active_during(start, end)))
+
+
+def _activation_parts(item):
+    # Описание можно заполнить как записями Activation, так и старыми строками "time|alt"
+    if isinstance(item, Activation):
+        return item.time_display(), item.altitude_display()
+    time_part, alt_part = item.split('|', 1)
+    return time_part, alt_part
+
+
+def _parse_minutes(value):
+    hours, minutes = value.split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+def parse_eaup_records(html, prefixes, engine=None, row_state=None):
+    # row_state (EaupRowState) — разбирать только строки, изменившиеся с прошлого выпуска
+    with METRICS.stage("parse"):
+        if row_state is not None:
+            return _parse_eaup_records_delta(html, prefixes, row_state, engine)
+        return _parse_eaup_records(html, prefixes, engine)
+
+
+def _parse_eaup_records(html, prefixes, engine=None):
+    # Один проход по таблице для нескольких FIR: {"LP": {"d10": [Activation, ...]}, "LE": {...}}
+    engine = _resolve_html_engine(engine)
+    prefixes = tuple(prefix.upper() for prefix in prefixes)
+    skip_names = set(name.upper() for name in SKIP_NAMES)
+
+    print('🔍Founded regions:')
+    records = []
+    rows_scanned = 0
+    for row_text in HTML_ENGINES[engine](html):
+        rows_scanned += 1
+        record = _parse_eaup_row(row_text, prefixes, skip_names)
+        if record is not None:
+            records.append(record)
+    METRICS.count("rows_scanned", rows_scanned)
+    METRICS.count("rows_matched", len(records))
+    return _regions_from_records(records, prefixes)
+
+
+def _parse_eaup_row(row_text, prefixes, skip_names):
+    # Одна строка таблицы -> (FIR, имя области как в таблице, Activation) или None
+    name_match = region_name_re(prefixes).search(row_text)
+    if not name_match:
+        return None
+    region_name = name_match.group(1).upper()
+    if region_name in skip_names:
+        return None
+    times = TIME_RE.findall(row_text)
+    if len(times) > 4 or len(times) < 2:
+        return None
+    raw_levels = LEVEL_RE.findall(row_text)
+    altitudes = []
+    for val in raw_levels:
+        val = val.upper()
+        if val == 'SFC' or val == 'GND':
+            val = 0
+        else:
+            val = int(val)
+        altitudes.append(val)
+    clean_alts = altitudes[:2]
+    lower = lower_ref = upper = upper_ref = None
+    if len(clean_alts) == 1:
+        upper, upper_ref = clean_alts[0], Activation.level_ref(clean_alts[0], True)
+    elif clean_alts:
+        lower, lower_ref = clean_alts[0], Activation.level_ref(clean_alts[0], False)
+        upper, upper_ref = clean_alts[1], Activation.level_ref(clean_alts[1], True)
+
+    prefix = next(p for p in sorted(prefixes, key=len, reverse=True) if region_name.startswith(p))
+    clean_region_name = sys.intern(region_name[len(prefix):].lower().replace('-', '').strip())
+    activation = Activation(clean_region_name, _parse_minutes(times[0]), _parse_minutes(times[1]),
+                            lower, lower_ref, upper, upper_ref)
+    return prefix, region_name, activation
+
+
+def _regions_from_records(records, prefixes, verbose=True):
+    # Записи строк по порядку таблицы -> регионы, одинаковые строки учитываются один раз
+    seen_records = set()
+    parsed_regions = {prefix: dict() for prefix in prefixes}
+    for prefix, region_name, activation in records:
+        record_key = (region_name,) + activation.key()[1:]
+        if record_key not in seen_records:
+            seen_records.add(record_key)
+            if verbose:
+                if len(prefixes) > 1:
+                    print('', prefix, activation.region+' ', activation, sep='\t')
+                else:
+                    print('', activation.region+' ', activation, sep='\t')
+            parsed_regions[prefix].setdefault(activation.region, []).append(activation)
+    for regions in parsed_regions.values():
+        for region, activations in regions.items():
+            if len(activations) > 1:
+                regions[region] = merge_activations(activations)
+    METRICS.count("activations", len(seen_records))
+    METRICS.count("regions", sum(len(regions) for regions in parsed_regions.values()))
+    return parsed_regions
+
+
+# Строки <tr> в исходном HTML, без разбора: для сравнения выпусков по строкам
+TABLE_ROW_RE = re.compile(r'<tr\b.*?</tr\s*>', flags=re.IGNORECASE | re.DOTALL)
+TABLE_ROW_START_RE = re.compile(r'<tr\b', flags=re.IGNORECASE)
+HIDDEN_HTML_RE = re.compile(r'<!--.*?-->|<(script|style)\b.*?</\1\s*>', flags=re.IGNORECASE | re.DOTALL)
+
+
+def split_table_rows(html):
+    # HTML строк <tr> как есть; None, если надёжно разбить нельзя (вложенные таблицы, незакрытые <tr>)
+    html = HIDDEN_HTML_RE.sub('', html)
+    rows = TABLE_ROW_RE.findall(html)
+    if len(rows) != len(TABLE_ROW_START_RE.findall(html)):
+        return None
+    return rows
+
+
+class EaupRowState:
+    # Последний разобранный выпуск по строкам: отпечаток HTML строки -> запись _parse_eaup_row (или None).
+    # Следующий выпуск (UUP) разбирает только строки, которых в прошлом не было
+    def __init__(self):
+        self.settings = None
+        self.table = None
+        self.order = []
+        self.records = {}
+        # {FIR: области, изменившиеся в последнем разборе} или None
+        self.changed = None
+
+    @staticmethod
+    def current_settings(prefixes, engine):
+        return tuple(prefixes), engine, tuple(sorted(name.upper() for name in SKIP_NAMES))
+
+
+def _row_fingerprint(row):
+    return hashlib.blake2b(row.encode('utf-8'), digest_size=16).digest()
+
+
+def _region_rows(order, records):
+    # {(FIR, область): [Activation в порядке строк таблицы]}
+    regions = {}
+    for fingerprint in order:
+        if records[fingerprint] is not None:
+            prefix, _, activation = records[fingerprint]
+            regions.setdefault((prefix, activation.region), []).append(activation)
+    return regions
+
+
+def _parse_eaup_records_delta(html, prefixes, state, engine=None):
+    # Разбор выпуска относительно state: новые строки разбираются, неизменные берутся из state, исчезнувшие удаляются.
+    # В state.changed остаётся {FIR: множество изменившихся областей}, или None,
+    # если сравнивать было не с чем и таблица разобрана целиком
+    engine = _resolve_html_engine(engine)
+    prefixes = tuple(prefix.upper() for prefix in prefixes)
+    settings = EaupRowState.current_settings(prefixes, engine)
+    comparable = state.settings == settings
+    rows = split_table_rows(html)
+    if rows is not None:
+        fingerprints = [_row_fingerprint(row) for row in rows]
+        known = state.records if comparable else {}
+        new_rows = dict((fingerprint, row) for fingerprint, row in zip(fingerprints, rows)
+                        if fingerprint not in known)
+        # Новые строки разбираются одной маленькой таблицей тем же движком
+        row_texts = list(HTML_ENGINES[engine]("<table>" + "".join(new_rows.values()) + "</table>"))
+        if len(row_texts) != len(new_rows):
+            rows = None
+    if rows is None:
+        state.__init__()
+        return _parse_eaup_records(html, prefixes, engine)
+
+    skip_names = set(name.upper() for name in SKIP_NAMES)
+    records = dict(known)
+    for fingerprint, row_text in zip(new_rows, row_texts):
+        records[fingerprint] = _parse_eaup_row(row_text, prefixes, skip_names)
+    current = set(fingerprints)
+    previous = set(state.order) if comparable else set()
+    # Область изменилась, если изменился список её строк, в том числе только их порядок
+    current_regions = _region_rows(fingerprints, records)
+    previous_regions = _region_rows(state.order, state.records) if comparable else {}
+    changed = {}
+    for prefix, region in current_regions.keys() | previous_regions.keys():
+        if current_regions.get((prefix, region)) != previous_regions.get((prefix, region)):
+            changed.setdefault(prefix, set()).add(region)
+
+    state.settings = settings
+    state.order = fingerprints
+    state.records = {fingerprint: records[fingerprint] for fingerprint in current}
+    state.changed = changed if comparable else None
+    METRICS.count("rows_scanned", len(new_rows))
+    METRICS.count("rows_reused", len(fingerprints) - len(new_rows))
+    matched = [records[fingerprint] for fingerprint in fingerprints if records[fingerprint] is not None]
+    METRICS.count("rows_matched", len(matched))
+    if not comparable:
+        print(f"🔍EU table: {len(rows)} rows parsed")
+        return _regions_from_records(matched, prefixes)
+
+    print(f"🔁EU table changes: {len(current - previous)} new rows, {len(previous - current)} removed, "
+          f"{len(current & previous)} unchanged")
+    regions_by_prefix = _regions_from_records(matched, prefixes, verbose=False)
+    for prefix, regions in sorted(changed.items()):
+        for region in sorted(regions):
+            activations = regions_by_prefix[prefix].get(region)
+            print('', prefix, region + ' ', ", ".join(map(str, activations)) if activations else "not active",
+                  sep='\t')
+    return regions_by_prefix
+
+
+def activations_to_strings(regions):
+    return {region: [str(activation) for activation in activations] for region, activations in regions.items()}
+
+
+def parse_eaup_html(html, engine=None, prefix=None):
+    # Разбор уже загруженной страницы AUP/UUP (из файла или прямо из HTTP ответа)
+    if prefix is None:
+        prefix = ICAO_PREFIXES[0]
+    return parse_eaup_html_multi(html, (prefix,), engine)[prefix]
+
+
+def parse_eaup_html_multi(html, prefixes, engine=None):
+    # Прежний формат результата: {"LP": {"d10": ["10:00-12:00|GND/FL100"]}}
+    return {prefix: activations_to_strings(regions)
+            for prefix, regions in parse_eaup_records(html, prefixes, engine).items()}
+
+
+class EaupCache:
+    # Кэш скачанных таблиц AUP/UUP: "<время выпуска>_<sha256>.htm" и рядом разобранные регионы в pickle.
+    # last_run.json хранит, из чего был собран последний OUTPUT_KML
+    LAST_RUN_FILE = "last_run.json"
+    # Не .pickle: evict удаляет только записи таблиц
+    ROW_STATE_FILE = "last_rows.state"
+
+    def __init__(self, directory, max_mb=200, max_age_days=30):
+        self.directory = directory
+        self.max_bytes = max_mb * 1024 * 1024 if max_mb else None
+        self.max_age = max_age_days * 24 * 3600 if max_age_days else None
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def entry_key(html_code, release_label=None):
+        digest = hashlib.sha256(html_code.encode('utf-8')).hexdigest()[:16]
+        if release_label:
+            stamp = datetime.strptime(release_label, '%d/%m/%Y %H:%M').strftime('%Y%m%d%H%M')
+        else:
+            stamp = "unknown"
+        return f"{stamp}_{digest}"
+
+    def _path(self, key, extension):
+        return os.path.join(self.directory, key + extension)
+
+    def put(self, html_code, release_label=None):
+        key = self.entry_key(html_code, release_label)
+        path = self._path(key, ".htm")
+        if not os.path.exists(path):
+            with open_output(path, atomic=True) as f:
+                f.write(html_code.encode('utf-8'))
+        return key
+
+    def load_regions(self, key):
+        try:
+            with open(self._path(key, ".pickle"), 'rb') as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def store_regions(self, key, regions):
+        with open_output(self._path(key, ".pickle"), atomic=True) as f:
+            pickle.dump(regions, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load_row_state(self):
+        try:
+            with open(os.path.join(self.directory, self.ROW_STATE_FILE), 'rb') as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            return EaupRowState()
+
+    def store_row_state(self, row_state):
+        with open_output(os.path.join(self.directory, self.ROW_STATE_FILE), atomic=True) as f:
+            pickle.dump(row_state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def last_run(self):
+        try:
+            with open(os.path.join(self.directory, self.LAST_RUN_FILE), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save_last_run(self, state):
+        with open(os.path.join(self.directory, self.LAST_RUN_FILE), "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False, indent=4)
+
+    def evict(self, keep=()):
+        # Сначала удаляем устаревшие записи, потом самые старые, пока кэш не влезет в лимит
+        entries = {}
+        for file_name in os.listdir(self.directory):
+            key, extension = os.path.splitext(file_name)
+            if extension not in (".htm", ".pickle"):
+                continue
+            stat = os.stat(os.path.join(self.directory, file_name))
+            size, mtime = entries.get(key, (0, 0))
+            entries[key] = (size + stat.st_size, max(mtime, stat.st_mtime))
+
+        now = time.time()
+        total = sum(size for size, _ in entries.values())
+        removed = 0
+        for key, (size, mtime) in sorted(entries.items(), key=lambda item: item[1][1]):
+            expired = self.max_age is not None and now - mtime > self.max_age
+            oversized = self.max_bytes is not None and total > self.max_bytes
+            if key in keep or not (expired or oversized):
+                continue
+            for extension in (".htm", ".pickle"):
+                if os.path.exists(self._path(key, extension)):
+                    os.remove(self._path(key, extension))
+            total -= size
+            removed += 1
+        return removed
+
+
+# --- ИСТОРИЯ АКТИВАЦИЙ ---
+# Время выпуска в имени архивного файла: 202602261400_<sha>.htm (как в кэше), 2026-02-26 14:00.htm и т.п.
+RELEASE_STAMP_RE = re.compile(r'(?<!\d)(\d{4})-?(\d{2})-?(\d{2})[T_ .-]?(\d{2})[:h.-]?(\d{2})(?!\d)')
+HISTORY_RELEASE_FORMAT = '%Y-%m-%d %H:%M'
+HISTORY_BATCH = 100
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    release TEXT NOT NULL,
+    sha256 TEXT NOT NULL UNIQUE,
+    source TEXT
+);
+CREATE INDEX IF NOT EXISTS snapshots_release ON snapshots (release);
+CREATE TABLE IF NOT EXISTS activations (
+    snapshot_id INTEGER NOT NULL REFERENCES snapshots (id),
+    release TEXT NOT NULL,
+    prefix TEXT NOT NULL,
+    region TEXT NOT NULL,
+    start_minute INTEGER NOT NULL,
+    end_minute INTEGER NOT NULL,
+    lower INTEGER,
+    lower_ref TEXT,
+    upper INTEGER,
+    upper_ref TEXT
+);
+CREATE INDEX IF NOT EXISTS activations_region ON activations (prefix, region, release);
+CREATE INDEX IF NOT EXISTS activations_release ON activations (release);
+"""
+
+
+def snapshot_release(path):
+    # Время выпуска из имени файла, иначе — время изменения файла
+    match = RELEASE_STAMP_RE.search(os.path.basename(path))
+    if match:
+        try:
+            return datetime(*(int(value) for value in match.groups()), tzinfo=timezone.utc)
+        except ValueError:
+            pass
+    return datetime.fromtimestamp(os.path.getmtime(path), timezone.utc).replace(second=0, microsecond=0)
+
+
+def history_rows(regions_by_prefix):
+    # {"LP": {"d10": [Activation, ...]}} -> кортежи для activations, без объектов (их дешевле передавать из пула)
+    return [(prefix, activation.region, activation.start, activation.end, activation.lower, activation.lower_ref,
+             activation.upper, activation.upper_ref)
+            for prefix, regions in regions_by_prefix.items()
+            for activations in regions.values() for activation in activations]
+
+
+def history_region_key(name, prefixes=None):
+    # "LP-D10" -> ("LP", "d10"), как в _parse_eaup_records; без префикса FIR -> (None, "d10")
+    name = name.strip().upper()
+    for prefix in sorted(prefixes or set(ICAO_PREFIXES) | set(job_prefixes(kml_jobs())), key=len, reverse=True):
+        if name.startswith(prefix):
+            return prefix, name[len(prefix):].lower().replace('-', '').strip()
+    return None, name.lower().replace('-', '')
+
+
+def _history_range(since=None, until=None):
+    # Даты "YYYY-MM-DD" -> условие по release, until включительно
+    conditions, parameters = [], []
+    if since:
+        conditions.append("release >= ?")
+        parameters.append(datetime.strptime(since, '%Y-%m-%d').strftime(HISTORY_RELEASE_FORMAT))
+    if until:
+        conditions.append("release < ?")
+        parameters.append((datetime.strptime(until, '%Y-%m-%d') + timedelta(days=1)).strftime(HISTORY_RELEASE_FORMAT))
+    return conditions, parameters
+
+
+class HistoryStore:
+    # История активаций в SQLite: снимок таблицы AUP/UUP (время выпуска, sha256 HTML) и его активации.
+    # Снимок с тем же sha256 второй раз не добавляется; запросы идут по индексам, без разбора HTML
+    def __init__(self, path=None):
+        self.path = path or HISTORY_DB
+        self.connection = sqlite3.connect(self.path)
+        self.connection.executescript(HISTORY_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def known_snapshots(self):
+        return set(sha256 for sha256, in self.connection.execute("SELECT sha256 FROM snapshots"))
+
+    def add_snapshots(self, snapshots):
+        # snapshots: [(release datetime, sha256, source, history_rows)], всё одной транзакцией
+        added = 0
+        with self.connection:
+            for release, sha256, source, rows in snapshots:
+                release_text = release.strftime(HISTORY_RELEASE_FORMAT)
+                cursor = self.connection.execute(
+                    "INSERT OR IGNORE INTO snapshots (release, sha256, source) VALUES (?, ?, ?)",
+                    (release_text, sha256, source))
+                if not cursor.rowcount:
+                    continue
+                self.connection.executemany(
+                    "INSERT INTO activations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(cursor.lastrowid, release_text) + row for row in rows])
+                added += 1
+        METRICS.count("history_snapshots", added)
+        return added
+
+    def region_history(self, region, prefix=None, since=None, until=None):
+        # [(время выпуска, Activation)] одной области, по порядку
+        conditions, parameters = _history_range(since, until)
+        conditions.insert(0, "region = ?")
+        parameters.insert(0, region)
+        if prefix:
+            conditions.append("prefix = ?")
+            parameters.append(prefix)
+        query = ("SELECT release, region, start_minute, end_minute, lower, lower_ref, upper, upper_ref "
+                 "FROM activations WHERE " + " AND ".join(conditions) + " ORDER BY release, start_minute")
+        return [(row[0], Activation(*row[1:])) for row in self.connection.execute(query, parameters)]
+
+    def stats(self, since=None, until=None):
+        # По каждой области: в скольких выпусках была активна, число активаций, суммарные часы, первый/последний выпуск
+        conditions, parameters = _history_range(since, until)
+        where = (" WHERE " + " AND ".join(conditions)) if conditions else ""
+        total = self.connection.execute("SELECT COUNT(*), MIN(release), MAX(release) FROM snapshots" + where,
+                                        parameters).fetchone()
+        regions = [{
+            "prefix": prefix, "region": region, "releases": releases, "activations": activations,
+            "hours": round(minutes / 60, 1), "first": first, "last": last,
+        } for prefix, region, releases, activations, minutes, first, last in self.connection.execute(
+            "SELECT prefix, region, COUNT(DISTINCT snapshot_id), COUNT(*), "
+            "SUM(CASE WHEN end_minute > start_minute THEN end_minute - start_minute "
+            "ELSE end_minute + 1440 - start_minute END), MIN(release), MAX(release) "
+            "FROM activations" + where + " GROUP BY prefix, region ORDER BY 5 DESC, 1, 2", parameters)]
+        return {"releases": total[0], "first": total[1], "last": total[2], "regions": regions}
+
+
+def _parse_snapshot(path, prefixes):
+    # В процессе пула: разбор одного архивного снимка, список найденных регионов не печатается
+    with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+        html = f.read()
+    with contextlib.redirect_stdout(io.StringIO()):
+        return history_rows(_parse_eaup_records(html, prefixes))
+
+
+def ingest_history(directory, store, workers=None, prefixes=None):
+    # Загрузка архива таблиц: хэши считаются здесь, уже известные снимки не разбираются,
+    # новые разбираются пулом процессов и пишутся в базу пачками по HISTORY_BATCH
+    if prefixes is None:
+        prefixes = job_prefixes(kml_jobs())
+    paths = sorted(os.path.join(directory, file_name) for file_name in os.listdir(directory)
+                   if file_name.lower().endswith((".htm", ".html")))
+    known = store.known_snapshots()
+    pending = []
+    for path in paths:
+        sha256 = _file_sha256(path)
+        if sha256 not in known:
+            known.add(sha256)
+            pending.append((path, sha256))
+    print(f"🗄️{len(pending)} new EU tables of {len(paths)} in '{directory}'")
+    if not pending:
+        return 0
+
+    workers = min(len(pending), workers or BATCH_WORKERS or os.cpu_count() or 1)
+    tasks = [path for path, _ in pending]
+    added = 0
+    with METRICS.stage("history_ingest"), contextlib.ExitStack() as stack:
+        if workers > 1:
+            pool = stack.enter_context(concurrent.futures.ProcessPoolExecutor(max_workers=workers, **_pool_config()))
+            results = pool.map(_parse_snapshot, tasks, [prefixes] * len(tasks),
+                               chunksize=max(1, len(tasks) // (workers * 4)))
+        else:
+            results = map(_parse_snapshot, tasks, [prefixes] * len(tasks))
+        batch = []
+        for (path, sha256), rows in zip(pending, results):
+            batch.append((snapshot_release(path), sha256, os.path.basename(path), rows))
+            if len(batch) >= HISTORY_BATCH:
+                added += store.add_snapshots(batch)
+                batch = []
+        added += store.add_snapshots(batch)
+    print(f"✅{added} EU tables added to '{store.path}'")
+    return added
+
+
+def record_history(html_code, release_label, regions_by_prefix):
+    # HISTORY_RECORD: каждая обработанная таблица попадает в историю; без метки выпуска — текущее время
+    if release_label:
+        release = datetime.strptime(release_label, '%d/%m/%Y %H:%M').replace(tzinfo=timezone.utc)
+    else:
+        release = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    store = HistoryStore()
+    try:
+        store.add_snapshots([(release, hashlib.sha256(html_code.encode('utf-8')).hexdigest(), release_label,
+                              history_rows(regions_by_prefix))])
+    finally:
+        store.close()
+
+
+def _config_sha256():
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def process_table(html_code, release_label=None, atomic=False, databases=None):
+    # Разбор таблицы и сборка KML, с пропуском работы, если таблица, база и настройки не менялись.
+    # databases: OUTPUT_KML -> результат preload_database
+    METRICS.add_bytes("html_parsed", len(html_code.encode('utf-8')))
+    if not CACHE_DIR:
+        regions_by_prefix = parse_eaup_records(html_code, job_prefixes(kml_jobs()))
+        if HISTORY_RECORD:
+            record_history(html_code, release_label, regions_by_prefix)
+        write_outputs(regions_by_prefix, atomic=atomic, databases=databases)
+        return True
+
+    cache = EaupCache(CACHE_DIR, CACHE_MAX_MB, CACHE_MAX_AGE_DAYS)
+    key = cache.put(html_code, release_label)
+    jobs = kml_jobs()
+    state = {
+        "table": key,
+        "input_kml": {job["INPUT_KML"]: _file_sha256(job["INPUT_KML"]) for job in jobs},
+        "config": _config_sha256(),
+        "output_kml": [job["OUTPUT_KML"] for job in jobs],
+        # С TIME_SPANS файл зависит и от даты
+        "day": str(time_spans_day()) if TIME_SPANS else None,
+    }
+    last_run = cache.last_run()
+    if last_run == state and all(os.path.exists(path) for job in jobs for path in job_output_paths(job)):
+        print("♻️EU table, database and config didn't change since last run, output is up to date")
+        METRICS.count("runs_skipped")
+        return False
+
+    prefixes = job_prefixes(jobs)
+    changed = None
+    row_state = cache.load_row_state() if ROW_DELTA else None
+    regions_by_prefix = cache.load_regions(key)
+    if regions_by_prefix is None or not all(prefix in regions_by_prefix for prefix in prefixes):
+        if ROW_DELTA:
+            previous_table = row_state.table
+            regions_by_prefix = parse_eaup_records(html_code, prefixes, row_state=row_state)
+            # Изменения относятся к последним файлам, только если они собраны из прошлой таблицы state
+            if last_run is not None and previous_table == last_run["table"] and \
+                    all(last_run.get(name) == state[name] for name in state if name != "table"):
+                changed = row_state.changed
+            row_state.table = key
+        else:
+            regions_by_prefix = parse_eaup_records(html_code, prefixes)
+        cache.store_regions(key, regions_by_prefix)
+    else:
+        METRICS.count("cache_hits")
+        print(f"♻️Using parsed regions from cache '{key}'")
+    if HISTORY_RECORD:
+        record_history(html_code, release_label, regions_by_prefix)
+    write_outputs(regions_by_prefix, atomic=atomic, databases=databases,
+                  changed_prefixes=None if changed is None else set(changed))
+    if row_state is not None and row_state.table == key:
+        cache.store_row_state(row_state)
+    cache.save_last_run(state)
+    cache.evict(keep=(key,))
+    return True
+
+
+def time_spans_day():
+    # Сутки, к которым привязываются <TimeSpan>: "today", "tomorrow" или "YYYY-MM-DD"
+    today = datetime.now(timezone.utc).date()
+    if TIME_SPAN_DAY in (None, "today"):
+        return today
+    if TIME_SPAN_DAY == "tomorrow":
+        return today + timedelta(days=1)
+    return datetime.strptime(TIME_SPAN_DAY, '%Y-%m-%d').date()
+
+
+def kml_jobs():
+    # Без JOBS в конфиге — одна база INPUT_KML -> OUTPUT_KML для первого префикса ICAO_PREFIXES
+    if not JOBS:
+        jobs = [{"INPUT_KML": INPUT_KML, "OUTPUT_KML": OUTPUT_KML, "PREFIX": ICAO_PREFIXES[0],
+                 "FULL_COPY": FULL_COPY, "BAN_WORDS": BAN_WORDS, "OUTPUTS": []}]
+    else:
+        jobs = [{
+            "INPUT_KML": job["INPUT_KML"],
+            "OUTPUT_KML": job["OUTPUT_KML"],
+            "PREFIX": job["PREFIX"].upper(),
+            "FULL_COPY": job.get("FULL_COPY", []),
+            "BAN_WORDS": job.get("BAN_WORDS", BAN_WORDS),
+            "OUTPUTS": [output_sink(spec) for spec in job.get("OUTPUTS", [])],
+        } for job in JOBS]
+    # Общие OUTPUTS собираются из базы первой задачи или первой задачи своего "PREFIX"
+    for spec in OUTPUTS:
+        prefix = spec.get("PREFIX") if isinstance(spec, dict) else None
+        job = next((job for job in jobs if prefix is None or job["PREFIX"] == prefix.upper()), None)
+        if job is None:
+            raise ValueError(f"No job with PREFIX '{prefix}' for output '{spec['PATH']}'")
+        job["OUTPUTS"].append(output_sink(spec))
+    return jobs
+
+
+def job_prefixes(jobs):
+    return tuple(dict.fromkeys(job["PREFIX"] for job in jobs))
+
+
+def job_output_paths(job):
+    # Все файлы задачи: OUTPUT_KML, выходы OUTPUTS и, с DELTA_KML, файлы обновлений
+    paths = [job["OUTPUT_KML"]] + [sink["PATH"] for sink in job["OUTPUTS"]]
+    if DELTA_KML:
+        paths += kml_delta_paths(job["OUTPUT_KML"]).values()
+    return paths
+
+
+def run_kml_job(job, regions_dict, atomic=False, database=None):
+    # Выполняется в отдельном процессе: одна база KML -> один выходной файл
+    time_span_day = time_spans_day() if TIME_SPANS else None
+    if database is None:
+        database = {}
+    if job["OUTPUTS"]:
+        if STREAMING_KML:
+            print("⚠️OUTPUTS are rendered from the whole database, STREAMING_KML is ignored")
+        name_index = database.get("name_index")
+        if name_index is None and NAME_INDEX:
+            name_index = load_name_index(job["INPUT_KML"], job["BAN_WORDS"])
+        render_outputs(job["INPUT_KML"], [output_sink(job["OUTPUT_KML"])] + job["OUTPUTS"], job["FULL_COPY"],
+                       regions_dict, name_index, atomic=atomic, ban_words=job["BAN_WORDS"],
+                       time_span_day=time_span_day, tree=database.get("tree"))
+    elif STREAMING_KML:
+        process_ge_pro_kml_stream(job["INPUT_KML"], job["OUTPUT_KML"], job["FULL_COPY"], regions_dict,
+                                  atomic=atomic, ban_words=job["BAN_WORDS"], time_span_day=time_span_day)
+    else:
+        name_index = database.get("name_index")
+        if name_index is None and NAME_INDEX:
+            name_index = load_name_index(job["INPUT_KML"], job["BAN_WORDS"])
+        process_ge_pro_kml(job["INPUT_KML"], job["OUTPUT_KML"], job["FULL_COPY"], regions_dict, name_index,
+                           atomic=atomic, ban_words=job["BAN_WORDS"], time_span_day=time_span_day,
+                           tree=database.get("tree"))
+    if DELTA_KML:
+        with METRICS.stage("kml_delta"):
+            write_kml_delta(job["OUTPUT_KML"], atomic=atomic)
+    return job["OUTPUT_KML"]
+
+
+def _run_kml_job_in_worker(job, regions_dict, atomic=False):
+    # В процессе пула свои METRICS: отдаём их вместе с результатом, чтобы сложить в основном процессе
+    METRICS.reset()
+    output_path = run_kml_job(job, regions_dict, atomic)
+    return output_path, METRICS.as_dict()
+
+
+def kml_workers(jobs):
+    return min(len(jobs), BATCH_WORKERS or os.cpu_count() or 1)
+
+
+def preload_database(job, keep_tree=True):
+    # Подготовка базы KML, пока скачивается таблица: разбор, индекс имён и компиляция шаблонов описаний.
+    # Дерево нельзя передать в процесс пула, поэтому оно сохраняется только для сборки в этом процессе.
+    # Индекс со смещениями меток заменяет разбор: после загрузки таблицы разбираются только активные метки
+    with METRICS.stage("kml_preload"):
+        if NAME_INDEX and os.path.exists(name_index_path(job["INPUT_KML"])):
+            name_index = load_name_index(job["INPUT_KML"], job["BAN_WORDS"])
+            if name_index.get("placemark_ranges"):
+                return {"tree": None, "name_index": name_index}
+        parser = etree.XMLParser(remove_blank_text=True, recover=True)
+        with open_kml_input(job["INPUT_KML"]) as source:
+            tree = etree.parse(source, parser)
+        root = tree.getroot()
+        if NAME_INDEX:
+            name_index = load_name_index(job["INPUT_KML"], job["BAN_WORDS"], root)
+        else:
+            # Без индекса шаблоны описаний компилируются в кэш compile_description_template
+            name_index = None
+            _, folders = _find_top_folders(root)
+            for folder in folders:
+                folder_templates(folder)
+        return {"tree": tree if keep_tree else None, "name_index": name_index}
+
+
+def _pool_config():
+    # При spawn (Windows, macOS) процессы пула импортируют модуль заново со значениями по умолчанию,
+    # поэтому текущий конфиг передаётся им явно; при fork глобальные значения наследуются
+    if multiprocessing.get_start_method() != "fork":
+        return {"initializer": apply_config, "initargs": (config,)}
+    return {}
+
+
+def _output_up_to_date(job, changed_prefixes):
+    # changed_prefixes — FIR, чьи регионы изменились с прошлой таблицы (parse_eaup_records).
+    # Пропускается задача целиком: KML FIR либо не трогается, либо собирается заново, по меткам он не правится
+    if changed_prefixes is None or job["PREFIX"] in changed_prefixes or \
+            not all(map(os.path.exists, job_output_paths(job))):
+        return False
+    print(f"♻️{job['PREFIX']}: active regions didn't change, '{job['OUTPUT_KML']}' is up to date")
+    METRICS.count("jobs_skipped")
+    return True
+
+
+def write_outputs(regions_by_prefix, atomic=False, databases=None, changed_prefixes=None):
+    if databases is None:
+        databases = {}
+    if not JOBS:
+        # Без JOBS есть только одна пара INPUT_KML/OUTPUT_KML, остальные FIR из ICAO_PREFIXES не на что вывести
+        if len(ICAO_PREFIXES) > 1:
+            print(f"⚠️Without JOBS only {ICAO_PREFIXES[0]} is written to '{OUTPUT_KML}', "
+                  f"{', '.join(ICAO_PREFIXES[1:])} ignored: add a job per prefix to JOBS")
+        if not _output_up_to_date(kml_jobs()[0], changed_prefixes):
+            write_active_regions(regions_by_prefix[ICAO_PREFIXES[0]], atomic=atomic,
+                                 database=databases.get(OUTPUT_KML))
+        return
+
+    jobs = [job for job in kml_jobs() if regions_by_prefix.get(job["PREFIX"])]
+    for job in kml_jobs():
+        if not regions_by_prefix.get(job["PREFIX"]):
+            print(f"\033[31m{job['PREFIX']}: regions for update didn't found\033[0m, '{job['OUTPUT_KML']}' didn't created")
+    jobs = [job for job in jobs if not _output_up_to_date(job, changed_prefixes)]
+    if not jobs:
+        return
+    for job in jobs:
+        print(f"🗺️{job['PREFIX']}: '{job['INPUT_KML']}' -> '{job['OUTPUT_KML']}'")
+    workers = kml_workers(jobs)
+    if workers == 1:
+        for job in jobs:
+            run_kml_job(job, regions_by_prefix[job["PREFIX"]], atomic, databases.get(job["OUTPUT_KML"]))
+            print(f"✅Saved in '{job['OUTPUT_KML']}'.")
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, **_pool_config()) as pool:
+        futures = [pool.submit(_run_kml_job_in_worker, job, regions_by_prefix[job["PREFIX"]], atomic)
+                   for job in jobs]
+        for future in concurrent.futures.as_completed(futures):
+            output_path, job_metrics = future.result()
+            METRICS.merge(job_metrics)
+            print(f"✅Saved in '{output_path}'.")
+
+
+def write_active_regions(lp_regions, atomic=False, database=None):
+    if not lp_regions:
+        print("\033[31mRegions for update didn't found, KML didn't created, try later")
+        return
+    print(f"🔍Founded {len(lp_regions)} active regions in European AUP/UUP.")
+    run_kml_job(kml_jobs()[0], lp_regions, atomic, database)
+    print(f"✅Saved in '{OUTPUT_KML}'.")
+
+
+def write_traceback():
+    tb = traceback.format_exc()
+    print(f"\n\033[31mAn unexpected error occurred\033[0m. Traceback written to '{TRACEBACK_FILE}'.")
+    with open(TRACEBACK_FILE, 'w', encoding='utf-8') as f:
+        f.write(tb)
+    print(tb, file=sys.stderr)
+
+
+def _export_metrics(success):
+    # Сбой записи метрик не должен ронять основной процесс
+    try:
+        METRICS.export(success)
+    except OSError as e:
+        print(f"\033[31mMetrics didn't saved\033[0m: {e}")
+
+
+async def run_pipeline_async(release=None, atomic=False):
+    # Скачивание таблицы и подготовка баз KML идут одновременно: база разбирается в пуле потоков,
+    # пока браузер ждёт портал. Таблица передаётся парсеру из памяти.
+    # process_table идёт в главном потоке, когда потоки закончили: с JOBS он запускает пул процессов,
+    # а fork при работающих потоках может зависнуть на их блокировках
+    # В потоковом режиме база целиком в память не загружается, поэтому заранее её не разбираем (кроме задач с OUTPUTS)
+    jobs = [job for job in kml_jobs() if job["OUTPUTS"] or not STREAMING_KML]
+    keep_trees = kml_workers(jobs) == 1
+    loop = asyncio.get_running_loop()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(jobs), 1)) as pool:
+        preloads = [loop.run_in_executor(pool, preload_database, job, keep_trees) for job in jobs]
+        try:
+            release_label, html_code = await fetch_eaup_table_async(release)
+        except BaseException:
+            # Дожидаемся потоков, чтобы их ошибки не потерялись молча
+            await asyncio.gather(*preloads, return_exceptions=True)
+            raise
+        databases = dict(zip((job["OUTPUT_KML"] for job in jobs), await asyncio.gather(*preloads)))
+    save_html_table(html_code)
+    process_table(html_code, release_label, atomic, databases)
+    return release_label
+
+
+def make_fetcher():
+    if use_http_backend():
+        return HttpEaupFetcher()
+    return BrowserEaupFetcher()
+
+
+def watch(interval=None, fetcher=None, cycles=None):
+    # Режим демона: один браузер/HTTP сессия на всё время работы,
+    # KML пересобирается только при появлении нового выпуска AUP/UUP
+    if interval is None:
+        interval = WATCH_INTERVAL
+    if fetcher is None:
+        fetcher = make_fetcher()
+    last_release = None
+    cycle = 0
+    print(f"👀Watching for new EU tables every {interval} s, press Ctrl+C to stop")
+    try:
+        while cycles is None or cycle < cycles:
+            cycle += 1
+            METRICS.reset()
+            success = False
+            try:
+                try:
+                    releases = fetcher.releases()
+                except (OSError, RuntimeError, ValueError, http.client.HTTPException) as e:
+                    if not isinstance(fetcher, HttpEaupFetcher):
+                        raise
+                    # Как и в разовом запуске: если HTTP не сработал, переходим на браузер
+                    print(f"❌HTTP download failed ({e}), switching to browser")
+                    fetcher.close()
+                    fetcher = BrowserEaupFetcher()
+                    releases = fetcher.releases()
+                release = select_eaup_release(releases, EAUP_RELEASE)
+                release_key = (release["label"], release["kind"])
+                if release_key == last_release:
+                    print(f"💤No new EU table, latest is still {release['label']} {release['kind']}".rstrip())
+                else:
+                    html_code = fetcher.fetch(release)
+                    with open(HTML_FILE, "w", encoding="utf-8") as f:
+                        f.write(html_code)
+                    process_table(html_code, release["label"], atomic=True)
+                    last_release = release_key
+                success = True
+            except (Exception, SystemExit):
+                # Ошибка одного цикла не должна останавливать демон
+                write_traceback()
+            _export_metrics(success)
+            if cycles is None or cycle < cycles:
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        print("\n\033[32mWatching stopped\033[0m")
+    finally:
+        fetcher.close()
+
+
+def read_html_table(path=None):
+    path = path or HTML_FILE
+    print(f"🔧Start parsing '{path}'...")
+    try:
+        with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+            return f.read()
+    except FileNotFoundError:
+        print(f"File '{path}' didn't found, check the file name with database, it must be called '{path}'")
+        sys.exit(1)
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(
+        prog="UpdatePortugalAUPUUP.py",
+        description="Keep only the areas active in the European AUP/UUP in the Google Earth database.")
+    parser.add_argument("--config", default=CONFIG_FILE, help="config file, created with defaults if missing")
+    # Старый флаг режима наблюдения, то же что команда watch
+    parser.add_argument("--watch", action="store_true", help=argparse.SUPPRESS)
+    commands = parser.add_subparsers(dest="command", metavar="command")
+
+    fetch = commands.add_parser("fetch", help="download the AUP/UUP table to HTML_FILE")
+    fetch.add_argument("--release", help='table to download, "dd/mm/YYYY HH:MM" (the newest by default)')
+
+    parse = commands.add_parser("parse", help="parse the downloaded table and print active regions")
+    parse.add_argument("--html", help="table to parse instead of HTML_FILE")
+    parse.add_argument("--json", help="also save the regions to this JSON file")
+
+    render = commands.add_parser("render", help="build OUTPUT_KML from the downloaded table, without network")
+    render.add_argument("--html", help="table to use instead of HTML_FILE")
+
+    run = commands.add_parser("run", help="fetch (if IS_ONLINE) and render, the default command")
+    run.add_argument("--release", help='table to download, "dd/mm/YYYY HH:MM" (the newest by default)')
+    run.add_argument("--offline", action="store_true", help="don't download, use the table in HTML_FILE")
+
+    commands.add_parser("watch", help="keep checking the portal and rebuild the output for every new table")
+
+    query = commands.add_parser("query", help="active areas on a route or in a box, from the downloaded table")
+    query.add_argument("--html", help="table to use instead of HTML_FILE")
+    shape = query.add_mutually_exclusive_group()
+    shape.add_argument("--route", nargs="+", type=_waypoint, metavar="LAT,LON", help="route waypoints, degrees")
+    shape.add_argument("--bbox", nargs=4, type=float, metavar=("MIN_LAT", "MIN_LON", "MAX_LAT", "MAX_LON"))
+    query.add_argument("--width", type=float, default=10.0, help="corridor width along the route, NM (10)")
+    query.add_argument("--lower", type=float, help="lowest altitude of interest, ft")
+    query.add_argument("--upper", type=float, help="highest altitude of interest, ft")
+    query.add_argument("--time", help='only areas active at "HH:MM" or during "HH:MM-HH:MM" UTC')
+    query.add_argument("--json", help="save the areas to this JSON file")
+    query.add_argument("--kml", help="save the areas to this KML/KMZ file")
+
+    ingest = commands.add_parser("ingest", help="add a directory of archived AUP/UUP tables to the history database")
+    ingest.add_argument("directory", help="directory with .htm tables, release time taken from the file names")
+    ingest.add_argument("--db", help="history database instead of HISTORY_DB")
+    ingest.add_argument("--workers", type=int, help="parsing processes (all cores by default)")
+
+    history = commands.add_parser("history", help="activation history from the history database")
+    history_commands = history.add_subparsers(dest="history_command", metavar="query", required=True)
+    region = history_commands.add_parser("region", help="every activation of one area")
+    region.add_argument("name", help='area, for example "LP-D10"')
+    stats = history_commands.add_parser("stats", help="how often and how long every area was active")
+    for history_parser in (region, stats):
+        history_parser.add_argument("--db", help="history database instead of HISTORY_DB")
+        history_parser.add_argument("--from", dest="since", help="first day, YYYY-MM-DD")
+        history_parser.add_argument("--to", dest="until", help="last day, YYYY-MM-DD")
+        history_parser.add_argument("--json", help="also save the result to this JSON file")
+    return parser
+
+
+def _waypoint(value):
+    try:
+        lat, lon = (float(part) for part in value.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"waypoint must be LAT,LON, got '{value}'")
+    return lat, lon
+
+
+def _time_window(value):
+    start, _, end = value.partition('-')
+    start = _parse_minutes(start)
+    return start, _parse_minutes(end) if end else start + 1
+
+
+def run_history(args):
+    store = HistoryStore(args.db)
+    try:
+        if args.history_command == "region":
+            prefix, region = history_region_key(args.name)
+            entries = store.region_history(region, prefix, args.since, args.until)
+            print(f"📜{args.name}: {len(entries)} activations")
+            for release, activation in entries:
+                print('', release, activation, sep='\t')
+            result = [{"release": release, "time": activation.time_display(),
+                       "altitudes": ANSI_RE.sub('', activation.altitude_display()),
+                       "lower_ft": activation.lower_ft, "upper_ft": activation.upper_ft}
+                      for release, activation in entries]
+        else:
+            result = store.stats(args.since, args.until)
+            print(f"📊{result['releases']} EU tables from {result['first']} to {result['last']}")
+            for entry in result["regions"]:
+                print(f"\t{entry['prefix']} {entry['region']}\t{entry['releases']} tables\t"
+                      f"{entry['activations']} activations\t{entry['hours']} h")
+    finally:
+        store.close()
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=4, ensure_ascii=False)
+        print(f"✅Saved in '{args.json}'")
+    return result
+
+
+def run_query(args):
+    regions_by_prefix = parse_eaup_records(read_html_table(args.html), job_prefixes(kml_jobs()))
+    window = _time_window(args.time) if args.time else None
+    areas = []
+    for job in kml_jobs():
+        regions_dict = regions_by_prefix.get(job["PREFIX"], {})
+        results = query_active_areas(load_spatial_index(job["INPUT_KML"], job["BAN_WORDS"]), regions_dict,
+                                     route=args.route, width_nm=args.width, bbox=args.bbox, lower_ft=args.lower,
+                                     upper_ft=args.upper, window=window, folders_to_copy=job["FULL_COPY"])
+        print(f"🔍{job['PREFIX']}: {len(results)} active areas found")
+        for result in results:
+            print(f"\t{result['area']['name']}\t{round(result['distance_m'] / METERS_PER_NM, 1)} NM\t" +
+                  ", ".join(str(activation) for activation in result["activations"]))
+        if args.kml and results:
+            kml_path = args.kml
+            if len(kml_jobs()) > 1:
+                base, extension = os.path.splitext(args.kml)
+                kml_path = f"{base} {job['PREFIX']}{extension}"
+            regions_subset = {}
+            for result in results:
+                regions_subset.setdefault(result["area"]["key"], result["activations"])
+            process_ge_pro_kml(job["INPUT_KML"], kml_path, [], regions_subset, ban_words=job["BAN_WORDS"],
+                               atomic=True)
+            print(f"✅Saved in '{kml_path}'.")
+        areas += query_results_json(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(areas, f, indent=4, ensure_ascii=False)
+        print(f"✅Areas saved in '{args.json}'")
+    return areas
+
+
+def main(argv=None):
+    # Двойной клик по скрипту в Windows: без аргументов окно не закрывается сразу после работы
+    interactive = argv is None and len(sys.argv) == 1
+    args = build_arg_parser().parse_args(argv)
+    command = "watch" if args.watch else (args.command or "run")
+
+    global CONFIG_FILE
+    CONFIG_FILE = args.config
+    apply_config(load_config())
+    setup_logging()
+
+    if command == "watch":
+        watch()
+        return 0
+
+    success = False
+    try:
+        if command == "fetch":
+            fetch_eaup_table(args.release)
+        elif command == "query":
+            run_query(args)
+        elif command == "ingest":
+            store = HistoryStore(args.db)
+            try:
+                ingest_history(args.directory, store, args.workers)
+            finally:
+                store.close()
+        elif command == "history":
+            run_history(args)
+        elif command == "parse":
+            regions_by_prefix = parse_eaup_records(read_html_table(args.html), job_prefixes(kml_jobs()))
+            if args.json:
+                with open(args.json, "w", encoding="utf-8") as f:
+                    json.dump({prefix: activations_to_strings(regions)
+                               for prefix, regions in regions_by_prefix.items()}, f, indent=4, ensure_ascii=False)
+                print(f"✅Regions saved in '{args.json}'")
+        else:
+            online = command == "run" and IS_ONLINE and not args.offline
+            if online and ASYNC_PIPELINE:
+                asyncio.run(run_pipeline_async(args.release))
+            else:
+                release_label = None
+                if online:
+                    release_label = fetch_eaup_table(args.release)
+                process_table(read_html_table(getattr(args, "html", None)), release_label)
+            print("\n\033[32mProcess finished\033[0m, without errors.")
+        success = True
+        return 0
+    except Exception:
+        write_traceback()
+        return 1
+    finally:
+        _export_metrics(success)
+        # Записываю в переменную enter, чтобы избавиться от бага с необходимостью дважды нажимать enter
+        if interactive and sys.stdin.isatty():
+            input("\nPress enter to exit...")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
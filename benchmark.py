@@ -0,0 +1,304 @@
+import argparse
+import concurrent.futures
+import contextlib
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+from lxml import etree
+
+import UpdatePortugalAUPUUP as aup
+
+try:
+    import resource
+except ImportError:
+    # Windows: пиковый RSS процесса недоступен, остаётся только tracemalloc
+    resource = None
+
+
+# --- СИНТЕТИЧЕСКИЕ ДАННЫЕ ---
+REGION_KINDS = ("TRA", "D", "R")
+FOREIGN_PREFIXES = ("LE", "LF", "LI", "ED")
+FULL_COPY_FOLDERS = ("ALWAYS ON - NOT CHANGE AREAS LP-R (ALWAYS THE SAME)",
+                     "ALWAYS ON - DAILY NOTAM UPDATES AREAS (AS IN DAILY EMAIL AT 05H00)")
+DESCRIPTION_TEMPLATE = """AREA RESTRITA TEMPORARIA - {name}
+EXERCICIOS AEREOS
+
+EUROCONTROL FUA
+ALTITUDES (FL) XXXXft AGL/FLXXX
+RESTRITA (TIME) XX:XX-XX:XX UTC
+"""
+
+
+def region_names(count):
+    # LP-TRA1, LP-D2, LP-R3, LP-TRA4... — уникальные имена, как в базе Google Earth
+    return [f"LP-{REGION_KINDS[number % len(REGION_KINDS)]}{number}" for number in range(1, count + 1)]
+
+
+def _random_level(rng):
+    return "SFC" if rng.random() < 0.3 else f"{rng.randrange(10, 460, 5):03d}"
+
+
+def _random_slot(rng):
+    start = rng.randrange(0, 24 * 60 - 30, 15)
+    end = min(start + rng.randrange(30, 8 * 60, 15), 24 * 60 - 1)
+    return f"{start // 60:02d}:{start % 60:02d}", f"{end // 60:02d}:{end % 60:02d}"
+
+
+def make_eaup_html(rows, names, seed=0, foreign_share=0.3):
+    # Таблица AUP/UUP как на портале: зона, время, нижний/верхний уровень, плюс строки чужих FIR
+    rng = random.Random(seed)
+    lines = ['<html><head><script>var x = "<tr><td>LP-D1</td></tr>";</script></head><body><table>',
+             '<tr><th>Airspace</th><th>From</th><th>Until</th><th>Lower</th><th>Upper</th><th>Remark</th></tr>']
+    for _ in range(rows):
+        if rng.random() < foreign_share:
+            name = f"{rng.choice(FOREIGN_PREFIXES)}-{rng.choice(REGION_KINDS)}{rng.randrange(1, 999)}"
+        else:
+            name = rng.choice(names)
+        start, end = _random_slot(rng)
+        levels = sorted((_random_level(rng), _random_level(rng)), key=lambda v: -1 if v == "SFC" else int(v))
+        if rng.random() < 0.1:
+            levels = levels[1:]
+        cells = [name, start, end] + levels + [rng.choice(("", "MIL", "ACT BY NOTAM"))]
+        lines.append("<tr>" + "".join(f"<td>{cell}</td>" for cell in cells) + "</tr>")
+    lines.append('</table></body></html>')
+    return "\n".join(lines)
+
+
+def _polygon(rng, points=24):
+    lon, lat = rng.uniform(-9.5, -6.2), rng.uniform(37.0, 42.0)
+    coords = [f"{lon + 0.1 * rng.random():.12f},{lat + 0.1 * rng.random():.12f},0" for _ in range(points - 1)]
+    coords.append(coords[0])
+    return " ".join(coords)
+
+
+def make_kml_database(path, placemarks, seed=0, full_copy_share=0.1, styles=50):
+    # База в формате Google Earth Pro: стили, папки-фильтры по типам зон и папки FULL_COPY
+    rng = random.Random(seed)
+    full_copy_count = int(placemarks * full_copy_share)
+    names = region_names(placemarks - full_copy_count)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                f'<kml xmlns="{aup.KML_NS}" xmlns:gx="http://www.google.com/kml/ext/2.2">\n<Document>\n'
+                '\t<name>Synthetic Data Base</name>\n')
+        for number in range(styles):
+            f.write(f'\t<Style id="PolyStyle{number}"><LineStyle><color>ff000000</color><width>6</width>'
+                    f'</LineStyle><PolyStyle><color>99{rng.randrange(0xffffff):06x}</color></PolyStyle></Style>\n')
+
+        def write_placemark(name):
+            f.write(f'\t\t<Placemark>\n\t\t\t<name>{name}</name>\n'
+                    f'\t\t\t<description>{DESCRIPTION_TEMPLATE.format(name=name)}</description>\n'
+                    f'\t\t\t<styleUrl>#PolyStyle{rng.randrange(styles)}</styleUrl>\n'
+                    '\t\t\t<Polygon><tessellate>1</tessellate><outerBoundaryIs><LinearRing>'
+                    f'<coordinates>{_polygon(rng)}</coordinates></LinearRing></outerBoundaryIs></Polygon>\n'
+                    '\t\t</Placemark>\n')
+
+        for kind in REGION_KINDS:
+            f.write(f'\t<Folder>\n\t\t<name>ON IF ACTIVE - CHANGEABLE AREAS LP-{kind}</name>\n')
+            for name in names:
+                if name[3:].rstrip("0123456789") == kind:
+                    write_placemark(name)
+            f.write('\t</Folder>\n')
+        for number, folder_name in enumerate(FULL_COPY_FOLDERS):
+            f.write(f'\t<Folder>\n\t\t<name>{folder_name}</name>\n')
+            for pm_number in range(number, full_copy_count, len(FULL_COPY_FOLDERS)):
+                write_placemark(f"ALWAYS ON {pm_number}")
+            f.write('\t</Folder>\n')
+        f.write('</Document>\n</kml>\n')
+    return names
+
+
+# --- ЗАМЕРЫ ---
+def _reset_peak_rss():
+    # Linux: "5" в clear_refs сбрасывает VmHWM до текущего RSS. ru_maxrss так не сбросить,
+    # и он переживает exec, поэтому даже новый процесс наследует пик родителя
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдаёт килобайты, macOS — байты
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _measure_memory(func, args, kwargs, prepare=None):
+    # Выполняется в отдельном процессе. Перед этапом VmHWM сбрасывается через /proc/self/clear_refs,
+    # поэтому VmHWM после него — пик именно этого этапа, вместе с памятью libxml2, которую tracemalloc не видит.
+    # Без /proc (не Linux) берётся ru_maxrss: пик с запуска процесса, сбросить его нельзя, поэтому этап виден,
+    # только если превысил память запуска и подготовки (prepare).
+    # tracemalloc (только объекты Python) — вторым прогоном после замера RSS
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        if prepare is not None:
+            args = (prepare(*args),)
+        gc.collect()
+        _reset_peak_rss()
+        baseline_rss = _peak_rss_mb()
+        func(*args, **kwargs)
+        peak_rss = _peak_rss_mb()
+        gc.collect()
+        tracemalloc.start()
+        func(*args, **kwargs)
+        peak = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 2)
+        tracemalloc.stop()
+    return peak, baseline_rss, peak_rss
+
+
+def measure(stage, func, *args, memory=True, prepare=None, **kwargs):
+    # Время этапа; память — в чистом процессе (spawn), чтобы разборы прошлых этапов не оставались в RSS.
+    # prepare(*args) — подготовка вне замера, её результат передаётся в func. Вывод самого скрипта глушится
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        call_args = (prepare(*args),) if prepare is not None else args
+        gc.collect()
+        started = time.perf_counter()
+        result = func(*call_args, **kwargs)
+        seconds = time.perf_counter() - started
+    peak = baseline_rss = peak_rss = None
+    if memory:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+            peak, baseline_rss, peak_rss = pool.submit(_measure_memory, func, args, kwargs, prepare).result()
+    return result, {"stage": stage, "seconds": round(seconds, 4), "tracemalloc_peak_mb": peak,
+                    "peak_rss_mb": peak_rss,
+                    "rss_growth_mb": None if peak_rss is None else round(peak_rss - baseline_rss, 1)}
+
+
+def _serialize(tree):
+    # Отдельно от фильтрации: только запись дерева, как в конце process_ge_pro_kml; разбор — в prepare
+    return len(etree.tostring(tree, pretty_print=True, xml_declaration=True, encoding='UTF-8'))
+
+
+def run_case(rows, placemarks, work_dir, seed=0, engines=("lxml",), memory=True):
+    case_dir = os.path.join(work_dir, f"{rows}x{placemarks}")
+    os.makedirs(case_dir, exist_ok=True)
+    input_kml = os.path.join(case_dir, "Data Base.kml")
+    html_file = os.path.join(case_dir, "AUP_UUP Details.htm")
+
+    names, generate_kml = measure("generate_kml", make_kml_database, input_kml, placemarks, seed, memory=False)
+    html, generate_html = measure("generate_html", make_eaup_html, rows, names, seed, memory=False)
+    with open(html_file, "w", encoding="utf-8") as f:
+        f.write(html)
+    stages = [generate_kml, generate_html]
+
+    regions = None
+    for engine in engines:
+        regions, stage = measure(f"parse_{engine}", aup.parse_eaup_records, html, ("LP",), engine,
+                                 memory=memory)
+        stages.append(stage)
+    regions = regions["LP"]
+
+    name_index, stage = measure("build_name_index", aup.build_name_index, input_kml, aup.BAN_WORDS,
+                                memory=memory)
+    stages.append(stage)
+    _, stage = measure("render_tree", aup.process_ge_pro_kml, input_kml, os.path.join(case_dir, "tree.kml"),
+                       list(FULL_COPY_FOLDERS), regions, name_index, memory=memory)
+    stages.append(stage)
+    _, stage = measure("render_stream", aup.process_ge_pro_kml_stream, input_kml,
+                       os.path.join(case_dir, "stream.kml"), list(FULL_COPY_FOLDERS), regions, memory=memory)
+    stages.append(stage)
+    _, stage = measure("serialize", _serialize, input_kml, memory=memory, prepare=etree.parse)
+    stages.append(stage)
+
+    return {"rows": rows, "placemarks": placemarks, "regions": len(regions),
+            "html_mb": round(os.path.getsize(html_file) / (1024 * 1024), 2),
+            "kml_mb": round(os.path.getsize(input_kml) / (1024 * 1024), 2),
+            "stages": stages}
+
+
+def run_benchmark(rows_list, placemarks_list, seed=0, engines=("lxml",), work_dir=None, memory=True):
+    keep_dir = work_dir is not None
+    work_dir = work_dir or tempfile.mkdtemp(prefix="aup_benchmark_")
+    try:
+        cases = []
+        for rows, placemarks in zip(rows_list, placemarks_list):
+            print(f"⏱️Benchmark {rows} rows x {placemarks} placemarks...")
+            cases.append(run_case(rows, placemarks, work_dir, seed, engines, memory))
+            for stage in cases[-1]["stages"]:
+                peak = "" if stage["tracemalloc_peak_mb"] is None else f"{stage['tracemalloc_peak_mb']:>10.1f} MB"
+                rss = "" if stage["peak_rss_mb"] is None else f"{stage['peak_rss_mb']:>10.1f} MB RSS"
+                print(f"\t{stage['stage']:<18}{stage['seconds']:>10.3f} s{peak}{rss}")
+    finally:
+        if not keep_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return {"created": datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            "python": platform.python_version(), "platform": platform.platform(),
+            "seed": seed, "cases": cases}
+
+
+def compare_results(baseline, current, max_regression=0.25):
+    # Регрессия — этап стал медленнее больше чем на max_regression (доля) в том же размере данных
+    baseline_stages = {(case["rows"], case["placemarks"], stage["stage"]): stage["seconds"]
+                       for case in baseline["cases"] for stage in case["stages"]}
+    regressions = []
+    for case in current["cases"]:
+        for stage in case["stages"]:
+            before = baseline_stages.get((case["rows"], case["placemarks"], stage["stage"]))
+            if not before or stage["stage"].startswith("generate_"):
+                continue
+            change = (stage["seconds"] - before) / before
+            if change > max_regression:
+                regressions.append({"rows": case["rows"], "placemarks": case["placemarks"],
+                                    "stage": stage["stage"], "before": before, "after": stage["seconds"],
+                                    "change": round(change, 3)})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark AUP/UUP parsing and KML rendering on synthetic data")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="EAUP table rows per case")
+    parser.add_argument("--placemarks", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="database placemarks per case (same count as --rows)")
+    parser.add_argument("--engines", nargs="+", default=["lxml"], choices=sorted(aup.HTML_ENGINES))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark.json", help="where to save the JSON results")
+    parser.add_argument("--compare", help="previous JSON results to check for regressions")
+    parser.add_argument("--max-regression", type=float, default=0.25,
+                        help="allowed slowdown of a stage, 0.25 = 25%%")
+    parser.add_argument("--keep", help="keep generated files in this directory")
+    parser.add_argument("--no-memory", action="store_true", help="skip the memory pass in a separate process")
+    args = parser.parse_args(argv)
+    if len(args.rows) != len(args.placemarks):
+        parser.error("--rows and --placemarks need the same number of values")
+
+    results = run_benchmark(args.rows, args.placemarks, args.seed, args.engines, args.keep, not args.no_memory)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=4)
+    print(f"💾Results saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare_results(json.load(f), results, args.max_regression)
+        for regression in regressions:
+            print(f"\033[31m❌{regression['stage']} {regression['rows']}x{regression['placemarks']}: "
+                  f"{regression['before']:.3f} s -> {regression['after']:.3f} s (+{regression['change']:.0%})\033[0m")
+        if regressions:
+            return 1
+        print("✅No regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
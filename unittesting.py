@@ -5,6 +5,12 @@ import os
 import sys
 from lxml import etree
 import io
+import shutil
+import tempfile
+import time
+import json
+import subprocess
+import contextlib
 
 # Автоматически добавляем текущую директорию в пути поиска Python,
 # чтобы он точно увидел файл main.py
@@ -14,9 +20,57 @@ if current_dir not in sys.path:
 
 try:
     from mirror_1 import parse_eaup_htm
+    from mirror_1 import parse_eaup_html
+    from mirror_1 import parse_eaup_html_multi
+    from mirror_1 import parse_eaup_records
     from mirror_1 import process_ge_pro_kml
     from mirror_1 import load_config
     from mirror_1 import download_page
+    from mirror_1 import build_name_index
+    from mirror_1 import load_name_index
+    from mirror_1 import parse_indexed_database
+    from mirror_1 import process_ge_pro_kml_stream
+    from mirror_1 import parse_eaup_releases
+    from mirror_1 import select_eaup_release
+    from mirror_1 import HttpEaupFetcher
+    from mirror_1 import download_table_http
+    from mirror_1 import fetch_eaup_table
+    from mirror_1 import watch
+    from mirror_1 import EaupCache
+    from mirror_1 import process_table
+    from mirror_1 import write_kml_delta
+    from mirror_1 import kml_delta_paths
+    from mirror_1 import write_outputs
+    from mirror_1 import Activation
+    from mirror_1 import merge_activations
+    from mirror_1 import ActivationIndex
+    import benchmark
+    from mirror_1 import Metrics
+    from mirror_1 import METRICS
+    from mirror_1 import JsonLogStream
+    import zipfile
+    from mirror_1 import simplify_kml_geometry
+    import mirror_1
+    from mirror_1 import main
+    from mirror_1 import apply_config
+    from mirror_1 import DEFAULT_CONFIG
+    from mirror_1 import run_pipeline_async
+    import asyncio
+    import threading
+    from mirror_1 import compile_description_template
+    from mirror_1 import SpatialIndex
+    from mirror_1 import build_spatial_areas
+    from mirror_1 import load_spatial_index
+    from mirror_1 import query_active_areas
+    from mirror_1 import HistoryStore
+    from mirror_1 import ingest_history
+    from mirror_1 import snapshot_release
+    from mirror_1 import history_region_key
+    from mirror_1 import EaupRowState
+    from mirror_1 import split_table_rows
+    from mirror_1 import render_outputs
+    from mirror_1 import output_sink
+    from mirror_1 import kml_jobs
 except ImportError:
     print("\n❌ ОШИБКА: Не удалось найти файл 'main.py'.")
     print(f"Убедитесь, что ваш скрипт переименован в 'main.py' и лежит здесь: {current_dir}")
@@ -296,5 +350,1572 @@ class TestTimeCalculation(unittest.TestCase):
         self.assertEqual(start_time, expected)
         print("✅ Тест 14:59 пройден успешно!")
 
+SAMPLE_KML = """<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2">
+<Document>
+    <name>Base</name>
+    <Folder>
+        <name>AREAS LP-D</name>
+        <Placemark>
+            <name>LP-D10</name>
+            <description>ALTITUDES XXXXft AGL/FLXXX TIME XX:XX-XX:XX</description>
+        </Placemark>
+        <Placemark>
+            <name>LP-D11</name>
+            <description>ALTITUDES XXXXft AGL/FLXXX TIME XX:XX-XX:XX</description>
+        </Placemark>
+    </Folder>
+    <Folder>
+        <name>AREAS LP-R</name>
+        <Placemark>
+            <name>LP-R15</name>
+        </Placemark>
+    </Folder>
+</Document>
+</kml>
+"""
+
+
+class TempDirTestCase(unittest.TestCase):
+    # Общая подготовка: временная папка, удаляемая после теста, и подмена настроек модуля
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir, ignore_errors=True)
+
+    def path(self, *names):
+        return os.path.join(self.tmp_dir, *names)
+
+    @contextlib.contextmanager
+    def patch_module(self, **values):
+        # Глобальные настройки mirror_1 на время блока: patch_module(CACHE_DIR=None, ...)
+        with contextlib.ExitStack() as stack:
+            for name, value in values.items():
+                stack.enter_context(patch(f"mirror_1.{name}", value))
+            yield
+
+    def restore_config(self):
+        # main() и apply_config меняют конфиг модуля, после теста возвращаем прежний
+        self.addCleanup(apply_config, mirror_1.config)
+        self.addCleanup(setattr, mirror_1, "CONFIG_FILE", mirror_1.CONFIG_FILE)
+
+
+class KmlTestCase(TempDirTestCase):
+    # Тесты с базой: DATABASE_KML в base.kml и путь выхода out.kml
+    DATABASE_KML = SAMPLE_KML
+
+    def setUp(self):
+        super().setUp()
+        self.input_kml = self.path("base.kml")
+        with open(self.input_kml, "w", encoding="utf-8") as f:
+            f.write(self.DATABASE_KML)
+        self.output_kml = self.path("out.kml")
+
+    def patch_job(self, **values):
+        # База и выход теста вместо INPUT_KML/OUTPUT_KML модуля, AREAS LP-R копируется целиком
+        job = dict(INPUT_KML=self.input_kml, OUTPUT_KML=self.output_kml, FULL_COPY=["AREAS LP-R"])
+        return self.patch_module(**dict(job, **values))
+
+
+class TestNameIndex(KmlTestCase):
+    def setUp(self):
+        super().setUp()
+        self.regions_dict = {"d10": ["11:00-13:00|GND/FL240"]}
+
+    def test_index_groups_by_folder(self):
+        """Тест: индекс хранит позиции меток по нормализованному имени и папке"""
+        name_index = build_name_index(self.input_kml)
+        self.assertEqual(name_index["folders"][0]["keys"], {"d10": [0], "d11": [1]})
+        self.assertEqual(name_index["folders"][1]["keys"], {"r15": [0]})
+
+    def test_index_is_persisted_and_invalidated(self):
+        """Тест: индекс сохраняется рядом с базой и пересобирается при смене BAN_WORDS"""
+        load_name_index(self.input_kml)
+        self.assertTrue(os.path.exists(self.input_kml + ".index.json"))
+        with patch("mirror_1.build_name_index", wraps=build_name_index) as mock_build:
+            load_name_index(self.input_kml)
+            mock_build.assert_not_called()
+            load_name_index(self.input_kml, ban_words=["lp-"])
+            mock_build.assert_called_once()
+
+    def test_indexed_output_matches_full_scan(self):
+        """Тест: результат с индексом совпадает с полным проходом"""
+        scan_kml = self.path("scan.kml")
+        indexed_kml = self.path("indexed.kml")
+        process_ge_pro_kml(self.input_kml, scan_kml, ["AREAS LP-R"], self.regions_dict)
+        process_ge_pro_kml(self.input_kml, indexed_kml, ["AREAS LP-R"], self.regions_dict,
+                           load_name_index(self.input_kml))
+        with open(scan_kml, "rb") as f:
+            scan_result = f.read().replace(b"scan", b"out")
+        with open(indexed_kml, "rb") as f:
+            indexed_result = f.read().replace(b"indexed", b"out")
+        self.assertEqual(scan_result, indexed_result)
+        self.assertNotIn(b"LP-D11", indexed_result)
+
+    def test_index_stores_placemark_ranges(self):
+        """Тест: индекс хранит байтовые границы каждой метки папки"""
+        name_index = build_name_index(self.input_kml)
+        with open(self.input_kml, "rb") as f:
+            data = f.read()
+        start, end = name_index["placemark_ranges"][0][1]
+        self.assertTrue(data[start:end].startswith(b"<Placemark>"))
+        self.assertTrue(data[start:end].endswith(b"</Placemark>"))
+        self.assertIn(b"LP-D11", data[start:end])
+        self.assertEqual([len(ranges) for ranges in name_index["placemark_ranges"]], [2, 1])
+
+    def test_inactive_placemarks_are_not_parsed(self):
+        """Тест: неактивные метки вырезаются до разбора, позиции в индексе пересчитываются"""
+        tree, reduced_index = parse_indexed_database(self.input_kml, build_name_index(self.input_kml),
+                                                     self.regions_dict, ["AREAS LP-R"])
+        self.assertNotIn(b"LP-D11", etree.tostring(tree))
+        self.assertIn(b"LP-R15", etree.tostring(tree))
+        self.assertEqual(reduced_index["folders"][0]["keys"], {"d10": [0]})
+        self.assertEqual(reduced_index["folders"][0]["placemarks"], 1)
+
+    def test_unchanged_database_is_not_hashed(self):
+        """Тест: при тех же размере и времени изменения база не перечитывается для хэша"""
+        load_name_index(self.input_kml)
+        with patch("mirror_1._file_sha256") as mock_hash:
+            load_name_index(self.input_kml)
+            mock_hash.assert_not_called()
+
+
+class TestStreamingKML(KmlTestCase):
+    def setUp(self):
+        super().setUp()
+        self.regions_dict = {"d10": ["11:00-13:00|GND/FL240"]}
+
+    def test_stream_matches_tree_output(self):
+        """Тест: потоковая обработка даёт тот же документ, что и обработка дерева"""
+        tree_kml = self.output_kml
+        stream_dir = self.path("stream")
+        os.mkdir(stream_dir)
+        stream_kml = os.path.join(stream_dir, "out.kml")
+        process_ge_pro_kml(self.input_kml, tree_kml, ["AREAS LP-R"], self.regions_dict)
+        process_ge_pro_kml_stream(self.input_kml, stream_kml, ["AREAS LP-R"], self.regions_dict)
+
+        parser = etree.XMLParser(remove_blank_text=True)
+        tree_result = etree.tostring(etree.parse(tree_kml, parser), method="c14n")
+        stream_result = etree.tostring(etree.parse(stream_kml, parser), method="c14n")
+        self.assertEqual(tree_result.replace(b"stream/", b""), stream_result.replace(b"stream/", b""))
+        self.assertIn(b"11:00-13:00", stream_result)
+        self.assertNotIn(b"LP-D11", stream_result)
+        self.assertIn(b"LP-R15", stream_result)
+
+    def test_stream_does_not_repeat_namespaces(self):
+        """Тест: объявления пространств имён пишутся только в корне"""
+        stream_kml = self.output_kml
+        process_ge_pro_kml_stream(self.input_kml, stream_kml, ["AREAS LP-R"], self.regions_dict)
+        with open(stream_kml, "rb") as f:
+            self.assertEqual(f.read().count(b"xmlns="), 1)
+
+
+class TestHtmlEngines(unittest.TestCase):
+    def setUp(self):
+        self.test_html = """
+        <html>
+            <script>var LP_FAKE = "LP-D99 00:00 01:00";</script>
+            <table>
+                <tr><th>Name</th><th>From</th><th>To</th><th>Lower</th><th>Upper</th></tr>
+                <tr>
+                    <td><a href="#">LP-D10</a> <!-- LP-D98 --></td>
+                    <td> 10:00 </td>
+                    <td>12:00</td>
+                    <td>SFC</td>
+                    <td><span>0</span><span>30</span></td>
+                </tr>
+                <tr>
+                    <td>LP-TRA54</td>
+                    <td>14:00</td>
+                    <td>16:00</td>
+                    <td>100</td>
+                    <td>245</td>
+                </tr>
+            </table>
+        </html>
+        """
+
+    def test_engines_return_same_regions(self):
+        """Тест: lxml и bs4 дают одинаковый словарь регионов"""
+        results = {}
+        for engine in ("bs4", "lxml"):
+            with patch("os.path.exists", return_value=True):
+                with patch("builtins.open", mock_open(read_data=self.test_html)):
+                    results[engine] = parse_eaup_htm("fake_table.htm", engine=engine)
+        self.assertEqual(results["lxml"], results["bs4"])
+        self.assertEqual(results["lxml"], {"d10": ["10:00-12:00|GND/3000ft AMSL"],
+                                           "tra54": ["14:00-16:00|FL100/FL245"]})
+
+    def test_unknown_engine(self):
+        """Тест: неизвестный движок разбора HTML"""
+        with self.assertRaises(ValueError):
+            parse_eaup_htm("fake_table.htm", engine="html5lib")
+
+
+PORTAL_HTML = """<html><body>
+<table>
+    <tr><td>EAUP</td><td><a href="table.html" target="_blank">26/02/2026 06:00</a></td></tr>
+    <tr><td>EUUP</td><td><a href="table.html" target="_blank">26/02/2026 14:00</a></td></tr>
+    <tr><td>EUUP</td><td><a href="table.html" target="_blank">26/02/2026 09:30</a></td></tr>
+    <tr><td>EAUP</td><td><a href="table.html" target="_blank">27/02/2026 06:00</a></td></tr>
+</table>
+</body></html>"""
+
+
+def chromium_available():
+    try:
+        from playwright.sync_api import sync_playwright
+        with sync_playwright() as p:
+            p.chromium.launch(headless=True).close()
+        return True
+    except Exception:
+        return False
+
+
+class TestReleaseDiscovery(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.entries = [
+            {"text": "26/02/2026 06:00", "context": "EAUP26/02/2026 06:00", "href": "table.html"},
+            {"text": "26/02/2026 14:00", "context": "EUUP26/02/2026 14:00", "href": "table.html"},
+            {"text": "26/02/2026 09:30", "context": "EUUP26/02/2026 09:30", "href": "table.html"},
+            {"text": "27/02/2026 06:00", "context": "EAUP27/02/2026 06:00", "href": "table.html"},
+            {"text": "Last update", "context": "", "href": None},
+        ]
+
+    def test_releases_sorted_newest_first(self):
+        """Тест: выпуски разбираются за один проход и сортируются от новых к старым"""
+        releases = parse_eaup_releases(self.entries)
+        self.assertEqual([r["label"] for r in releases],
+                         ["27/02/2026 06:00", "26/02/2026 14:00", "26/02/2026 09:30", "26/02/2026 06:00"])
+        self.assertEqual([r["kind"] for r in releases], ["AUP", "UUP", "UUP", "AUP"])
+
+    def test_select_newest_not_in_future(self):
+        """Тест: выбирается самый свежий выпуск, который уже наступил"""
+        releases = parse_eaup_releases(self.entries)
+        now = datetime(2026, 2, 26, 14, 10, tzinfo=timezone.utc)
+        self.assertEqual(select_eaup_release(releases, now=now)["label"], "26/02/2026 14:00")
+
+    def test_select_wanted_release(self):
+        """Тест: выбор выпуска, заданного пользователем"""
+        releases = parse_eaup_releases(self.entries)
+        self.assertEqual(select_eaup_release(releases, wanted="26/02/2026 09:30")["kind"], "UUP")
+        with self.assertRaises(RuntimeError):
+            select_eaup_release(releases, wanted="01/01/2026 00:00")
+
+    def test_select_nothing_for_last_day(self):
+        """Тест: нет выпусков за последние 24 часа"""
+        releases = parse_eaup_releases(self.entries)
+        with self.assertRaises(RuntimeError):
+            select_eaup_release(releases, now=datetime(2026, 3, 5, 0, 0, tzinfo=timezone.utc))
+
+    class FakePortalPage:
+        # Страница портала без браузера: ссылки из статичного HTML, как их вернул бы _RELEASE_LINKS_JS
+        def __init__(self, html, url):
+            self.html = html
+            self.url = url
+            self.clicked = []
+            self.opened = []
+
+        def wait_for_function(self, *args, **kwargs):
+            pass
+
+        def evaluate(self, script):
+            return mirror_1._release_entries_from_html(self.html, self.url)
+
+        def get_by_text(self, text):
+            self.clicked.append(text)
+            return MagicMock()
+
+        def new_page(self):
+            target_page = MagicMock()
+            self.opened.append(target_page)
+            return target_page
+
+        def expect_page(self):
+            return MagicMock()
+
+    def test_discovery_opens_link_of_selected_release(self):
+        """Тест: при одинаковой метке у заголовка, AUP и UUP открывается ссылка UUP, а не первый текст"""
+        html = """<html><body>
+            <p>Last update 27/02/2026 06:00</p>
+            <table>
+                <tr><td>EAUP</td><td><a href="aup.html">27/02/2026 06:00</a></td></tr>
+                <tr><td>EUUP</td><td><a href="uup.html">27/02/2026 06:00</a></td></tr>
+            </table>
+        </body></html>"""
+        page = self.FakePortalPage(html, "http://portal.test/gateway/")
+        with patch("sys.stdout", new_callable=io.StringIO):
+            label, target_page = mirror_1._open_table_by_discovery(page, page, "27/02/2026 06:00")
+        self.assertEqual(label, "27/02/2026 06:00")
+        target_page.goto.assert_called_once_with("http://portal.test/gateway/uup.html")
+        self.assertEqual(page.clicked, [])
+
+    def test_discovery_clicks_without_link(self):
+        """Тест: если у выпуска нет ссылки, он открывается кликом по тексту"""
+        page = self.FakePortalPage("<html><body><div>EUUP 27/02/2026 06:00</div></body></html>",
+                                   "http://portal.test/gateway/")
+        with patch("sys.stdout", new_callable=io.StringIO):
+            mirror_1._open_table_by_discovery(page, page, "27/02/2026 06:00")
+        self.assertEqual(page.clicked, ["27/02/2026 06:00"])
+        self.assertEqual(page.opened, [])
+
+    @unittest.skipUnless(chromium_available(), "Chromium for playwright is not installed")
+    def test_download_from_saved_portal(self):
+        """Тест: поиск ссылок на сохранённой копии портала через локальный HTTP сервер"""
+        import functools
+        import threading
+        from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+        with open(self.path("portal.html"), "w", encoding="utf-8") as f:
+            f.write(PORTAL_HTML)
+        with open(self.path("table.html"), "w", encoding="utf-8") as f:
+            f.write("<html><table><tr><td>LP-D10</td><td>10:00</td><td>12:00</td></tr></table></html>")
+        handler = functools.partial(SimpleHTTPRequestHandler, directory=self.tmp_dir)
+        server = HTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+
+        html_file = self.path("downloaded.htm")
+        with self.patch_module(HTML_FILE=html_file, LINK_DISCOVERY=True):
+            download_page(url=f"http://127.0.0.1:{server.server_port}/portal.html",
+                          release="26/02/2026 09:30")
+        with open(html_file, encoding="utf-8") as f:
+            self.assertIn("LP-D10", f.read())
+
+
+class TestHttpBackend(TempDirTestCase):
+    def setUp(self):
+        import functools
+        import threading
+        from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+        super().setUp()
+        with open(self.path("portal.html"), "w", encoding="utf-8") as f:
+            f.write(PORTAL_HTML)
+        with open(self.path("table.html"), "w", encoding="utf-8") as f:
+            f.write("<html><table><tr><td>LP-D10</td><td>10:00</td><td>12:00</td>"
+                    "<td>SFC</td><td>100</td></tr></table></html>")
+
+        class KeepAliveHandler(SimpleHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(("127.0.0.1", 0), functools.partial(KeepAliveHandler, directory=self.tmp_dir))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}/"
+
+    def test_releases_and_table_over_one_connection(self):
+        """Тест: список выпусков и таблица загружаются без браузера через одно соединение"""
+        fetcher = HttpEaupFetcher(releases_url=self.base_url + "portal.html", table_url="")
+        releases = fetcher.releases()
+        self.assertEqual(releases[0]["label"], "27/02/2026 06:00")
+        self.assertEqual(releases[0]["href"], self.base_url + "table.html")
+        html = fetcher.fetch(releases[1])
+        self.assertIn("LP-D10", html)
+        self.assertEqual(len(fetcher.connections), 1)
+        fetcher.close()
+
+    def test_download_feeds_parser(self):
+        """Тест: загруженная по HTTP таблица сохраняется и разбирается как раньше"""
+        html_file = self.path("downloaded.htm")
+        fetcher = HttpEaupFetcher(releases_url=self.base_url + "portal.html", table_url="")
+        with self.patch_module(HTML_FILE=html_file):
+            download_table_http(release="26/02/2026 14:00", fetcher=fetcher)
+        fetcher.close()
+        self.assertEqual(parse_eaup_htm(html_file), {"d10": ["10:00-12:00|GND/FL100"]})
+
+    def test_table_url_template(self):
+        """Тест: адрес таблицы по шаблону из конфигурации"""
+        fetcher = HttpEaupFetcher(releases_url=self.base_url + "portal.html",
+                                  table_url=self.base_url + "table.html?date={time:%Y-%m-%d}&kind={kind}")
+        release = fetcher.releases()[0]
+        self.assertIn("LP-D10", fetcher.fetch(release))
+        fetcher.close()
+
+    def test_fallback_to_browser(self):
+        """Тест: если HTTP не сработал, используется playwright"""
+        with self.patch_module(FETCH_BACKEND="http", HTTP_RELEASES_URL=self.base_url + "missing.html",
+                               HTTP_TABLE_URL=self.base_url + "table.html"), \
+                patch("mirror_1.download_page") as mock_download_page, \
+                patch("sys.stdout", new_callable=io.StringIO) as stdout:
+            fetch_eaup_table()
+        mock_download_page.assert_called_once()
+        self.assertIn("HTTP download failed", stdout.getvalue())
+
+    def test_probing_table_url_without_releases_page(self):
+        """Тест: без страницы выпусков адрес таблицы подбирается по шаблону, как перебор в браузере"""
+        now_utc = datetime.now(timezone.utc)
+        published = now_utc.replace(minute=(now_utc.minute // 30) * 30, second=0, microsecond=0) - timedelta(hours=1)
+        with open(self.path(published.strftime("%H%M") + "-AUP.html"), "w", encoding="utf-8") as f:
+            f.write("<html><table><tr><td>LP-D10</td></tr></table></html>")
+        fetcher = HttpEaupFetcher(releases_url="", table_url=self.base_url + "{time:%H%M}-{kind}.html")
+        with patch("sys.stdout", new_callable=io.StringIO):
+            releases = fetcher.releases()
+        self.assertEqual(releases[0]["label"], published.strftime('%d/%m/%Y %H:%M'))
+        self.assertEqual(releases[0]["kind"], "AUP")
+        self.assertIn("LP-D10", fetcher.fetch(releases[0]))
+        fetcher.close()
+
+    def test_http_backend_without_release_source(self):
+        """Тест: HTTP_TABLE_URL без {time:...} не позволяет найти выпуск, сразу браузер"""
+        with self.patch_module(FETCH_BACKEND="http", HTTP_RELEASES_URL=None, HTTP_TABLE_URL=self.base_url + "table.html"), \
+                patch("mirror_1.download_table_http") as mock_download_http, \
+                patch("mirror_1.download_page") as mock_download_page, \
+                patch("sys.stdout", new_callable=io.StringIO):
+            fetch_eaup_table()
+        mock_download_http.assert_not_called()
+        mock_download_page.assert_called_once()
+
+    def test_http_needs_table_url(self):
+        """Тест: без HTTP_RELEASES_URL и HTTP_TABLE_URL статичная страница портала не запрашивается, сразу браузер"""
+        with self.patch_module(FETCH_BACKEND="http", HTTP_RELEASES_URL=None, HTTP_TABLE_URL=None), \
+                patch("mirror_1.download_table_http") as mock_download_http, \
+                patch("mirror_1.download_page") as mock_download_page, \
+                patch("sys.stdout", new_callable=io.StringIO):
+            fetch_eaup_table()
+        mock_download_http.assert_not_called()
+        mock_download_page.assert_called_once()
+
+
+class TestWatchDaemon(KmlTestCase):
+    class FakeFetcher:
+        def __init__(self, labels):
+            self.labels = list(labels)
+            self.fetched = []
+            self.closed = False
+
+        def releases(self):
+            label = self.labels.pop(0)
+            if label is None:
+                raise ValueError("portal is down")
+            return parse_eaup_releases([{"text": label, "context": "EUUP", "href": None}])
+
+        def fetch(self, release):
+            self.fetched.append(release["label"])
+            return "<table><tr><td>LP-D10</td><td>10:00</td><td>12:00</td><td>SFC</td><td>100</td></tr></table>"
+
+        def close(self):
+            self.closed = True
+
+    def setUp(self):
+        super().setUp()
+        now = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+        self.old_label = (now - timedelta(hours=2)).strftime('%d/%m/%Y %H:%M')
+        self.new_label = (now - timedelta(hours=1)).strftime('%d/%m/%Y %H:%M')
+
+    def run_watch(self, fetcher, cycles):
+        with self.patch_job(HTML_FILE=self.path("table.htm"), TRACEBACK_FILE=self.path("Traceback.txt"),
+                            CACHE_DIR=self.path("cache")), \
+                patch("mirror_1.time.sleep") as mock_sleep:
+            watch(interval=60, fetcher=fetcher, cycles=cycles)
+        return mock_sleep
+
+    def test_regenerates_only_on_new_release(self):
+        """Тест: KML пересобирается только при новом выпуске, ошибки опроса не останавливают демон"""
+        fetcher = self.FakeFetcher([self.old_label, self.old_label, None, self.new_label])
+        mock_sleep = self.run_watch(fetcher, cycles=4)
+        self.assertEqual(fetcher.fetched, [self.old_label, self.new_label])
+        self.assertEqual(mock_sleep.call_count, 3)
+        self.assertTrue(fetcher.closed)
+        with open(self.output_kml, encoding="utf-8") as f:
+            self.assertIn("10:00-12:00", f.read())
+        # После атомарной замены временных файлов не остаётся
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                         ["Traceback.txt", "base.kml", "base.kml.index.json", "cache", "out.kml", "table.htm"])
+
+    def test_sys_exit_does_not_stop_daemon(self):
+        """Тест: sys.exit внутри обработки KML не завершает демон"""
+        fetcher = self.FakeFetcher([self.old_label, self.new_label])
+        with patch("mirror_1.write_active_regions", side_effect=SystemExit(1)) as mock_write:
+            self.run_watch(fetcher, cycles=2)
+        self.assertEqual(mock_write.call_count, 2)
+
+
+class TestEaupCache(KmlTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = self.path("cache")
+        self.html = "<table><tr><td>LP-D10</td><td>10:00</td><td>12:00</td><td>SFC</td><td>100</td></tr></table>"
+
+    def run_process_table(self, html, config_data=None):
+        with self.patch_job(CACHE_DIR=self.cache_dir), \
+                patch.dict("mirror_1.config", config_data or {}), \
+                patch("mirror_1.parse_eaup_records", wraps=parse_eaup_records) as mock_parse:
+            changed = process_table(html, "26/02/2026 14:00")
+        return changed, mock_parse.call_count
+
+    def test_same_table_is_skipped(self):
+        """Тест: та же таблица с той же базой и настройками не разбирается повторно"""
+        self.assertEqual(self.run_process_table(self.html), (True, 1))
+        self.assertEqual(self.run_process_table(self.html), (False, 0))
+        key = EaupCache.entry_key(self.html, "26/02/2026 14:00")
+        self.assertTrue(key.startswith("202602261400_"))
+        self.assertTrue(os.path.exists(os.path.join(self.cache_dir, key + ".pickle")))
+
+    def test_deleted_output_is_rebuilt(self):
+        """Тест: если удалён любой файл задачи (выход OUTPUTS, файлы обновлений), запуск не пропускается"""
+        geojson = self.path("out.geojson")
+        config_data = {"OUTPUTS": [geojson], "DELTA_KML": True}
+        with self.patch_module(**config_data):
+            self.assertEqual(self.run_process_table(self.html, config_data), (True, 1))
+            self.assertEqual(self.run_process_table(self.html, config_data), (False, 0))
+            for path in (geojson, kml_delta_paths(self.output_kml)["master"]):
+                os.remove(path)
+                self.assertEqual(self.run_process_table(self.html, config_data), (True, 0))
+                self.assertTrue(os.path.exists(path))
+
+    def test_changed_config_uses_parsed_cache(self):
+        """Тест: при смене настроек KML пересобирается, но таблица берётся из кэша"""
+        self.run_process_table(self.html)
+        self.assertEqual(self.run_process_table(self.html, {"NAME_INDEX": False}), (True, 0))
+
+    def test_new_table_is_parsed(self):
+        """Тест: новая таблица разбирается и попадает в выходной KML"""
+        self.run_process_table(self.html)
+        changed, parse_calls = self.run_process_table(self.html.replace("12:00", "13:00"))
+        self.assertEqual((changed, parse_calls), (True, 1))
+        with open(self.output_kml, encoding="utf-8") as f:
+            self.assertIn("10:00-13:00", f.read())
+
+    def test_eviction_by_age_and_size(self):
+        """Тест: старые записи и записи сверх лимита размера удаляются"""
+        cache = EaupCache(self.cache_dir, max_mb=1, max_age_days=1)
+        old_key = cache.put("old table")
+        os.utime(os.path.join(self.cache_dir, old_key + ".htm"), (0, 0))
+        big_key = cache.put("x" * (1024 * 1024))
+        new_key = cache.put("new table")
+        os.utime(os.path.join(self.cache_dir, big_key + ".htm"), (time.time() - 60, time.time() - 60))
+        self.assertEqual(cache.evict(keep=(new_key,)), 2)
+        self.assertEqual(os.listdir(self.cache_dir), [new_key + ".htm"])
+
+
+class TestKmlDelta(KmlTestCase):
+    def setUp(self):
+        super().setUp()
+        self.kml_ns = {"k": "http://www.opengis.net/kml/2.2"}
+
+    def publish(self, regions_dict):
+        process_ge_pro_kml(self.input_kml, self.output_kml, ["AREAS LP-R"], regions_dict)
+        result = write_kml_delta(self.output_kml)
+        return result, etree.parse(kml_delta_paths(self.output_kml)["delta"])
+
+    def test_placemarks_get_stable_ids(self):
+        """Тест: активные метки и обрабатываемые папки получают id для Update"""
+        process_ge_pro_kml(self.input_kml, self.output_kml, ["AREAS LP-R"], {"d10": ["11:00-13:00|GND/FL240"]})
+        tree = etree.parse(self.output_kml)
+        self.assertEqual(tree.xpath("//k:Placemark/@id", namespaces=self.kml_ns), ["fua-0-d10"])
+        self.assertEqual(tree.xpath("//k:Folder/@id", namespaces=self.kml_ns), ["fua-folder-0"])
+
+    def test_delta_between_publications(self):
+        """Тест: Create/Change/Delete считаются относительно прошлой публикации"""
+        result, delta = self.publish({"d10": ["11:00-13:00|GND/FL240"]})
+        self.assertEqual((result["created"], result["changed"], result["deleted"]), ([], [], []))
+        self.assertEqual(len(delta.xpath("//k:Update", namespaces=self.kml_ns)[0]), 1)
+
+        result, delta = self.publish({"d10": ["12:00-14:00|GND/FL240"], "d11": ["08:00-09:00|GND/FL100"]})
+        self.assertEqual((result["created"], result["changed"], result["deleted"]), (["fua-0-d11"], ["fua-0-d10"], []))
+        self.assertEqual(delta.xpath("//k:Update/k:targetHref/text()", namespaces=self.kml_ns), ["out.kml"])
+        self.assertEqual(delta.xpath("//k:Create/k:Folder/@targetId", namespaces=self.kml_ns), ["fua-folder-0"])
+        self.assertIn("12:00-14:00", delta.xpath("//k:Change/k:Placemark/k:description/text()",
+                                                 namespaces=self.kml_ns)[0])
+
+        result, delta = self.publish({"d11": ["08:00-09:00|GND/FL100"]})
+        self.assertEqual((result["created"], result["changed"], result["deleted"]), ([], [], ["fua-0-d10"]))
+        self.assertEqual(delta.xpath("//k:Delete/k:Placemark/@targetId", namespaces=self.kml_ns), ["fua-0-d10"])
+
+    def test_created_placemarks_are_deleted_first(self):
+        """Тест: повторное применение Update не создаёт дубликатов — перед Create метка удаляется"""
+        self.publish({"d10": ["11:00-13:00|GND/FL240"]})
+        _, delta = self.publish({"d10": ["11:00-13:00|GND/FL240"], "d11": ["08:00-09:00|GND/FL100"]})
+        update = delta.xpath("//k:Update", namespaces=self.kml_ns)[0]
+        self.assertEqual([etree.QName(child).localname for child in update], ["targetHref", "Delete", "Create"])
+        self.assertEqual(delta.xpath("//k:Delete/k:Placemark/@targetId", namespaces=self.kml_ns), ["fua-0-d11"])
+        self.assertEqual(delta.xpath("//k:Create//k:Placemark/@id", namespaces=self.kml_ns), ["fua-0-d11"])
+
+    def test_master_network_link(self):
+        """Тест: мастер-файл ссылается на полный KML и на файл обновлений"""
+        self.publish({"d10": ["11:00-13:00|GND/FL240"]})
+        master = etree.parse(kml_delta_paths(self.output_kml)["master"])
+        self.assertEqual(master.xpath("//k:NetworkLink/k:Link/k:href/text()", namespaces=self.kml_ns),
+                         ["out.kml", "out Update.kml"])
+
+
+class TestMultiFir(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.html = """
+        <table>
+            <tr><td>LP-D10</td><td>10:00</td><td>12:00</td><td>SFC</td><td>100</td></tr>
+            <tr><td>LED45</td><td>09:00</td><td>11:00</td><td>SFC</td><td>200</td></tr>
+            <tr><td>LE-R71</td><td>13:00</td><td>15:00</td><td>050</td><td>150</td></tr>
+            <tr><td>LPA</td><td>08:00</td><td>09:00</td><td>100</td><td>200</td></tr>
+        </table>
+        """
+
+    def test_one_parse_for_many_prefixes(self):
+        """Тест: одна таблица разбирается сразу для нескольких FIR"""
+        result = parse_eaup_html_multi(self.html, ("LP", "LE"))
+        self.assertEqual(result["LP"], {"d10": ["10:00-12:00|GND/FL100"]})
+        self.assertEqual(result["LE"], {"d45": ["09:00-11:00|GND/FL200"], "r71": ["13:00-15:00|FL50/FL150"]})
+        self.assertEqual(parse_eaup_html(self.html), result["LP"])
+
+    def test_jobs_run_in_process_pool(self):
+        """Тест: задания (база, префикс, FULL_COPY, выход) выполняются параллельно"""
+        jobs = []
+        for prefix in ("LP", "LE"):
+            input_kml = self.path(f"{prefix}.kml")
+            with open(input_kml, "w", encoding="utf-8") as f:
+                f.write(SAMPLE_KML.replace("LP-", f"{prefix}-"))
+            jobs.append({"INPUT_KML": input_kml, "OUTPUT_KML": self.path(f"{prefix} out.kml"),
+                         "PREFIX": prefix, "FULL_COPY": [f"AREAS {prefix}-R"],
+                         "BAN_WORDS": [f"{prefix.lower()}-", "-"]})
+        regions_by_prefix = parse_eaup_html_multi(self.html.replace("LED45", "LE-D10"), ("LP", "LE"))
+        with self.patch_module(JOBS=jobs, BATCH_WORKERS=2):
+            write_outputs(regions_by_prefix)
+
+        with open(jobs[0]["OUTPUT_KML"], encoding="utf-8") as f:
+            lp_result = f.read()
+        with open(jobs[1]["OUTPUT_KML"], encoding="utf-8") as f:
+            le_result = f.read()
+        self.assertIn("10:00-12:00", lp_result)
+        self.assertIn("09:00-11:00", le_result)
+        self.assertIn("LE-R15", le_result)
+        self.assertNotIn("LE-D11", le_result)
+
+    def test_extra_prefixes_without_jobs_are_reported(self):
+        """Тест: без JOBS выводится только первый префикс, об остальных предупреждение"""
+        regions_by_prefix = parse_eaup_html_multi(self.html, ("LP", "LE"))
+        with self.patch_module(JOBS=[], ICAO_PREFIXES=["LP", "LE"]), \
+                patch("mirror_1.write_active_regions") as mock_write, \
+                patch("sys.stdout", new_callable=io.StringIO) as stdout:
+            write_outputs(regions_by_prefix)
+        mock_write.assert_called_once()
+        self.assertEqual(mock_write.call_args[0][0], regions_by_prefix["LP"])
+        self.assertIn("LE ignored: add a job per prefix to JOBS", stdout.getvalue())
+
+
+class TestActivationRecords(KmlTestCase):
+    def test_records_keep_numbers(self):
+        """Тест: записи хранят минуты и высоты числами, строка собирается только при выводе"""
+        html = """<table>
+            <tr><td>LP-D10</td><td>10:00</td><td>12:30</td><td>SFC</td><td>030</td></tr>
+            <tr><td>LP-R15</td><td>14:00</td><td>16:00</td><td>245</td></tr>
+            <tr><td>LP-R16</td><td>14:00</td><td>16:00</td></tr>
+        </table>"""
+        records = parse_eaup_records(html, ("LP",))["LP"]
+        d10 = records["d10"][0]
+        self.assertEqual((d10.start, d10.end), (600, 750))
+        self.assertEqual((d10.lower, d10.lower_ref, d10.upper, d10.upper_ref), (0, "GND", 30, "AMSL"))
+        self.assertEqual(d10.upper_ft, 3000)
+        self.assertEqual(str(d10), "10:00-12:30|GND/3000ft AMSL")
+        self.assertEqual(str(records["r15"][0]), "14:00-16:00|FL245")
+        self.assertIn("Not specified", records["r16"][0].altitude_display())
+        self.assertFalse(hasattr(d10, "__dict__"))
+
+    def test_merge_overlapping_slots(self):
+        """Тест: пересекающиеся и соседние интервалы с одинаковыми высотами склеиваются"""
+        activations = [
+            Activation("d10", 600, 720, 0, "GND", 100, "FL"),
+            Activation("d10", 700, 800, 0, "GND", 100, "FL"),
+            Activation("d10", 800, 840, 0, "GND", 100, "FL"),
+            Activation("d10", 900, 960, 0, "GND", 100, "FL"),
+            Activation("d10", 650, 700, 0, "GND", 200, "FL"),
+        ]
+        merged = merge_activations(activations)
+        self.assertEqual([(a.start, a.end, a.upper) for a in merged],
+                         [(600, 840, 100), (650, 700, 200), (900, 960, 100)])
+
+    def test_merge_groups_full_levels(self):
+        """Тест: интервалы без высоты и с другой системой отсчёта не разрывают группу одинаковых высот"""
+        activations = [
+            Activation("d10", 600, 660, 0, "GND", 30, "AMSL"),
+            Activation("d10", 620, 700),
+            Activation("d10", 630, 680, 0, "GND", 30, "FL"),
+            Activation("d10", 660, 720, 0, "GND", 30, "AMSL"),
+            Activation("d10", 700, 760),
+        ]
+        merged = merge_activations(activations)
+        self.assertEqual([(a.start, a.end, a.upper_ref) for a in merged],
+                         [(600, 720, "AMSL"), (620, 760, None), (630, 680, "FL")])
+
+    def test_parser_merges_adjacent_rows(self):
+        """Тест: соседние строки таблицы с одинаковыми высотами дают одну активацию"""
+        html = """<table>
+            <tr><td>LP-D10</td><td>12:00</td><td>14:00</td><td>SFC</td><td>030</td></tr>
+            <tr><td>LP-D10</td><td>10:00</td><td>12:00</td><td>SFC</td><td>030</td></tr>
+        </table>"""
+        with patch("sys.stdout", new_callable=io.StringIO):
+            records = parse_eaup_records(html, ("LP",))["LP"]
+        self.assertEqual([str(a) for a in records["d10"]], ["10:00-14:00|GND/3000ft AMSL"])
+
+    def test_kml_accepts_records(self):
+        """Тест: process_ge_pro_kml заполняет описание из записей Activation"""
+        regions = {"d10": [Activation("d10", 600, 720, 0, "GND", 240, "FL"),
+                           Activation("d10", 900, 960, 10, "AGL", 30, "AMSL")]}
+        process_ge_pro_kml(self.input_kml, self.output_kml, ["AREAS LP-R"], regions)
+        with open(self.output_kml, encoding="utf-8") as f:
+            result = f.read()
+        self.assertIn("ALTITUDES GND/FL240, 1000ft AGL/3000ft AMSL TIME 10:00-12:00, 15:00-16:00", result)
+
+
+class TestActivationIndex(KmlTestCase):
+    def setUp(self):
+        super().setUp()
+        self.index = ActivationIndex({
+            "d10": [Activation("d10", 600, 720, 0, "GND", 100, "FL")],
+            "d11": [Activation("d11", 700, 800, 0, "GND", 50, "AMSL")],
+            "r15": [Activation("r15", 1320, 120, 0, "GND", 245, "FL")],
+        })
+
+    def test_active_at(self):
+        """Тест: запрос активных зон на момент времени, включая интервал через полночь"""
+        self.assertEqual(self.index.regions_at(650), ["d10"])
+        self.assertEqual(self.index.regions_at("11:45"), ["d10", "d11"])
+        self.assertEqual(self.index.regions_at(datetime(2026, 3, 1, 12, 0)), ["d11"])
+        self.assertEqual(self.index.regions_at("01:00"), ["r15"])
+        self.assertEqual(self.index.regions_at("23:30"), ["r15"])
+        self.assertEqual(self.index.regions_at("18:00"), [])
+
+    def test_active_during(self):
+        """Тест: запрос зон, пересекающих окно; конец интервала не включается"""
+        self.assertEqual(self.index.regions_during("12:00", "13:00"), ["d11"])
+        self.assertEqual(self.index.regions_during("09:00", "10:00"), [])
+        self.assertEqual(self.index.regions_during("21:00", "22:30"), ["r15"])
+
+    def test_time_spans_in_kml(self):
+        """Тест: при заданных сутках на каждый интервал создаётся своя метка с <TimeSpan>"""
+        regions = {"d10": [Activation("d10", 600, 720, 0, "GND", 240, "FL"),
+                           Activation("d10", 1380, 60, 0, "GND", 30, "AMSL")]}
+        tree_kml = self.path("tree.kml")
+        stream_kml = self.path("stream.kml")
+        day = datetime(2026, 3, 1).date()
+        process_ge_pro_kml(self.input_kml, tree_kml, [], regions, time_span_day=day)
+        process_ge_pro_kml_stream(self.input_kml, stream_kml, [], regions, time_span_day=day)
+        ns = {"kml": "http://www.opengis.net/kml/2.2"}
+        for path in (tree_kml, stream_kml):
+            placemarks = etree.parse(path).findall(".//kml:Placemark", ns)
+            self.assertEqual(len(placemarks), 2)
+            spans = [(pm.findtext("kml:TimeSpan/kml:begin", namespaces=ns),
+                      pm.findtext("kml:TimeSpan/kml:end", namespaces=ns)) for pm in placemarks]
+            self.assertEqual(spans, [("2026-03-01T10:00:00Z", "2026-03-01T12:00:00Z"),
+                                     ("2026-03-01T23:00:00Z", "2026-03-02T01:00:00Z")])
+            self.assertIn("TIME 10:00-12:00", placemarks[0].findtext("kml:description", namespaces=ns))
+            self.assertEqual(len(set(pm.get("id") for pm in placemarks)), 2)
+
+
+class TestBenchmark(TempDirTestCase):
+    def test_synthetic_case(self):
+        """Тест: бенчмарк на маленьких синтетических данных замеряет все этапы и находит регрессии"""
+        with patch("sys.stdout", new_callable=io.StringIO):
+            results = benchmark.run_benchmark([300], [120], work_dir=self.tmp_dir)
+        case = results["cases"][0]
+        stages = [stage["stage"] for stage in case["stages"]]
+        self.assertEqual(stages, ["generate_kml", "generate_html", "parse_lxml", "build_name_index",
+                                  "render_tree", "render_stream", "serialize"])
+        self.assertGreater(case["regions"], 0)
+        self.assertIsNotNone(case["stages"][2]["tracemalloc_peak_mb"])
+        if sys.platform.startswith("linux"):
+            self.assertGreaterEqual(case["stages"][4]["rss_growth_mb"], 0)
+        self.assertTrue(os.path.exists(self.path("300x120", "tree.kml")))
+
+        slower = {"cases": [dict(case, stages=[dict(stage, seconds=stage["seconds"] * 2 + 1)
+                                               for stage in case["stages"]])]}
+        regressions = benchmark.compare_results(results, slower)
+        self.assertEqual([r["stage"] for r in regressions], stages[2:])
+        self.assertEqual(benchmark.compare_results(results, results), [])
+
+
+class TestMetrics(KmlTestCase):
+    def test_export_json_and_prometheus(self):
+        """Тест: длительности, счётчики и размеры уходят в JSON и в textfile Prometheus"""
+        metrics = Metrics()
+        with metrics.stage("parse"):
+            metrics.count("rows_scanned", 10)
+        with self.assertRaises(ValueError):
+            with metrics.stage("download"):
+                raise ValueError
+        metrics.add_bytes("html_table", 2048)
+        metrics.merge({"stages": {"parse": {"seconds": 1.0, "calls": 1, "errors": 0}},
+                       "counters": {"rows_scanned": 5}, "bytes": {}})
+
+        json_path = self.path("metrics.json")
+        prom_path = self.path("aup.prom")
+        with patch("sys.stdout", new_callable=io.StringIO):
+            metrics.export(False, json_path, prom_path)
+        with open(json_path, encoding="utf-8") as f:
+            exported = json.load(f)
+        self.assertFalse(exported["success"])
+        self.assertEqual(exported["stages"]["parse"]["calls"], 2)
+        self.assertEqual(exported["stages"]["download"]["errors"], 1)
+        self.assertEqual(exported["counters"]["rows_scanned"], 15)
+        with open(prom_path, encoding="utf-8") as f:
+            prom = f.read()
+        self.assertIn('aup_items{counter="rows_scanned"} 15', prom)
+        self.assertIn('aup_bytes{file="html_table"} 2048', prom)
+        self.assertIn('aup_stage_errors{stage="download"} 1', prom)
+        self.assertIn("aup_last_run_success 0", prom)
+        self.assertIn("# TYPE aup_stage_duration_seconds gauge", prom)
+
+    def test_placemark_counters(self):
+        """Тест: обе версии обработки KML считают просмотренные, оставленные, удалённые и скопированные метки"""
+        regions = {"d10": ["10:00-12:00|GND/FL100"]}
+        for process in (process_ge_pro_kml, process_ge_pro_kml_stream):
+            METRICS.reset()
+            with patch("sys.stdout", new_callable=io.StringIO):
+                process(self.input_kml, self.output_kml, ["AREAS LP-R"], regions)
+            counters = METRICS.counters
+            self.assertEqual((counters["placemarks_scanned"], counters["placemarks_matched"],
+                              counters["placemarks_removed"], counters["placemarks_copied"]), (2, 1, 1, 1))
+            self.assertGreater(METRICS.sizes["output_kml"], 0)
+        self.assertIn("kml_stream", METRICS.stages)
+
+    def test_structured_log(self):
+        """Тест: в режиме LOG_FORMAT=json строки print и этапы пишутся как JSON без цветовых кодов"""
+        output = io.StringIO()
+        with self.patch_module(LOG_FORMAT="json"), patch("sys.stdout", JsonLogStream(output)):
+            print("\033[32mProcess finished\033[0m, without errors.")
+            with Metrics().stage("parse"):
+                pass
+        records = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(records[0]["message"], "Process finished, without errors.")
+        self.assertEqual((records[1]["event"], records[1]["stage"], records[1]["status"]), ("stage", "parse", "ok"))
+
+
+class TestKmz(KmlTestCase):
+    ICON_STYLE = ('<Style id="icon"><IconStyle><Icon><href>files/icon.png</href></Icon></IconStyle></Style>'
+                  '<Style id="web"><IconStyle><Icon><href>http://maps.google.com/a.png</href></Icon></IconStyle>'
+                  '</Style>')
+    DATABASE_KML = SAMPLE_KML.replace("<name>Base</name>", "<name>Base</name>" + ICON_STYLE).replace(
+        "<name>LP-D10</name>", "<name>LP-D10</name><styleUrl>#icon</styleUrl>")
+
+    def setUp(self):
+        super().setUp()
+        self.input_kmz = self.path("base.kmz")
+        with zipfile.ZipFile(self.input_kmz, "w", zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr("doc.kml", self.DATABASE_KML)
+            archive.writestr("files/icon.png", b"PNG")
+        self.regions = {"d10": ["10:00-12:00|GND/FL100"]}
+
+    def read_doc(self, path):
+        with zipfile.ZipFile(path) as archive:
+            self.assertEqual(archive.namelist(), ["doc.kml", "files/icon.png"])
+            self.assertEqual(archive.read("files/icon.png"), b"PNG")
+            return archive.read("doc.kml").decode("utf-8")
+
+    def test_kmz_in_kmz_out(self):
+        """Тест: база из KMZ, результат в KMZ с doc.kml первым и иконкой из исходного архива"""
+        with patch("sys.stdout", new_callable=io.StringIO):
+            for process in (process_ge_pro_kml, process_ge_pro_kml_stream):
+                output_kmz = self.path(f"{process.__name__}.kmz")
+                process(self.input_kmz, output_kmz, ["AREAS LP-R"], self.regions)
+                doc = self.read_doc(output_kmz)
+                self.assertIn("LP-D10", doc)
+                self.assertNotIn("LP-D11", doc)
+                self.assertIn("10:00-12:00", doc)
+                self.assertIn(f"<name>{output_kmz[:-4]}</name>", doc)
+
+    def test_icon_next_to_kml(self):
+        """Тест: для базы KML иконка берётся с диска рядом с базой, индекс имён читает KMZ"""
+        os.makedirs(self.path("files"))
+        with open(self.path(os.path.join("files", "icon.png")), "wb") as f:
+            f.write(b"PNG")
+        output_kmz = self.path("out.kmz")
+        with patch("sys.stdout", new_callable=io.StringIO):
+            self.assertEqual(build_name_index(self.input_kmz)["folders"],
+                             build_name_index(self.input_kml)["folders"])
+            process_ge_pro_kml(self.input_kml, output_kmz, ["AREAS LP-R"], self.regions)
+        self.assertIn("LP-D10", self.read_doc(output_kmz))
+
+    def test_compact_output(self):
+        """Тест: компактная запись без отступов даёт тот же документ, но меньше по размеру"""
+        with patch("sys.stdout", new_callable=io.StringIO):
+            for process in (process_ge_pro_kml, process_ge_pro_kml_stream):
+                pretty_kml = self.path("pretty.kml")
+                compact_kml = self.path("compact.kml")
+                process(self.input_kml, pretty_kml, ["AREAS LP-R"], self.regions, compact=False)
+                process(self.input_kml, compact_kml, ["AREAS LP-R"], self.regions, compact=True)
+                with open(compact_kml, encoding="utf-8") as f:
+                    self.assertEqual(f.read().count("\n"), 1)
+                self.assertLess(os.path.getsize(compact_kml), os.path.getsize(pretty_kml))
+                pretty_root = etree.parse(pretty_kml, etree.XMLParser(remove_blank_text=True)).getroot()
+                compact_root = etree.parse(compact_kml).getroot()
+                for root in (pretty_root, compact_root):
+                    root.find("{http://www.opengis.net/kml/2.2}Document/{http://www.opengis.net/kml/2.2}name").text = ""
+                self.assertEqual(etree.tostring(pretty_root, method="c14n"), etree.tostring(compact_root, method="c14n"))
+
+
+class TestStyleOptimization(KmlTestCase):
+    DATABASE_KML = """<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2">
+<Document>
+    <name>Base</name>
+    <Style id="a"><PolyStyle><color>99ffff00</color></PolyStyle></Style>
+    <Style id="b">
+        <PolyStyle><color>99ffff00</color></PolyStyle>
+    </Style>
+    <Style id="c"><PolyStyle><color>ff0000ff</color></PolyStyle></Style>
+    <Style id="d"><PolyStyle><color>ff00ff00</color></PolyStyle></Style>
+    <StyleMap id="m1"><Pair><key>normal</key><styleUrl>#a</styleUrl></Pair><Pair><key>highlight</key><styleUrl>#c</styleUrl></Pair></StyleMap>
+    <StyleMap id="m2"><Pair><key>normal</key><styleUrl>#b</styleUrl></Pair><Pair><key>highlight</key><styleUrl>#c</styleUrl></Pair></StyleMap>
+    <Folder>
+        <name>AREAS LP-D</name>
+        <Placemark>
+            <name>LP-D10</name>
+            <description>ALTITUDES XXXXft AGL/FLXXX TIME XX:XX-XX:XX</description>
+            <styleUrl>#m2</styleUrl>
+        </Placemark>
+        <Placemark>
+            <name>LP-D11</name>
+            <description>ALTITUDES XXXXft AGL/FLXXX TIME XX:XX-XX:XX</description>
+            <styleUrl>#d</styleUrl>
+        </Placemark>
+    </Folder>
+</Document>
+</kml>
+"""
+
+    def setUp(self):
+        super().setUp()
+        self.regions = {"d10": ["10:00-12:00|GND/FL100"]}
+        self.ns = {"kml": "http://www.opengis.net/kml/2.2"}
+
+    def run_process(self, process, **kwargs):
+        with patch("sys.stdout", new_callable=io.StringIO):
+            process(self.input_kml, self.output_kml, [], self.regions, **kwargs)
+        root = etree.parse(self.output_kml).getroot()
+        style_ids = [elem.get("id") for elem in root.iterfind(".//kml:Style", self.ns)]
+        map_ids = [elem.get("id") for elem in root.iterfind(".//kml:StyleMap", self.ns)]
+        urls = [elem.text for elem in root.iterfind(".//kml:styleUrl", self.ns)]
+        return style_ids, map_ids, urls
+
+    def test_merge_and_prune(self):
+        """Тест: одинаковые стили и StyleMap сливаются, неиспользуемые удаляются, ссылки переписаны"""
+        self.assertEqual(self.run_process(process_ge_pro_kml, optimize_styles=True),
+                         (["a", "c"], ["m1"], ["#a", "#c", "#m1"]))
+
+    def test_stream_merges_only(self):
+        """Тест: потоковый режим сливает дубликаты, но не удаляет стили, ссылки на которые могут быть дальше"""
+        self.assertEqual(self.run_process(process_ge_pro_kml_stream, optimize_styles=True),
+                         (["a", "c", "d"], ["m1"], ["#a", "#c", "#m1"]))
+
+    def test_no_prune_with_delta(self):
+        """Тест: с DELTA_KML стили не удаляются — на них могут ссылаться метки из Update"""
+        with self.patch_module(DELTA_KML=True):
+            style_ids, map_ids, urls = self.run_process(process_ge_pro_kml, optimize_styles=True)
+        self.assertEqual((style_ids, map_ids), (["a", "c", "d"], ["m1"]))
+
+    def test_disabled(self):
+        """Тест: при выключенной оптимизации стили копируются как были"""
+        self.assertEqual(self.run_process(process_ge_pro_kml, optimize_styles=False),
+                         (["a", "b", "c", "d"], ["m1", "m2"], ["#a", "#c", "#b", "#c", "#m2"]))
+
+
+class TestGeometry(KmlTestCase):
+    KML_TAG = "{http://www.opengis.net/kml/2.2}"
+    DATABASE_KML = SAMPLE_KML.replace("<name>LP-D10</name>", "<name>LP-D10</name><LineString><coordinates>"
+                                      "-8.000000123,39,0 -7.5,39.5,0 -7,40,0</coordinates></LineString>")
+
+    def placemark(self, geometry):
+        return etree.fromstring(f'<Placemark xmlns="http://www.opengis.net/kml/2.2"><name>LP-D10</name>'
+                                f'<description>x</description>{geometry}</Placemark>')
+
+    def test_circle_within_tolerance(self):
+        """Тест: плотная окружность упрощается, кольцо остаётся замкнутым, отклонение не больше допуска"""
+        import math
+        ring = " ".join(f"{-8 + 0.05 * math.cos(math.radians(a)):.9f},{39 + 0.05 * math.sin(math.radians(a)):.9f},0"
+                        for a in list(range(0, 360, 2)) + [0])
+        pm = self.placemark(f"<Polygon><outerBoundaryIs><LinearRing><coordinates>{ring}</coordinates>"
+                            f"</LinearRing></outerBoundaryIs></Polygon>")
+        report = simplify_kml_geometry(pm, tolerance_m=20)
+        coordinates = pm.findtext(f".//{self.KML_TAG}coordinates").split()
+        self.assertEqual(report[0]["points_before"], 181)
+        self.assertEqual(report[0]["points_after"], len(coordinates))
+        self.assertLess(len(coordinates), 60)
+        self.assertEqual(coordinates[0], coordinates[-1])
+        self.assertTrue(coordinates[0].endswith(",0"))
+        self.assertLessEqual(report[0]["max_deviation_m"], 20)
+
+    def test_collinear_line_and_precision(self):
+        """Тест: точки на прямой выкидываются, округление меняет только долготу/широту"""
+        pm = self.placemark("<LineString><coordinates>-8.0,39.0,100 -7.5,39.5,150 -7.0,40.0,200"
+                            "</coordinates></LineString>")
+        report = simplify_kml_geometry(pm, tolerance_m=1)
+        self.assertEqual(pm.findtext(f".//{self.KML_TAG}coordinates"), "-8,39,100 -7,40,200")
+        self.assertLess(report[0]["max_deviation_m"], 1)
+
+        pm = self.placemark("<Point><coordinates>-7.383181802386972,41.29934630257896</coordinates></Point>")
+        report = simplify_kml_geometry(pm, precision=4)
+        self.assertEqual(pm.findtext(f".//{self.KML_TAG}coordinates"), "-7.3832,41.2993")
+        self.assertEqual(report[0]["points_after"], 1)
+        self.assertGreater(report[0]["max_deviation_m"], 0)
+
+    def test_region_lod(self):
+        """Тест: Region/Lod по границам области добавляется перед геометрией, у точки его нет"""
+        pm = self.placemark("<LineString><coordinates>-8,39,0 -7,40,0</coordinates></LineString>")
+        simplify_kml_geometry(pm, lod_pixels=64)
+        self.assertEqual([etree.QName(child).localname for child in pm],
+                         ["name", "description", "Region", "LineString"])
+        self.assertEqual(pm.findtext(f".//{self.KML_TAG}north"), "40")
+        self.assertEqual(pm.findtext(f".//{self.KML_TAG}minLodPixels"), "64")
+        point = self.placemark("<Point><coordinates>-8,39,0</coordinates></Point>")
+        simplify_kml_geometry(point, lod_pixels=64)
+        self.assertIsNone(point.find(f"{self.KML_TAG}Region"))
+
+    def test_pipeline_option(self):
+        """Тест: стадия геометрии включается параметрами конфига в обоих режимах обработки"""
+        with self.patch_module(COORDINATE_PRECISION=2, SIMPLIFY_TOLERANCE_M=10), \
+                patch("sys.stdout", new_callable=io.StringIO) as stdout:
+            for process in (process_ge_pro_kml, process_ge_pro_kml_stream):
+                process(self.input_kml, self.output_kml, [], {"d10": ["10:00-12:00|GND/FL100"]})
+                with open(self.output_kml, encoding="utf-8") as f:
+                    self.assertIn("<coordinates>-8,39,0 -7,40,0</coordinates>", f.read())
+        self.assertIn("📐Geometry: 3 -> 2 points", stdout.getvalue())
+
+
+class TestCli(KmlTestCase):
+    TABLE_HTML = """<table>
+        <tr><td>LP-D10</td><td>10:00</td><td>12:00</td><td>SFC</td><td>050</td></tr>
+    </table>"""
+
+    def setUp(self):
+        super().setUp()
+        self.restore_config()
+        self.html_file = self.path("table.htm")
+        with open(self.html_file, "w", encoding="utf-8") as f:
+            f.write(self.TABLE_HTML)
+        self.config_file = self.path("config.json")
+        with open(self.config_file, "w", encoding="utf-8") as f:
+            json.dump(dict(DEFAULT_CONFIG, IS_ONLINE=False, HTML_FILE=self.html_file, INPUT_KML=self.input_kml,
+                           OUTPUT_KML=self.output_kml, CACHE_DIR=None, FULL_COPY=[]), f)
+
+    def test_import_is_lazy(self):
+        """Тест: импорт модуля не читает и не создаёт config.json и не загружает lxml, bs4, playwright"""
+        code = ("import sys, mirror_1; "
+                "print(sorted(m for m in ('lxml', 'bs4', 'playwright', 'numpy') if m in sys.modules))")
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(mirror_1.__file__)))
+        result = subprocess.run([sys.executable, "-c", code], cwd=self.tmp_dir, env=env,
+                                capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip(), "[]")
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ["base.kml", "config.json", "table.htm"])
+        os.remove(self.config_file)
+        subprocess.run([sys.executable, "-c", code], cwd=self.tmp_dir, env=env, check=True, capture_output=True)
+        self.assertFalse(os.path.exists(self.config_file))
+
+    def test_parse_command(self):
+        """Тест: команда parse печатает регионы и сохраняет их в JSON"""
+        regions_json = self.path("regions.json")
+        with patch("sys.stdout", new_callable=io.StringIO):
+            code = main(["--config", self.config_file, "parse", "--json", regions_json])
+        self.assertEqual(code, 0)
+        with open(regions_json, encoding="utf-8") as f:
+            self.assertEqual(json.load(f), {"LP": {"d10": ["10:00-12:00|GND/FL50"]}})
+
+    def test_render_and_run_offline(self):
+        """Тест: render и run --offline собирают KML из уже скачанной таблицы без сети"""
+        for argv in (["render", "--html", self.html_file], ["run", "--offline"]):
+            with patch("mirror_1.fetch_eaup_table") as fetch, patch("sys.stdout", new_callable=io.StringIO):
+                self.assertEqual(main(["--config", self.config_file] + argv), 0)
+            fetch.assert_not_called()
+            with open(self.output_kml, encoding="utf-8") as f:
+                self.assertIn("10:00-12:00", f.read())
+            os.remove(self.output_kml)
+
+    def test_missing_table(self):
+        """Тест: без таблицы команда завершается с кодом 1"""
+        with patch("sys.stdout", new_callable=io.StringIO), self.assertRaises(SystemExit) as raised:
+            main(["--config", self.config_file, "render", "--html", self.path("none.htm")])
+        self.assertEqual(raised.exception.code, 1)
+
+
+class TestAsyncPipeline(KmlTestCase):
+    TABLE_HTML = """<table>
+        <tr><td>LP-D10</td><td>10:00</td><td>12:00</td><td>SFC</td><td>050</td></tr>
+    </table>"""
+
+    def setUp(self):
+        super().setUp()
+        self.restore_config()
+        self.html_file = self.path("table.htm")
+        apply_config(dict(DEFAULT_CONFIG, HTML_FILE=self.html_file, INPUT_KML=self.input_kml,
+                          OUTPUT_KML=self.output_kml, CACHE_DIR=None, FULL_COPY=[], FETCH_BACKEND="http",
+                          HTTP_TABLE_URL="http://127.0.0.1/table.html?time={time:%Y%m%d%H%M}"))
+        METRICS.reset()
+
+    def test_database_preloaded_while_downloading(self):
+        """Тест: база KML разбирается, пока скачивается таблица, и не читается второй раз"""
+        preloaded = threading.Event()
+        original_load_name_index = mirror_1.load_name_index
+
+        def load_name_index(*args, **kwargs):
+            preloaded.set()
+            return original_load_name_index(*args, **kwargs)
+
+        def fetch(release):
+            # Скачивание не закончится, пока в другом потоке не будет готов индекс базы
+            self.assertTrue(preloaded.wait(5))
+            return "26/02/2026 14:00", self.TABLE_HTML
+
+        with patch("mirror_1.load_name_index", side_effect=load_name_index), \
+                patch("mirror_1.fetch_table_http", side_effect=fetch), \
+                patch("sys.stdout", new_callable=io.StringIO):
+            self.assertEqual(asyncio.run(run_pipeline_async()), "26/02/2026 14:00")
+
+        with open(self.output_kml, encoding="utf-8") as f:
+            self.assertIn("10:00-12:00", f.read())
+        with open(self.html_file, encoding="utf-8") as f:
+            self.assertEqual(f.read(), self.TABLE_HTML)
+        self.assertIn("kml_preload", METRICS.stages)
+        self.assertNotIn("kml_read", METRICS.stages)
+
+    def test_table_processed_on_main_thread(self):
+        """Тест: process_table идёт в главном потоке, пул процессов JOBS не запускается из рабочего потока"""
+        threads = []
+        with patch("mirror_1.fetch_table_http", return_value=("26/02/2026 14:00", self.TABLE_HTML)), \
+                patch("mirror_1.process_table", side_effect=lambda *args: threads.append(threading.current_thread())), \
+                patch("sys.stdout", new_callable=io.StringIO):
+            asyncio.run(run_pipeline_async())
+        self.assertEqual(threads, [threading.main_thread()])
+
+    def test_template_error_found_before_render(self):
+        """Тест: с TEMPLATE_ERROR_POLICY abort активная метка без шаблона останавливает работу до записи KML"""
+        apply_config(dict(mirror_1.config, TEMPLATE_ERROR_POLICY="abort"))
+        with open(self.input_kml, "w", encoding="utf-8") as f:
+            f.write(SAMPLE_KML.replace("ALTITUDES XXXXft AGL/FLXXX TIME XX:XX-XX:XX", "no template", 1))
+        with patch("mirror_1.fetch_table_http", return_value=("26/02/2026 14:00", self.TABLE_HTML)), \
+                patch("sys.stdout", new_callable=io.StringIO) as stdout, \
+                self.assertRaises(SystemExit):
+            asyncio.run(run_pipeline_async())
+        self.assertIn("AREAS LP-D: LP-D10 (active)", stdout.getvalue())
+        self.assertFalse(os.path.exists(self.output_kml))
+
+
+class TestDescriptionTemplates(KmlTestCase):
+    DATABASE_KML = SAMPLE_KML.replace(
+        "ALTITUDES XXXXft AGL/FLXXX TIME XX:XX-XX:XX", "ALTITUDES {bad} TIME", 1).replace("LP-D11", "LP-D12\n").replace(
+        "</Folder>", "<Placemark><name>LP-D11</name><description>{x} XX:XX-XX:XX XXXXft AGL/FLXXX"
+                     "</description></Placemark></Folder>", 1)
+
+    def setUp(self):
+        super().setUp()
+        self.restore_config()
+        self.regions_dict = {"d10": ["10:00-12:00|GND/FL50"], "d11": ["13:00-14:00|GND/FL90"]}
+
+    def test_compile(self):
+        """Тест: шаблон компилируется в строку для одной подстановки, фигурные скобки экранируются"""
+        template = compile_description_template("{a} XXXXft AGL/FLXXX at XX:XX-XX:XX")
+        self.assertEqual(template.format(altitudes="GND/FL50", active_time="10:00-12:00"),
+                         "{a} GND/FL50 at 10:00-12:00")
+        self.assertIsNone(compile_description_template("XX:XX-XX:XX only"))
+        self.assertIsNone(compile_description_template(None))
+
+    def test_index_keeps_templates(self):
+        """Тест: скомпилированные шаблоны хранятся в индексе имён, неверный — как null"""
+        templates = build_name_index(self.input_kml)["folders"][0]["templates"]
+        self.assertIsNone(templates["0"])
+        self.assertEqual(templates["2"], "{{x}} {active_time} {altitudes}")
+
+    def test_skip_policy_reports_all_errors(self):
+        """Тест: все неверные описания выводятся одним списком, активная метка пропускается, остальное пишется"""
+        for name_index in (None, load_name_index(self.input_kml)):
+            with self.subTest(name_index=name_index is not None), \
+                    patch("sys.stdout", new_callable=io.StringIO) as stdout:
+                process_ge_pro_kml(self.input_kml, self.output_kml, [], self.regions_dict, name_index)
+            self.assertIn("of 1 placemarks:\n\tAREAS LP-D: LP-D10 (active)", stdout.getvalue())
+            with open(self.output_kml, encoding="utf-8") as f:
+                output = f.read()
+            self.assertNotIn("LP-D10", output)
+            self.assertIn("{x} 13:00-14:00 GND/FL90", output)
+
+    def test_abort_policy_leaves_tree_untouched(self):
+        """Тест: с abort работа останавливается до изменения дерева и записи файла"""
+        apply_config(dict(mirror_1.config, TEMPLATE_ERROR_POLICY="abort"))
+        parser = etree.XMLParser(remove_blank_text=True)
+        tree = etree.parse(self.input_kml, parser)
+        before = etree.tostring(tree)
+        with patch("sys.stdout", new_callable=io.StringIO), self.assertRaises(SystemExit):
+            process_ge_pro_kml(self.input_kml, self.output_kml, [], self.regions_dict, tree=tree)
+        self.assertEqual(etree.tostring(tree), before)
+        self.assertFalse(os.path.exists(self.output_kml))
+
+    def test_stream_policies(self):
+        """Тест: потоковый режим пропускает метку с неверным шаблоном, а с abort не оставляет файл"""
+        with patch("sys.stdout", new_callable=io.StringIO) as stdout:
+            process_ge_pro_kml_stream(self.input_kml, self.output_kml, [], self.regions_dict, atomic=True)
+        self.assertIn("LP-D10 (active)", stdout.getvalue())
+        with open(self.output_kml, encoding="utf-8") as f:
+            self.assertNotIn("LP-D10", f.read())
+        os.remove(self.output_kml)
+        apply_config(dict(mirror_1.config, TEMPLATE_ERROR_POLICY="abort"))
+        with patch("sys.stdout", new_callable=io.StringIO), self.assertRaises(SystemExit):
+            process_ge_pro_kml_stream(self.input_kml, self.output_kml, [], self.regions_dict, atomic=True)
+        self.assertFalse(os.path.exists(self.output_kml))
+
+    def test_stream_abort_keeps_previous_output(self):
+        """Тест: с abort потоковый режим не портит прежний файл и без atomic"""
+        with open(self.output_kml, "w", encoding="utf-8") as f:
+            f.write("previous")
+        apply_config(dict(mirror_1.config, TEMPLATE_ERROR_POLICY="abort"))
+        with patch("sys.stdout", new_callable=io.StringIO), self.assertRaises(SystemExit):
+            process_ge_pro_kml_stream(self.input_kml, self.output_kml, [], self.regions_dict, atomic=False)
+        with open(self.output_kml, encoding="utf-8") as f:
+            self.assertEqual(f.read(), "previous")
+        self.assertFalse([name for name in os.listdir(self.tmp_dir) if name.startswith(".tmp-")])
+
+
+def square_placemark(name, lat, lon, size=0.1):
+    ring = [(lon, lat), (lon + size, lat), (lon + size, lat + size), (lon, lat + size), (lon, lat)]
+    coordinates = " ".join(f"{x},{y},0" for x, y in ring)
+    return f"""<Placemark><name>{name}</name>
+        <description>ALTITUDES XXXXft AGL/FLXXX TIME XX:XX-XX:XX</description>
+        <Polygon><outerBoundaryIs><LinearRing><coordinates>{coordinates}</coordinates></LinearRing></outerBoundaryIs>
+        </Polygon></Placemark>"""
+
+
+SPATIAL_KML = f"""<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2">
+<Document>
+    <name>Base</name>
+    <Folder>
+        <name>AREAS LP-D</name>
+        {square_placemark("LP-D10", 38.0, -9.0)}
+        {square_placemark("LP-D11", 38.5, -9.0)}
+        {square_placemark("LP-D12", 40.0, -8.0)}
+    </Folder>
+</Document>
+</kml>
+"""
+
+
+class TestSpatialIndex(KmlTestCase):
+    DATABASE_KML = SPATIAL_KML
+
+    def setUp(self):
+        super().setUp()
+        self.index = SpatialIndex(build_spatial_areas(self.input_kml))
+        self.regions = {
+            "d10": [Activation("d10", 600, 720, 0, "GND", 50, "FL")],
+            "d11": [Activation("d11", 780, 840, 100, "FL", 240, "FL")],
+            "d12": [Activation("d12", 600, 720, 0, "GND", 50, "FL")],
+        }
+
+    def names(self, results):
+        return [result["area"]["name"] for result in results]
+
+    def test_route_corridor(self):
+        """Тест: маршрут находит пересечённую область и соседнюю в пределах половины ширины коридора"""
+        route = [(38.05, -9.3), (38.05, -8.7)]
+        self.assertEqual(self.names(query_active_areas(self.index, self.regions, route=route, width_nm=2)), ["LP-D10"])
+        # До LP-D11 по широте 0.45° ≈ 27 NM
+        results = query_active_areas(self.index, self.regions, route=route, width_nm=60)
+        self.assertEqual(self.names(results), ["LP-D10", "LP-D11"])
+        self.assertAlmostEqual(results[1]["distance_m"] / 1852, 27, delta=0.5)
+
+    def test_route_inside_area(self):
+        """Тест: маршрут из одной точки внутри области"""
+        self.assertEqual(self.names(query_active_areas(self.index, self.regions, route=[(40.05, -7.95)])), ["LP-D12"])
+
+    def test_bbox_altitude_and_time(self):
+        """Тест: рамка, диапазон высот и окно времени отбирают только подходящие активации"""
+        bbox = (37.9, -9.2, 38.7, -8.8)
+        self.assertEqual(self.names(query_active_areas(self.index, self.regions, bbox=bbox)), ["LP-D10", "LP-D11"])
+        self.assertEqual(self.names(query_active_areas(self.index, self.regions, bbox=bbox, lower_ft=6000)),
+                         ["LP-D11"])
+        self.assertEqual(self.names(query_active_areas(self.index, self.regions, bbox=bbox, window=(610, 620))),
+                         ["LP-D10"])
+        # Рамка целиком внутри области
+        self.assertEqual(self.names(query_active_areas(self.index, self.regions, bbox=(38.04, -8.96, 38.06, -8.94))),
+                         ["LP-D10"])
+
+    def test_index_cached(self):
+        """Тест: контуры сохраняются рядом с базой и читаются без разбора KML"""
+        with patch("sys.stdout", new_callable=io.StringIO):
+            load_spatial_index(self.input_kml)
+        with patch("mirror_1.build_spatial_areas") as build:
+            self.assertEqual(len(load_spatial_index(self.input_kml).areas), 3)
+        build.assert_not_called()
+
+    def test_query_command(self):
+        """Тест: команда query сохраняет найденные области в JSON и KML"""
+        self.restore_config()
+        html_file = self.path("table.htm")
+        with open(html_file, "w", encoding="utf-8") as f:
+            f.write("""<table>
+                <tr><td>LP-D10</td><td>10:00</td><td>12:00</td><td>SFC</td><td>050</td></tr>
+                <tr><td>LP-D12</td><td>10:00</td><td>12:00</td><td>SFC</td><td>050</td></tr>
+            </table>""")
+        config_file = self.path("config.json")
+        with open(config_file, "w", encoding="utf-8") as f:
+            json.dump(dict(DEFAULT_CONFIG, HTML_FILE=html_file, INPUT_KML=self.input_kml, CACHE_DIR=None,
+                           FULL_COPY=[]), f)
+        areas_json = self.path("areas.json")
+        areas_kml = self.path("areas.kml")
+        with patch("sys.stdout", new_callable=io.StringIO):
+            code = main(["--config", config_file, "query", "--route", "38.05,-9.3", "38.05,-8.7", "--width", "5",
+                         "--json", areas_json, "--kml", areas_kml])
+        self.assertEqual(code, 0)
+        with open(areas_json, encoding="utf-8") as f:
+            areas = json.load(f)
+        self.assertEqual([area["name"] for area in areas], ["LP-D10"])
+        self.assertEqual(areas[0]["activations"], [{"time": "10:00-12:00", "altitudes": "GND/FL50",
+                                                    "lower_ft": 0, "upper_ft": 5000}])
+        with open(areas_kml, encoding="utf-8") as f:
+            output = f.read()
+        self.assertIn("10:00-12:00", output)
+        self.assertNotIn("LP-D12", output)
+
+
+class TestHistory(TempDirTestCase):
+    TABLES = {
+        "202602251400_abc.htm": """<table>
+            <tr><td>LP-D10</td><td>10:00</td><td>12:00</td><td>SFC</td><td>050</td></tr>
+            <tr><td>LP-R15</td><td>22:00</td><td>02:00</td><td>245</td><td>300</td></tr>
+        </table>""",
+        "2026-02-26 14.00 AUP.htm": """<table>
+            <tr><td>LP-D10</td><td>08:00</td><td>09:00</td><td>SFC</td><td>030</td></tr>
+        </table>""",
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.archive = self.path("archive")
+        os.makedirs(self.archive)
+        for file_name, html in self.TABLES.items():
+            with open(os.path.join(self.archive, file_name), "w", encoding="utf-8") as f:
+                f.write(html)
+        self.db_path = self.path("history.sqlite")
+        self.store = HistoryStore(self.db_path)
+        self.addCleanup(self.store.close)
+
+    def test_snapshot_release(self):
+        """Тест: время выпуска берётся из имени файла в разных форматах"""
+        expected = datetime(2026, 2, 26, 14, 0, tzinfo=timezone.utc)
+        for file_name in ("202602261400_0123456789abcdef.htm", "2026-02-26 14:00.htm", "2026-02-26T14-00.html"):
+            self.assertEqual(snapshot_release(file_name), expected)
+
+    def test_region_key(self):
+        """Тест: имя области приводится к ключу из разбора таблицы"""
+        self.assertEqual(history_region_key("LP-D10", ("LP",)), ("LP", "d10"))
+        self.assertEqual(history_region_key("tra-13", ("LP",)), (None, "tra13"))
+
+    def test_ingest_and_queries(self):
+        """Тест: архив загружается пулом процессов, повторная загрузка ничего не добавляет, запросы идут из базы"""
+        with patch("sys.stdout", new_callable=io.StringIO):
+            self.assertEqual(ingest_history(self.archive, self.store, workers=2, prefixes=("LP",)), 2)
+            self.assertEqual(ingest_history(self.archive, self.store, workers=2, prefixes=("LP",)), 0)
+
+        history = [(release, str(activation)) for release, activation in self.store.region_history("d10", "LP")]
+        self.assertEqual(history, [("2026-02-25 14:00", "10:00-12:00|GND/FL50"),
+                                   ("2026-02-26 14:00", "08:00-09:00|GND/3000ft AMSL")])
+        self.assertEqual(len(self.store.region_history("d10", since="2026-02-26")), 1)
+        self.assertEqual(len(self.store.region_history("d10", until="2026-02-25")), 1)
+
+        stats = self.store.stats()
+        self.assertEqual((stats["releases"], stats["first"], stats["last"]),
+                         (2, "2026-02-25 14:00", "2026-02-26 14:00"))
+        by_region = {entry["region"]: entry for entry in stats["regions"]}
+        self.assertEqual((by_region["d10"]["releases"], by_region["d10"]["activations"], by_region["d10"]["hours"]),
+                         (2, 2, 3.0))
+        # Интервал через полночь: 22:00-02:00 — 4 часа
+        self.assertEqual(by_region["r15"]["hours"], 4.0)
+        self.assertEqual(self.store.stats(since="2026-02-26")["releases"], 1)
+
+    def test_history_commands(self):
+        """Тест: команды ingest и history region/stats с выводом в JSON"""
+        self.restore_config()
+        config_file = self.path("config.json")
+        with open(config_file, "w", encoding="utf-8") as f:
+            json.dump(dict(DEFAULT_CONFIG, HISTORY_DB=self.db_path, CACHE_DIR=None), f)
+        region_json = self.path("region.json")
+        stats_json = self.path("stats.json")
+        with patch("sys.stdout", new_callable=io.StringIO):
+            self.assertEqual(main(["--config", config_file, "ingest", self.archive, "--workers", "1"]), 0)
+            self.assertEqual(main(["--config", config_file, "history", "region", "LP-D10", "--json", region_json]), 0)
+            self.assertEqual(main(["--config", config_file, "history", "stats", "--to", "2026-02-25",
+                                   "--json", stats_json]), 0)
+        with open(region_json, encoding="utf-8") as f:
+            self.assertEqual([entry["time"] for entry in json.load(f)], ["10:00-12:00", "08:00-09:00"])
+        with open(stats_json, encoding="utf-8") as f:
+            self.assertEqual([entry["region"] for entry in json.load(f)["regions"]], ["r15", "d10"])
+
+    def test_run_recorded(self):
+        """Тест: с HISTORY_RECORD обработанная таблица сохраняется в истории"""
+        self.restore_config()
+        apply_config(dict(mirror_1.config, HISTORY_RECORD=True, HISTORY_DB=self.db_path, CACHE_DIR=None))
+        with patch("mirror_1.write_outputs"), patch("sys.stdout", new_callable=io.StringIO):
+            process_table(self.TABLES["202602251400_abc.htm"], "25/02/2026 14:00")
+        self.assertEqual([release for release, _ in self.store.region_history("r15", "LP")], ["2026-02-25 14:00"])
+
+
+class TestRowDelta(KmlTestCase):
+    ROW = "<tr><td>{}</td><td>{}</td><td>{}</td><td>SFC</td><td>{}</td></tr>"
+
+    def setUp(self):
+        super().setUp()
+        self.rows = [self.ROW.format("LP-D10", "10:00", "12:00", "100"),
+                     self.ROW.format("LP-R20", "08:00", "09:00", "50"),
+                     self.ROW.format("LE-D1", "06:00", "07:00", "60")]
+
+    def table(self, rows):
+        return "<html><body><table>" + "".join(rows) + "</table></body></html>"
+
+    def parse(self, html, state):
+        with patch("sys.stdout", new=io.StringIO()):
+            return parse_eaup_records(html, ["LP", "LE"], row_state=state)
+
+    def test_split_table_rows(self):
+        """Тест: строки берутся как есть, вложенные и незакрытые <tr> отключают разбиение"""
+        self.assertEqual(split_table_rows(self.table(self.rows) + "<!-- <tr>old</tr> -->"), self.rows)
+        self.assertIsNone(split_table_rows("<table><tr><td>LP-D10<tr><td>10:00</td></tr></table>"))
+
+    def test_delta_equals_full_parse(self):
+        """Тест: разбор по изменениям совпадает с полным разбором и знает изменившиеся области"""
+        state = EaupRowState()
+        self.assertEqual(self.parse(self.table(self.rows), state),
+                         parse_eaup_records(self.table(self.rows), ["LP", "LE"]))
+        self.assertIsNone(state.changed)
+
+        rows = [self.rows[0].replace("12:00", "13:00"), self.rows[2]]
+        with patch("mirror_1._parse_eaup_row", wraps=mirror_1._parse_eaup_row) as mock_row:
+            regions = self.parse(self.table(rows), state)
+        self.assertEqual(mock_row.call_count, 1)
+        self.assertEqual(regions, parse_eaup_records(self.table(rows), ["LP", "LE"]))
+        self.assertEqual(state.changed, {"LP": {"d10", "r20"}})
+
+    def test_reordered_rows_change_area(self):
+        """Тест: другой порядок строк одной области считается изменением, других областей — нет"""
+        state = EaupRowState()
+        rows = self.rows + [self.ROW.format("LP-D10", "14:00", "16:00", "50")]
+        self.parse(self.table(rows), state)
+        self.parse(self.table([rows[1], rows[0], rows[2], rows[3]]), state)
+        self.assertEqual(state.changed, {})
+        self.parse(self.table([rows[3], rows[1], rows[0], rows[2]]), state)
+        self.assertEqual(state.changed, {"LP": {"d10"}})
+
+    def test_other_prefixes_reset_state(self):
+        """Тест: другой набор FIR разбирает таблицу заново"""
+        state = EaupRowState()
+        self.parse(self.table(self.rows), state)
+        with patch("sys.stdout", new=io.StringIO()):
+            regions = parse_eaup_records(self.table(self.rows), ["LP"], row_state=state)
+        self.assertEqual(list(regions), ["LP"])
+        self.assertIsNone(state.changed)
+
+    def run_process_table(self, html):
+        with self.patch_job(CACHE_DIR=self.path("cache"), ROW_DELTA=True), \
+                patch("mirror_1.write_active_regions", wraps=mirror_1.write_active_regions) as mock_write, \
+                patch("sys.stdout", new=io.StringIO()):
+            process_table(html, "26/02/2026 14:00")
+        return mock_write.call_count
+
+    def test_unchanged_fir_output_is_kept(self):
+        """Тест: UUP без изменений в областях FIR не пересобирает его KML"""
+        self.assertEqual(self.run_process_table(self.table(self.rows)), 1)
+        rows = self.rows[:2] + [self.rows[2].replace("07:00", "08:00")]
+        self.assertEqual(self.run_process_table(self.table(rows)), 0)
+        rows[0] = rows[0].replace("12:00", "13:00")
+        self.assertEqual(self.run_process_table(self.table(rows)), 1)
+        with open(self.output_kml, encoding="utf-8") as f:
+            self.assertIn("10:00-13:00", f.read())
+
+
+OUTPUTS_KML = f"""<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2">
+<Document>
+    <name>Base</name>
+    <Folder>
+        <name>AREAS LP-D</name>
+        {square_placemark("LP-D10", 38.0, -9.0)}
+        {square_placemark("LP-D11", 38.5, -9.0)}
+    </Folder>
+    <Folder>
+        <name>AREAS LP-R</name>
+        {square_placemark("LP-R20", 39.0, -9.0)}
+    </Folder>
+    <Folder>
+        <name>ALWAYS ON</name>
+        {square_placemark("LP-X1", 40.0, -9.0)}
+    </Folder>
+</Document>
+</kml>
+"""
+
+
+class TestRenderOutputs(KmlTestCase):
+    DATABASE_KML = OUTPUTS_KML
+
+    def setUp(self):
+        super().setUp()
+        self.regions_dict = {
+            "d10": [Activation("d10", 600, 720, 0, "GND", 50, "FL")],
+            "d11": [Activation("d11", 600, 720, 150, "FL", 245, "FL")],
+            "r20": [Activation("r20", 480, 540, 0, "GND", 60, "FL"), Activation("r20", 900, 960, 200, "FL", 300, "FL")],
+        }
+        self.kml_ns = {"k": "http://www.opengis.net/kml/2.2"}
+
+    def render(self, sinks, **kwargs):
+        with patch("sys.stdout", new=io.StringIO()):
+            render_outputs(self.input_kml, [output_sink(sink) for sink in sinks], ["ALWAYS ON"],
+                           self.regions_dict, **kwargs)
+
+    def names(self, path):
+        return etree.parse(path).xpath("//k:Placemark/k:name/text()", namespaces=self.kml_ns)
+
+    def test_main_output_matches_process_ge_pro_kml(self):
+        """Тест: первый выход совпадает с файлом process_ge_pro_kml"""
+        expected_path = self.path("expected.kml")
+        with patch("sys.stdout", new=io.StringIO()):
+            process_ge_pro_kml(self.input_kml, expected_path, ["ALWAYS ON"], self.regions_dict)
+        self.render([self.path("expected.kml").replace("expected", "actual"), self.path("extra.geojson")])
+        with open(expected_path, "rb") as expected, open(self.path("actual.kml"), "rb") as actual:
+            self.assertEqual(actual.read().replace(b"actual", b"expected"), expected.read())
+
+    def test_filters_by_level_area_and_folder(self):
+        """Тест: выходы фильтруются по высотам, типу области и папкам, описание — только своих активаций"""
+        self.render([self.path("all.kml"),
+                     {"PATH": self.path("low.kml"), "UPPER_FT": 10000},
+                     {"PATH": self.path("high.kmz"), "LOWER_FT": 10000, "AREAS": ["R"]},
+                     {"PATH": self.path("d.kml"), "FOLDERS": ["AREAS LP-D"]}])
+        self.assertEqual(self.names(self.path("all.kml")), ["LP-D10", "LP-D11", "LP-R20", "LP-X1"])
+        self.assertEqual(self.names(self.path("low.kml")), ["LP-D10", "LP-R20", "LP-X1"])
+        self.assertEqual(self.names(self.path("d.kml")), ["LP-D10", "LP-D11"])
+        with zipfile.ZipFile(self.path("high.kmz")) as archive:
+            high = etree.fromstring(archive.read("doc.kml"))
+        self.assertEqual(high.xpath("//k:Placemark/k:name/text()", namespaces=self.kml_ns), ["LP-R20", "LP-X1"])
+        description = high.xpath("//k:Placemark/k:description/text()", namespaces=self.kml_ns)[0]
+        self.assertIn("15:00-16:00", description)
+        self.assertNotIn("08:00-09:00", description)
+        self.assertEqual(high.findtext("k:Document/k:name", namespaces=self.kml_ns), self.path("high"))
+
+    def test_geojson_features(self):
+        """Тест: GeoJSON содержит полигоны, активации и метки из FULL_COPY без активаций"""
+        self.render([self.path("all.kml"), {"PATH": self.path("areas.geojson"), "UPPER_FT": 10000}],
+                    time_span_day=datetime(2026, 2, 26).date())
+        with open(self.path("areas.geojson"), encoding="utf-8") as f:
+            collection = json.load(f)
+        features = {feature["properties"]["name"]: feature for feature in collection["features"]}
+        self.assertEqual(sorted(features), ["LP-D10", "LP-R20", "LP-X1"])
+        self.assertEqual(features["LP-D10"]["geometry"]["type"], "Polygon")
+        self.assertEqual(features["LP-D10"]["geometry"]["coordinates"][0][0], [-9.0, 38.0])
+        self.assertEqual(features["LP-R20"]["properties"]["activations"],
+                         [{"time": "08:00-09:00", "altitudes": "GND/FL60", "lower_ft": 0, "upper_ft": 6000,
+                           "begin": "2026-02-26T08:00:00Z", "end": "2026-02-26T09:00:00Z"}])
+        self.assertEqual(features["LP-X1"]["properties"]["activations"], [])
+
+    def test_outputs_config(self):
+        """Тест: OUTPUTS привязываются к задаче своего префикса, неизвестный формат — ошибка"""
+        jobs = [{"INPUT_KML": "lp.kml", "OUTPUT_KML": "lp_out.kml", "PREFIX": "LP"},
+                {"INPUT_KML": "le.kml", "OUTPUT_KML": "le_out.kml", "PREFIX": "LE",
+                 "OUTPUTS": ["le.geojson"]}]
+        with self.patch_module(JOBS=jobs, OUTPUTS=["lp.kmz", {"PATH": "le.kml", "PREFIX": "le"}]):
+            self.assertEqual([[sink["PATH"] for sink in job["OUTPUTS"]] for job in kml_jobs()],
+                             [["lp.kmz"], ["le.geojson", "le.kml"]])
+        with self.assertRaises(ValueError):
+            output_sink("areas.csv")
+
+
 if __name__ == "__main__":
     unittest.main()